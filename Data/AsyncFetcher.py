@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from Data.RateLimiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFetcher:
+    """
+    Asynchronous HTTP engine used by the async versions of DataPipeline methods.
+
+    One httpx.AsyncClient (keep-alive connection pool) is shared by all requests. Every routing host
+    (eun1 - platform, europe - regional) has its own budget in the RateLimiter and its own cap of requests
+    in flight, so calls to one host never wait for the other one. 429 is retried after Retry-After, 5xx after
+    retry_backoff, 2 * retry_backoff, 4 * retry_backoff ... seconds.
+
+    Usage:
+        async with AsyncFetcher(pipeline.rate_limiter) as fetcher:
+            data = await fetcher.get(url)
+    """
+
+    def __init__(self, rate_limiter, max_in_flight_per_host=20, max_retries=3, retry_backoff=1.0, timeout=10.0,
+                 metrics=None):
+        self.rate_limiter = rate_limiter
+        # optional PipelineMetrics
+        self.metrics = metrics
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.client = None
+        self.host_semaphores = {}
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=None,
+                              max_keepalive_connections=self.max_in_flight_per_host * 2,
+                              keepalive_expiry=30)
+        self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.aclose()
+        self.client = None
+
+    def _semaphore(self, host):
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_in_flight_per_host)
+        return self.host_semaphores[host]
+
+    async def get(self, url, method=None, raw=False):
+        host = urlsplit(url).netloc
+        method = method or RateLimiter.method_from_url(url)
+
+        for attempt in range(self.max_retries + 1):
+            # reservation is taken before waiting, so concurrent tasks get consecutive slots instead of racing
+            wait = self.rate_limiter.reserve(host, method)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            async with self._semaphore(host):
+                started = time.perf_counter()
+                response = await self.client.get(url)
+            self.rate_limiter.update_from_headers(host, method, response.headers)
+            if self.metrics:
+                self.metrics.observe_throttle(method, wait)
+                self.metrics.observe_request(method, response.status_code, time.perf_counter() - started,
+                                             len(response.content))
+
+            if response.status_code == 429:
+                retry_after = self.rate_limiter.on_rate_limited(host, method, response.headers)
+                logger.warning(f"Rate limited on {method} ({host}), retrying in {retry_after} seconds")
+                continue
+
+            if response.status_code >= 500 and attempt < self.max_retries:
+                backoff = self.retry_backoff * 2 ** attempt
+                logger.warning(f"{method} ({host}) returned {response.status_code}, retrying in {backoff} seconds")
+                await asyncio.sleep(backoff)
+                continue
+
+            if response.status_code != 200:
+                raise Exception(f"{url} returned {response.status_code} : {response.text}")
+
+            return response.content if raw else response.json()
+
+        raise Exception(f"{url} still rate limited after {self.max_retries} retries")
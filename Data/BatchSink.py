@@ -0,0 +1,81 @@
+import time
+
+
+class BatchSink:
+    """
+    Buffer between DataPipeline (which yields rows of one match at a time) and the database.
+
+    Rows are collected into micro-batches and written with DatabaseConnection.add_match_rows_bulk every
+    max_matches matches or max_seconds seconds (checked when a match is added), whichever comes first,
+    so memory usage doesn't depend on the size of the crawl and a crash loses at most one batch.
+    If a write fails, the batch stays in the buffer (it's written with the next flush) and the error is raised
+    to the caller.
+
+    Usage:
+        with BatchSink(db) as sink:
+            for match_rows in pipeline.collect_data_from_tier(10, 1, tier):
+                sink.add(match_rows)
+    """
+
+    TABLES = ("matches", "players", "traits", "units", "items")
+
+    def __init__(self, db, max_matches=50, max_seconds=30, on_flush=None, metrics=None, on_batch=None):
+        self.db = db
+        self.max_matches = max_matches
+        self.max_seconds = max_seconds
+        # optional callback called with match ids of every batch written to the database
+        self.on_flush = on_flush
+        # optional callback called with rows of every batch written to the database (e.g. BoardIndex.add_rows)
+        self.on_batch = on_batch
+        # optional PipelineMetrics - rows written per table and duration of every write
+        self.metrics = metrics
+
+        self.buffer = self.empty_buffer()
+        self.buffered_matches = 0
+        self.batch_started = time.monotonic()
+
+        self.flushed_batches = 0
+        self.flushed_matches = 0
+
+    def empty_buffer(self):
+        return {table: [] for table in self.TABLES}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # rows of fully analyzed matches are fine even if the crawl itself failed
+        self.flush()
+
+    def add(self, match_rows):
+        if self.buffered_matches == 0:
+            self.batch_started = time.monotonic()
+
+        for table, rows in match_rows.items():
+            self.buffer[table].extend(rows)
+        self.buffered_matches += 1
+
+        if (self.buffered_matches >= self.max_matches
+                or time.monotonic() - self.batch_started >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        if self.buffered_matches == 0:
+            return
+
+        batch = self.buffer
+        started = time.perf_counter()
+        self.db.add_match_rows_bulk(batch)
+        # the buffer is emptied only when the batch is written
+        self.buffer, self.buffered_matches = self.empty_buffer(), 0
+        if self.metrics:
+            self.metrics.observe_write({table: len(rows) for table, rows in batch.items()},
+                                       time.perf_counter() - started)
+        self.flushed_batches += 1
+        self.flushed_matches += len(batch["matches"])
+
+        if self.on_batch:
+            self.on_batch(batch)
+        if self.on_flush:
+            # match_id is the first column of the matches rows
+            self.on_flush([match[0] for match in batch["matches"]])
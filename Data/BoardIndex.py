@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class BoardIndex:
+    """
+    Fingerprints of boards (one player in one match) for questions like "which comps look like this one and how
+    do they place" without merging millions of trait / unit / item rows.
+
+    Every board is a bitset over the features of its set:
+    - active trait with its tier - T:TFT14_Vanguard:2,
+    - unit with its star level - U:TFT14_Jinx:3,
+    - item - I:TFT_Item_GuinsoosRageblade.
+    Bitsets are rows of a memory-mapped uint64 matrix (one per set) stored with placement and number of set bits of
+    every board, so a query is a few vectorized passes over the matrix (AND + popcount) - milliseconds for
+    a whole set's worth of boards. Similarity of two boards is Jaccard (shared features / all features).
+
+    Layout of <root>/set_<N>/:
+    - features.json - feature -> bit (new features get the next bit, the matrix is widened when they don't fit),
+    - boards.u64 - boards x words matrix, placements.u8 and bits.u16 - one value per board,
+    - keys.bin - match_id and puuid of every board (fixed size records, record number = row of the matrix),
+    - matches.txt - indexed matches (a match is never added twice),
+    - meta.json - number of boards, words per board and size of matches.txt. Files are appended first and meta.json
+      is written last, rows after the count (and matches after the size) from meta.json - an interrupted append -
+      are ignored when reading and cut off before the next append.
+
+    Boards are added at ingest (add_rows - BatchSink on_batch) or from the database (build_from_db).
+    """
+
+    KEY_SIZE = 128
+
+    def __init__(self, root, initial_words=8):
+        self.root = root
+        self.initial_words = initial_words
+        self.lock = threading.Lock()
+        # set number -> state of the set (path, count, words, features, indexed matches)
+        self.sets = {}
+
+    # storage
+    def _open(self, set_number):
+        state = self.sets.get(set_number)
+        if state is not None:
+            return state
+
+        path = os.path.join(self.root, f"set_{set_number}")
+        os.makedirs(path, exist_ok=True)
+        meta = self._read_json(os.path.join(path, "meta.json"), {"count": 0, "words": self.initial_words})
+        matches_path = os.path.join(path, "matches.txt")
+        matches = set()
+        # indexes written before the size was stored in meta.json take the whole file
+        matches_size = meta.get("matches_size")
+        if os.path.exists(matches_path):
+            with open(matches_path, "rb") as file:
+                data = file.read() if matches_size is None else file.read(matches_size)
+            matches = {line.strip() for line in data.decode("utf-8").splitlines() if line.strip()}
+            if matches_size is None:
+                matches_size = len(data)
+
+        state = {
+            "path": path,
+            "count": meta["count"],
+            "words": meta["words"],
+            "matches_size": matches_size or 0,
+            "features": self._read_json(os.path.join(path, "features.json"), {}),
+            "matches": matches,
+        }
+        self.sets[set_number] = state
+        return state
+
+    @staticmethod
+    def _read_json(path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+
+    @staticmethod
+    def _write_json(path, value):
+        # written next to the target and renamed, so a reader never sees half of the file
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _append(path, data, expected_size):
+        """Appending after the last committed row (bytes of an interrupted append are cut off)"""
+        with open(path, "ab") as file:
+            file.truncate(expected_size)
+            file.seek(expected_size)
+            file.write(data)
+
+    def _widen(self, state, words):
+        """Rewriting the matrix with more words per board (vocabulary of the set outgrew the bitset)"""
+        path = os.path.join(state["path"], "boards.u64")
+        widened = np.zeros((state["count"], words), dtype=np.uint64)
+        if state["count"]:
+            widened[:, :state["words"]] = np.memmap(path, dtype=np.uint64, mode="r",
+                                                    shape=(state["count"], state["words"]))
+        widened.tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        state["words"] = words
+        self._write_meta(state)
+
+    def _write_meta(self, state):
+        self._write_json(os.path.join(state["path"], "meta.json"),
+                         {"count": state["count"], "words": state["words"], "matches_size": state["matches_size"]})
+
+    def matrix(self, set_number):
+        """(boards, placements, bits) of the set - read-only memory maps"""
+        state = self._open(set_number)
+        count, words, path = state["count"], state["words"], state["path"]
+        if count == 0:
+            return (np.zeros((0, words), dtype=np.uint64), np.zeros(0, dtype=np.uint8),
+                    np.zeros(0, dtype=np.uint16))
+        return (np.memmap(os.path.join(path, "boards.u64"), dtype=np.uint64, mode="r", shape=(count, words)),
+                np.memmap(os.path.join(path, "placements.u8"), dtype=np.uint8, mode="r", shape=(count,)),
+                np.memmap(os.path.join(path, "bits.u16"), dtype=np.uint16, mode="r", shape=(count,)))
+
+    # adding boards
+    def add_boards(self, set_number, boards):
+        """boards - list of (match_id, puuid, placement, features), boards of already indexed matches are skipped"""
+        with self.lock:
+            state = self._open(set_number)
+            boards = [board for board in boards if board[0] not in state["matches"]]
+            if not boards:
+                return 0
+
+            features = state["features"]
+            for _, _, _, board_features in boards:
+                for feature in board_features:
+                    if feature not in features:
+                        features[feature] = len(features)
+            words = state["words"]
+            while len(features) > words * 64:
+                words *= 2
+            if words != state["words"]:
+                self._widen(state, words)
+            self._write_json(os.path.join(state["path"], "features.json"), features)
+
+            rows = np.zeros((len(boards), words), dtype=np.uint64)
+            keys = bytearray()
+            for row, (match_id, puuid, placement, board_features) in enumerate(boards):
+                for bit in {features[feature] for feature in board_features}:
+                    rows[row, bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+                keys += f"{match_id}\t{puuid}".encode("utf-8").ljust(self.KEY_SIZE, b" ")[:self.KEY_SIZE]
+            placements = np.array([placement or 0 for _, _, placement, _ in boards], dtype=np.uint8)
+            bits = np.bitwise_count(rows).sum(axis=1, dtype=np.uint16)
+
+            count, path = state["count"], state["path"]
+            self._append(os.path.join(path, "boards.u64"), rows.tobytes(), count * words * 8)
+            self._append(os.path.join(path, "placements.u8"), placements.tobytes(), count)
+            self._append(os.path.join(path, "bits.u16"), bits.tobytes(), count * 2)
+            self._append(os.path.join(path, "keys.bin"), bytes(keys), count * self.KEY_SIZE)
+
+            new_matches = {board[0] for board in boards}
+            matches = "".join(f"{match_id}\n" for match_id in new_matches).encode("utf-8")
+            self._append(os.path.join(path, "matches.txt"), matches, state["matches_size"])
+
+            # boards and matches are committed together
+            state["count"] = count + len(boards)
+            state["matches_size"] += len(matches)
+            self._write_meta(state)
+            state["matches"].update(new_matches)
+            return len(boards)
+
+    @staticmethod
+    def board_features(traits=(), units=(), items=()):
+        """
+        Features of one board - traits: (trait_name, tier_current), units: (character_id, star level),
+        items: item ids. Inactive traits (tier_current 0) are not features.
+        """
+        features = [f"T:{name}:{tier}" for name, tier in traits if tier]
+        features += [f"U:{character_id}:{star}" for character_id, star in units]
+        features += [f"I:{item_id}" for item_id in items]
+        return features
+
+    def add_rows(self, tables):
+        """
+        Boards of one batch of row tuples (DataPipeline.build_match_rows / BatchSink, order of
+        DatabaseConnection.BULK_COLUMNS). Returns the number of added boards.
+        """
+        match_sets = {match[0]: match[4] for match in tables.get("matches", [])}
+        placements = {(player[1], player[0]): player[2] for player in tables.get("players", [])}
+        traits, units, items = {}, {}, {}
+        for match_id, puuid, trait_name, _, _, tier_current, _ in tables.get("traits", []):
+            traits.setdefault((match_id, puuid), []).append((trait_name, tier_current))
+        for match_id, puuid, character_id, _, star in tables.get("units", []):
+            units.setdefault((match_id, puuid), []).append((character_id, star))
+        for match_id, puuid, _, item_id in tables.get("items", []):
+            items.setdefault((match_id, puuid), []).append(item_id)
+
+        boards_per_set = {}
+        for (match_id, puuid), placement in placements.items():
+            set_number = match_sets.get(match_id)
+            if set_number is None:
+                continue
+            features = self.board_features(traits.get((match_id, puuid), ()), units.get((match_id, puuid), ()),
+                                           items.get((match_id, puuid), ()))
+            boards_per_set.setdefault(set_number, []).append((match_id, puuid, placement, features))
+
+        return sum(self.add_boards(set_number, boards) for set_number, boards in boards_per_set.items())
+
+    def build_from_db(self, db, set_number, chunk_matches=2000):
+        """Indexing stored matches of one set (e.g. the first time), chunk_matches matches per round of queries"""
+        match_ids = [row[0] for row in db.query("SELECT match_id FROM matches WHERE tft_set_number = %s",
+                                                (set_number,))]
+        added = 0
+        for start in range(0, len(match_ids), chunk_matches):
+            chunk = match_ids[start:start + chunk_matches]
+            tables = {table: db.query(f"SELECT {', '.join(columns)} FROM {table} WHERE match_id = ANY(%s)",
+                                      (chunk,))
+                      for table, columns in db.BULK_COLUMNS.items()}
+            added += self.add_rows(tables)
+        logger.info(f"Indexed {added} boards of set {set_number}")
+        return added
+
+    # queries
+    def encode(self, set_number, features):
+        """Bitset of a board given as features (features unknown in the set are ignored - no board has them)"""
+        state = self._open(set_number)
+        board = np.zeros(state["words"], dtype=np.uint64)
+        for feature in features:
+            bit = state["features"].get(feature)
+            if bit is not None:
+                board[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+        return board
+
+    def keys(self, set_number, rows):
+        """(match_id, puuid) of the given rows of the matrix"""
+        keys = []
+        with open(os.path.join(self._open(set_number)["path"], "keys.bin"), "rb") as file:
+            for row in rows:
+                file.seek(int(row) * self.KEY_SIZE)
+                match_id, puuid = file.read(self.KEY_SIZE).decode("utf-8").rstrip().split("\t")
+                keys.append((match_id, puuid))
+        return keys
+
+    def top_k(self, set_number, features, k=50, chunk_rows=500000):
+        """
+        k boards most similar to the board given as features (see board_features).
+        Returns DataFrame match_id, puuid, similarity, placement sorted by similarity.
+        """
+        boards, placements, bits = self.matrix(set_number)
+        query = self.encode(set_number, features)
+        query_bits = int(np.bitwise_count(query).sum())
+
+        similarity = np.empty(len(boards), dtype=np.float32)
+        for start in range(0, len(boards), chunk_rows):
+            shared = np.bitwise_count(boards[start:start + chunk_rows] & query).sum(axis=1, dtype=np.uint16)
+            union = bits[start:start + chunk_rows].astype(np.float32) + query_bits - shared
+            similarity[start:start + chunk_rows] = shared / np.maximum(union, 1)
+
+        k = min(k, len(similarity))
+        if k == 0:
+            return pd.DataFrame(columns=["match_id", "puuid", "similarity", "placement"])
+        best = np.argpartition(-similarity, k - 1)[:k]
+        best = best[np.argsort(-similarity[best], kind="stable")]
+
+        keys = self.keys(set_number, best)
+        return pd.DataFrame({
+            "match_id": [match_id for match_id, _ in keys],
+            "puuid": [puuid for _, puuid in keys],
+            "similarity": similarity[best],
+            "placement": placements[best].astype(np.int8),
+        })
+
+    def similar_placement(self, set_number, features, k=50):
+        """How the k most similar boards placed - boards, mean similarity, avg_placement, top4_rate, win_rate"""
+        neighbours = self.top_k(set_number, features, k)
+        if neighbours.empty:
+            return {"boards": 0, "mean_similarity": None, "avg_placement": None, "top4_rate": None, "win_rate": None}
+        return {
+            "boards": len(neighbours),
+            "mean_similarity": round(float(neighbours["similarity"].mean()), 3),
+            "avg_placement": round(float(neighbours["placement"].mean()), 3),
+            "top4_rate": round(float((neighbours["placement"] <= 4).mean()), 4),
+            "win_rate": round(float((neighbours["placement"] == 1).mean()), 4),
+        }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from Data.DatabaseConnection import DatabaseConnection
+
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
+    default_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "indexes", "boards")
+    # python -m Data.BoardIndex 14 - indexing all stored boards of set 14
+    index = BoardIndex(os.getenv('BOARD_INDEX_PATH', default_root))
+    index.build_from_db(DatabaseConnection(dotenv_path), int(sys.argv[1]))
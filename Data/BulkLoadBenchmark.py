@@ -0,0 +1,69 @@
+"""
+Benchmark of the bulk load strategies of DatabaseConnection: executemany vs execute_values vs COPY.
+Rows have the shape of the units table and are loaded into a scratch table (bench_units, dropped at the end),
+so the real tables are never touched. Meant to be run against a local PostgreSQL:
+
+    BENCHMARK_DOTENV=/path/to/.env.local python -m Data.BulkLoadBenchmark 50000
+"""
+import os
+import random
+import sys
+import time
+
+from Data.DatabaseConnection import DatabaseConnection
+
+UNIT_COLUMNS = DatabaseConnection.BULK_COLUMNS["units"]
+
+
+def generate_units(rows_count):
+    champions = [f"TFT14_Champion{i}" for i in range(60)]
+    rows = []
+    for i in range(rows_count):
+        match_id = f"EUN1_{1000000 + i // 72}"
+        puuid = f"puuid-{(i // 9) % 8}-{i // 72}"
+        rows.append((match_id, puuid, f"{random.choice(champions)}_{i % 9}", random.randint(0, 6), random.randint(1, 3)))
+    return rows
+
+
+def recreate_table(db):
+    db.execute_query("DROP TABLE IF EXISTS bench_units")
+    db.execute_query("CREATE TABLE bench_units (LIKE units INCLUDING ALL)")
+
+
+def bench_executemany(db, rows):
+    sql = "INSERT INTO bench_units ({}) VALUES ({}) ON CONFLICT DO NOTHING".format(", ".join(UNIT_COLUMNS),
+                                                                                  ", ".join(["%s"] * len(UNIT_COLUMNS)))
+    db.execute_bulk(sql, rows)
+
+
+def bench_execute_values(db, rows):
+    sql = "INSERT INTO bench_units ({}) VALUES %s ON CONFLICT DO NOTHING".format(", ".join(UNIT_COLUMNS))
+    db.execute_values_bulk(sql, rows)
+
+
+def bench_copy(db, rows):
+    with db.transaction() as cursor:
+        db.copy_table(cursor, "bench_units", rows, UNIT_COLUMNS)
+
+
+def run(db, rows_count):
+    rows = generate_units(rows_count)
+    results = {}
+    for name, bench in (("executemany", bench_executemany),
+                        ("execute_values", bench_execute_values),
+                        ("copy", bench_copy)):
+        recreate_table(db)
+        start = time.perf_counter()
+        bench(db, rows)
+        elapsed = time.perf_counter() - start
+        results[name] = rows_count / elapsed
+        print(f"{name:>15}: {rows_count} rows in {elapsed:.2f}s -> {results[name]:,.0f} rows/sec")
+
+    db.execute_query("DROP TABLE IF EXISTS bench_units")
+    return results
+
+
+if __name__ == "__main__":
+    default_dotenv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
+    database = DatabaseConnection(os.getenv('BENCHMARK_DOTENV', default_dotenv))
+    run(database, int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+
+class Cooccurrence:
+    """
+    Synergy matrices of every set - how often two things are played together and how such boards place:
+    - trait_trait - active traits of the same board,
+    - unit_unit - units of the same board,
+    - unit_item - item held by the unit.
+    Every kind has three sparse matrices (scipy.sparse): count of boards, sum of their placements and count of top 4
+    boards, so e.g. average placement of a pair is placement_sum / count. Diagonal of trait_trait / unit_unit is the
+    number of boards with the trait / unit itself.
+
+    Matrices are built from integer-encoded boards of every ingest batch (incidence matrix boards x features,
+    X.T @ diag(weights) @ X) and added to the stored ones, so they are always up to date and the notebooks
+    (e.g. trait graphs) only load a finished matrix instead of merging the raw tables.
+
+    Layout of <root>/set_<N>/:
+    - matrices.npz - all matrices of the set (coordinates and values), the vocabulary and size of matches.txt,
+    - vocabulary.json - readable copy of the vocabulary - trait / unit / item names (position = row / column)
+      and number of boards,
+    - matches.txt - matches already counted (a match is never added twice).
+    matches.txt is appended first and matrices.npz is replaced last - the batch is counted only then, matches
+    after the size from matrices.npz (an interrupted save) are ignored when reading and cut off before the next save.
+    """
+
+    # kind -> (vocabulary of the rows, vocabulary of the columns)
+    KINDS = {"trait_trait": ("traits", "traits"), "unit_unit": ("units", "units"), "unit_item": ("units", "items")}
+    STATS = ("count", "placement_sum", "top4")
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # set number -> state of the set (path, vocabulary, name -> id, matrices, boards, counted matches)
+        self.sets = {}
+
+    # storage
+    def _open(self, set_number):
+        state = self.sets.get(set_number)
+        if state is not None:
+            return state
+
+        path = os.path.join(self.root, f"set_{set_number}")
+        os.makedirs(path, exist_ok=True)
+        vocabulary = {"traits": [], "units": [], "items": [], "boards": 0}
+        stored = {}
+        if os.path.exists(os.path.join(path, "matrices.npz")):
+            with np.load(os.path.join(path, "matrices.npz")) as file:
+                stored = {key: file[key] for key in file.files}
+        if "vocabulary" in stored:
+            vocabulary = json.loads(str(stored["vocabulary"]))
+        elif os.path.exists(os.path.join(path, "vocabulary.json")):
+            # sets saved before the vocabulary was kept in matrices.npz
+            with open(os.path.join(path, "vocabulary.json"), encoding="utf-8") as file:
+                vocabulary = json.load(file)
+        matrices = {}
+        for kind, (rows, columns) in self.KINDS.items():
+            shape = (len(vocabulary[rows]), len(vocabulary[columns]))
+            for stat in self.STATS:
+                if f"{kind}:{stat}:data" in stored:
+                    matrices[kind, stat] = sparse.csr_matrix(
+                        (stored[f"{kind}:{stat}:data"], (stored[f"{kind}:{stat}:row"], stored[f"{kind}:{stat}:col"])),
+                        shape=shape)
+                else:
+                    matrices[kind, stat] = sparse.csr_matrix(shape, dtype=np.int64)
+
+        matches = set()
+        # sets saved before the size was kept in matrices.npz take the whole file
+        matches_size = int(stored["matches_size"]) if "matches_size" in stored else None
+        if os.path.exists(os.path.join(path, "matches.txt")):
+            with open(os.path.join(path, "matches.txt"), "rb") as file:
+                data = file.read() if matches_size is None else file.read(matches_size)
+            matches = {line.strip() for line in data.decode("utf-8").splitlines() if line.strip()}
+            if matches_size is None:
+                matches_size = len(data)
+
+        state = {
+            "path": path,
+            "vocabulary": vocabulary,
+            "matches_size": matches_size or 0,
+            "ids": {name: {value: i for i, value in enumerate(vocabulary[name])}
+                    for name in ("traits", "units", "items")},
+            "matrices": matrices,
+            "matches": matches,
+        }
+        self.sets[set_number] = state
+        return state
+
+    def _save(self, state, new_matches):
+        # matches after the last committed size (interrupted save) are cut off
+        path = state["path"]
+        matches = "".join(f"{match_id}\n" for match_id in new_matches).encode("utf-8")
+        with open(os.path.join(path, "matches.txt"), "ab") as file:
+            file.truncate(state["matches_size"])
+            file.seek(state["matches_size"])
+            file.write(matches)
+
+        arrays = {"vocabulary": np.array(json.dumps(state["vocabulary"])),
+                  "matches_size": np.array(state["matches_size"] + len(matches), dtype=np.int64)}
+        for (kind, stat), matrix in state["matrices"].items():
+            coo = matrix.tocoo()
+            arrays[f"{kind}:{stat}:row"], arrays[f"{kind}:{stat}:col"] = coo.row, coo.col
+            arrays[f"{kind}:{stat}:data"] = coo.data
+
+        # written next to the targets and renamed, so a reader never sees half of a file - matrices, vocabulary and
+        # the new matches are committed together
+        with open(os.path.join(path, "matrices.tmp.npz"), "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(os.path.join(path, "matrices.tmp.npz"), os.path.join(path, "matrices.npz"))
+        state["matches_size"] += len(matches)
+        with open(os.path.join(path, "vocabulary.json.tmp"), "w", encoding="utf-8") as file:
+            json.dump(state["vocabulary"], file)
+        os.replace(os.path.join(path, "vocabulary.json.tmp"), os.path.join(path, "vocabulary.json"))
+
+    @staticmethod
+    def _encode(state, name, values):
+        """Integer ids of the values (new values are appended to the vocabulary)"""
+        ids, vocabulary = state["ids"][name], state["vocabulary"][name]
+        for value in values:
+            if value not in ids:
+                ids[value] = len(vocabulary)
+                vocabulary.append(value)
+        return np.fromiter((ids[value] for value in values), dtype=np.int64, count=len(values))
+
+    # adding boards
+    def add_rows(self, tables):
+        """
+        Counting boards of one batch of row tuples (DataPipeline.build_match_rows / BatchSink, order of
+        DatabaseConnection.BULK_COLUMNS). Returns the number of counted boards.
+        """
+        match_sets = {match[0]: match[4] for match in tables.get("matches", [])}
+        per_set = {}
+        for table in ("players", "traits", "units", "items"):
+            for row in tables.get(table, []):
+                # match_id is the second column of players, the first one of the other tables
+                set_number = match_sets.get(row[1] if table == "players" else row[0])
+                if set_number is not None:
+                    per_set.setdefault(set_number, {}).setdefault(table, []).append(row)
+
+        return sum(self.add_set_rows(set_number, set_tables) for set_number, set_tables in per_set.items())
+
+    def add_set_rows(self, set_number, tables):
+        with self.lock:
+            state = self._open(set_number)
+            players = [player for player in tables.get("players", []) if player[1] not in state["matches"]]
+            if not players:
+                return 0
+            new_matches = {player[1] for player in players}
+
+            # boards are numbered within the batch, weights are per board
+            boards = {(player[1], player[0]): number for number, player in enumerate(players)}
+            placements = np.array([player[2] or 0 for player in players], dtype=np.int64)
+            weights = {"count": np.ones(len(players), dtype=np.int64), "placement_sum": placements,
+                       "top4": ((placements >= 1) & (placements <= 4)).astype(np.int64)}
+
+            traits = [(boards[trait[0], trait[1]], trait[2]) for trait in tables.get("traits", [])
+                      if (trait[0], trait[1]) in boards and trait[5]]
+            units = [(boards[unit[0], unit[1]], unit[2]) for unit in tables.get("units", [])
+                     if (unit[0], unit[1]) in boards]
+            items = [(boards[item[0], item[1]], item[2], item[3]) for item in tables.get("items", [])
+                     if (item[0], item[1]) in boards]
+
+            trait_boards = np.array([board for board, _ in traits], dtype=np.int64)
+            trait_ids = self._encode(state, "traits", [name for _, name in traits])
+            unit_boards = np.array([board for board, _ in units], dtype=np.int64)
+            unit_ids = self._encode(state, "units", [name for _, name in units])
+            item_boards = np.array([board for board, _, _ in items], dtype=np.int64)
+            item_units = self._encode(state, "units", [unit for _, unit, _ in items])
+            item_ids = self._encode(state, "items", [item for _, _, item in items])
+
+            vocabulary = state["vocabulary"]
+            sizes = {name: len(vocabulary[name]) for name in ("traits", "units", "items")}
+            incidence = {
+                "trait_trait": self.incidence(trait_boards, trait_ids, (len(players), sizes["traits"])),
+                "unit_unit": self.incidence(unit_boards, unit_ids, (len(players), sizes["units"])),
+            }
+
+            for kind, (rows, columns) in self.KINDS.items():
+                shape = (sizes[rows], sizes[columns])
+                for stat in self.STATS:
+                    if kind == "unit_item":
+                        batch = sparse.csr_matrix((weights[stat][item_boards], (item_units, item_ids)), shape=shape)
+                    else:
+                        boards_x_features = incidence[kind]
+                        weighted = sparse.diags(weights[stat], dtype=np.int64)
+                        batch = (boards_x_features.T @ weighted @ boards_x_features).tocsr()
+                    state["matrices"][kind, stat] = self.grow(state["matrices"][kind, stat], shape) + batch
+
+            vocabulary["boards"] += len(players)
+            try:
+                self._save(state, new_matches)
+            except Exception:
+                # the set is read again from the last committed files
+                del self.sets[set_number]
+                raise
+            state["matches"].update(new_matches)
+            return len(players)
+
+    @staticmethod
+    def incidence(boards, features, shape):
+        """Boards x features matrix with 1 where the board has the feature (repeated features count once)"""
+        matrix = sparse.csr_matrix((np.ones(len(boards), dtype=np.int64), (boards, features)), shape=shape)
+        matrix.data[:] = 1
+        return matrix
+
+    @staticmethod
+    def grow(matrix, shape):
+        """The same matrix with more rows / columns (new vocabulary values)"""
+        if matrix.shape == shape:
+            return matrix
+        coo = matrix.tocoo()
+        return sparse.csr_matrix((coo.data, (coo.row, coo.col)), shape=shape)
+
+    def build_from_db(self, db, set_number, chunk_matches=2000):
+        """Counting stored matches of one set (e.g. the first time), chunk_matches matches per round of queries"""
+        match_ids = [row[0] for row in db.query("SELECT match_id FROM matches WHERE tft_set_number = %s",
+                                                (set_number,))]
+        added = 0
+        for start in range(0, len(match_ids), chunk_matches):
+            chunk = match_ids[start:start + chunk_matches]
+            tables = {table: db.query(f"SELECT {', '.join(columns)} FROM {table} WHERE match_id = ANY(%s)",
+                                      (chunk,))
+                      for table, columns in db.BULK_COLUMNS.items()}
+            added += self.add_rows(tables)
+        logger.info(f"Counted {added} boards of set {set_number}")
+        return added
+
+    # reading
+    def matrix(self, set_number, kind, stat="count"):
+        return self._open(set_number)["matrices"][kind, stat]
+
+    def vocabulary(self, set_number, name):
+        return list(self._open(set_number)["vocabulary"][name])
+
+    def pairs(self, set_number, kind, min_count=30):
+        """
+        Pairs played together at least min_count times - DataFrame a, b, count, avg_placement, top4_rate and
+        (trait_trait, unit_unit) lift - how much more often the pair is played than if the two were independent.
+        Ready for a graph (e.g. networkx.from_pandas_edgelist(pairs, "a", "b", edge_attr=True)).
+        """
+        state = self._open(set_number)
+        rows_name, columns_name = self.KINDS[kind]
+        counts = state["matrices"][kind, "count"].tocoo()
+        keep = counts.data >= min_count
+        if kind != "unit_item":
+            # symmetric - every pair once, without the diagonal
+            keep &= counts.row < counts.col
+        rows, columns, count = counts.row[keep], counts.col[keep], counts.data[keep]
+
+        placement_sum = np.asarray(state["matrices"][kind, "placement_sum"][rows, columns]).ravel()
+        top4 = np.asarray(state["matrices"][kind, "top4"][rows, columns]).ravel()
+        pairs = pd.DataFrame({
+            "a": np.array(state["vocabulary"][rows_name], dtype=object)[rows],
+            "b": np.array(state["vocabulary"][columns_name], dtype=object)[columns],
+            "count": count,
+            "avg_placement": np.round(placement_sum / count, 3),
+            "top4_rate": np.round(top4 / count, 4),
+        })
+        if kind != "unit_item":
+            singles = state["matrices"][kind, "count"].diagonal()
+            pairs["lift"] = np.round(count * state["vocabulary"]["boards"] / (singles[rows] * singles[columns]), 3)
+        return pairs.sort_values("count", ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import sys
+
+    from Data.DatabaseConnection import DatabaseConnection
+
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
+    default_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "indexes", "cooccurrence")
+    # python -m Data.Cooccurrence 14 - counting all stored boards of set 14
+    cooccurrence = Cooccurrence(os.getenv('COOCCURRENCE_PATH', default_root))
+    cooccurrence.build_from_db(DatabaseConnection(dotenv_path), int(sys.argv[1]))
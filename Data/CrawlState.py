@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class CrawlState:
+    """
+    Durable state of a crawl (local SQLite file), so DataUploader can resume exactly where it stopped.
+
+    Every unit of work is stored as an item of the current run:
+    - 'division' - players of one division from the rank snapshot (key TIER/DIVISION, walks the league pages if needed),
+    - 'puuid' - list of match ids of one player,
+    - 'match' - details of one match (done only after its rows are written to the database).
+    Item status goes pending -> in_flight -> done. Failed items go back to pending with exponential backoff
+    and after max_attempts they stay 'failed' (retry list - see failed_items / retry_failed).
+    Items left in_flight by a crashed process are pending again after start_run.
+    """
+
+    PENDING = 'pending'
+    IN_FLIGHT = 'in_flight'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, max_attempts=5, base_backoff=30, clock=time.time):
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.run_id = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS work_items (
+                run_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                tier TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (run_id, kind, key)
+            );
+            CREATE INDEX IF NOT EXISTS work_items_status ON work_items (run_id, kind, tier, status, next_attempt_at);""")
+        self.conn.commit()
+
+    def start_run(self, new_run=False):
+        """Resuming the last unfinished run (or starting a new one). Returns run id."""
+        with self.lock:
+            row = None
+            if not new_run:
+                row = self.conn.execute("SELECT run_id FROM runs WHERE finished_at IS NULL "
+                                        "ORDER BY run_id DESC LIMIT 1").fetchone()
+            if row:
+                self.run_id = row[0]
+                # items which were being processed when the previous process died
+                self.conn.execute("UPDATE work_items SET status = ? WHERE run_id = ? AND status = ?",
+                                  (self.PENDING, self.run_id, self.IN_FLIGHT))
+            else:
+                self.run_id = self.conn.execute("INSERT INTO runs (started_at) VALUES (?)",
+                                                (self.clock(),)).lastrowid
+            self.conn.commit()
+        return self.run_id
+
+    def finish_run(self):
+        with self.lock:
+            self.conn.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (self.clock(), self.run_id))
+            self.conn.commit()
+
+    def enqueue(self, kind, keys, tier=None):
+        """Adding new items - items already known in this run (in any status) are ignored."""
+        now = self.clock()
+        with self.lock:
+            self.conn.executemany("""
+                INSERT OR IGNORE INTO work_items (run_id, kind, key, tier, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)""", [(self.run_id, kind, key, tier, self.PENDING, now) for key in keys])
+            self.conn.commit()
+
+    def has_items(self, kind, tier=None):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM work_items WHERE run_id = ? AND kind = ? AND tier IS ? LIMIT 1",
+                                     (self.run_id, kind, tier)).fetchone() is not None
+
+    def claim(self, kind, tier=None, limit=100):
+        """Marks up to limit pending items, which are ready to (re)try, as in_flight and returns their keys."""
+        now = self.clock()
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute("""
+                SELECT key FROM work_items
+                WHERE run_id = ? AND kind = ? AND tier IS ? AND status = ? AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?""", (self.run_id, kind, tier, self.PENDING, now, limit))]
+            self.conn.executemany("UPDATE work_items SET status = ?, updated_at = ? "
+                                  "WHERE run_id = ? AND kind = ? AND key = ?",
+                                  [(self.IN_FLIGHT, now, self.run_id, kind, key) for key in keys])
+            self.conn.commit()
+        return keys
+
+    def mark_done(self, kind, keys):
+        now = self.clock()
+        with self.lock:
+            self.conn.executemany("UPDATE work_items SET status = ?, last_error = NULL, updated_at = ? "
+                                  "WHERE run_id = ? AND kind = ? AND key = ?",
+                                  [(self.DONE, now, self.run_id, kind, key) for key in keys])
+            self.conn.commit()
+
+    def mark_failed(self, kind, key, error):
+        """Scheduling a retry with exponential backoff, or moving the item to the retry list after max_attempts."""
+        now = self.clock()
+        with self.lock:
+            row = self.conn.execute("SELECT attempts FROM work_items WHERE run_id = ? AND kind = ? AND key = ?",
+                                    (self.run_id, kind, key)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            status = self.FAILED if attempts >= self.max_attempts else self.PENDING
+            next_attempt_at = now + self.base_backoff * 2 ** (attempts - 1)
+            self.conn.execute("""
+                UPDATE work_items SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                WHERE run_id = ? AND kind = ? AND key = ?""",
+                              (status, attempts, next_attempt_at, str(error), now, self.run_id, kind, key))
+            self.conn.commit()
+        return status
+
+    def next_retry_in(self, kind, tier=None):
+        """Seconds until the next pending item can be retried, None if there is nothing pending."""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT MIN(next_attempt_at) FROM work_items
+                WHERE run_id = ? AND kind = ? AND tier IS ? AND status = ?""",
+                                    (self.run_id, kind, tier, self.PENDING)).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - self.clock())
+
+    def failed_items(self, kind=None):
+        """Retry list - items which failed max_attempts times: (kind, key, tier, attempts, last_error)"""
+        with self.lock:
+            return self.conn.execute("""
+                SELECT kind, key, tier, attempts, last_error FROM work_items
+                WHERE run_id = ? AND status = ? AND (? IS NULL OR kind = ?)""",
+                                     (self.run_id, self.FAILED, kind, kind)).fetchall()
+
+    def retry_failed(self, kind=None):
+        """Moving items from the retry list back to pending."""
+        with self.lock:
+            retried = self.conn.execute("""
+                UPDATE work_items SET status = ?, attempts = 0, next_attempt_at = 0
+                WHERE run_id = ? AND status = ? AND (? IS NULL OR kind = ?)""",
+                                        (self.PENDING, self.run_id, self.FAILED, kind, kind)).rowcount
+            self.conn.commit()
+        return retried
+
+    def summary(self):
+        """Number of items of the current run in every status: {kind: {status: count}}"""
+        summary = {}
+        with self.lock:
+            for kind, status, count in self.conn.execute("""
+                    SELECT kind, status, COUNT(*) FROM work_items WHERE run_id = ? GROUP BY kind, status""",
+                                                         (self.run_id,)):
+                summary.setdefault(kind, {})[status] = count
+        return summary
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
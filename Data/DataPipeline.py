@@ -1,17 +1,33 @@
+import asyncio
+import logging
 import time
+from urllib.parse import urlsplit
 
 import requests
 from dotenv import load_dotenv
 import os
 
+from Data.AsyncFetcher import AsyncFetcher
+from Data.LeagueCache import LeagueCache
+from Data.MatchArchive import MatchArchive
+from Data.MatchFlattener import MatchFlattener
+from Data.MatchWatermarks import MatchWatermarks
+from Data.Metrics import PipelineMetrics
+from Data.RankSnapshot import RankSnapshot
+from Data.RateLimiter import RateLimiter
+from Data.WorkScheduler import WorkItem, WorkScheduler
+
+logger = logging.getLogger(__name__)
+
 
 class DataPipeline:
     def __init__(self, dotenv_path):
         load_dotenv(dotenv_path)
         self.api_key = os.getenv('RIOT_GAMES_KEY')
 
-        self.eune_base_url = "https://eun1.api.riotgames.com"
-        self.europe_base_url = "https://europe.api.riotgames.com"
+        # base urls can be overridden, e.g. to point the pipeline at a local stub server
+        self.eune_base_url = os.getenv('RIOT_EUNE_BASE_URL', "https://eun1.api.riotgames.com")
+        self.europe_base_url = os.getenv('RIOT_EUROPE_BASE_URL', "https://europe.api.riotgames.com")
         self.game_type = ["tft"]
         self.queue_tft = "RANKED_TFT"
 
@@ -19,49 +35,118 @@ class DataPipeline:
         self.tiers = ["IRON", "BRONZE", "SILVER", "GOLD", "PLATINUM", "EMERALD", "DIAMOND"]
         self.divisions = ['I', 'II', 'III', 'IV']
 
-        #we have only 100 request per minute and 20 per sec.
-        self.api_requests_made = 0
-        self.start_time = time.time()
-        self.requests_per_sec = 0
-        self.last_request_time = time.time()
-
-    def make_request(self, url):
-        response = requests.get(url)
-        if response.status_code != 200:
-            raise Exception(f"{url} returned {response.status_code} : {response.text}")
-
-        return response.json()
+        #we have only 100 request per 2 minutes and 20 per sec (development key) - the real limits are read from
+        #the response headers, see RateLimiter
+        self.rate_limiter = RateLimiter()
+        self.max_retries = 3
+        # 5xx responses are retried after RETRY_BACKOFF, 2 * RETRY_BACKOFF, 4 * RETRY_BACKOFF ... seconds
+        self.retry_backoff = float(os.getenv('RETRY_BACKOFF', 1))
+        self.session = requests.Session()
+        # requests, latency, 429s, rate limiter waits and parsed matches of the whole run
+        self.metrics = PipelineMetrics()
+
+        # league lookups of players are cached (memory + sqlite file) - repeated players cost no api calls
+        default_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache", "league_cache.sqlite")
+        self.league_cache_path = os.getenv('LEAGUE_CACHE_PATH', default_cache_path)
+        self.league_cache = LeagueCache(self.league_cache_path,
+                                        ttl_seconds=int(os.getenv('LEAGUE_CACHE_TTL', 24 * 60 * 60)))
+
+        # ranks of all players of the crawled divisions (all league pages), refreshed every RANK_SNAPSHOT_TTL seconds,
+        # LEAGUE_MAX_PAGES limits the walk over the pages of one division (all pages by default)
+        default_snapshot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache",
+                                             "rank_snapshot.sqlite")
+        self.rank_snapshot_path = os.getenv('RANK_SNAPSHOT_PATH', default_snapshot_path)
+        self.rank_snapshot = RankSnapshot(self.rank_snapshot_path,
+                                          ttl_seconds=int(os.getenv('RANK_SNAPSHOT_TTL', 24 * 60 * 60)))
+        self.max_league_pages = int(os.getenv('LEAGUE_MAX_PAGES')) if os.getenv('LEAGUE_MAX_PAGES') else None
+
+        # newest listed match of every player - with incremental_crawl only matches played since then are listed
+        # (startTime + paging up to the watermark, at most MATCH_LIST_MAX_PAGES pages per player)
+        default_watermarks_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache",
+                                               "match_watermarks.sqlite")
+        self.watermarks = MatchWatermarks(os.getenv('MATCH_WATERMARKS_PATH', default_watermarks_path))
+        self.incremental_crawl = False
+        self.max_listing_pages = int(os.getenv('MATCH_LIST_MAX_PAGES', 10))
+
+        # raw match payloads never change once the game is over, so every downloaded match is archived locally
+        default_archive_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "archive", "matches")
+        self.match_archive = MatchArchive(os.getenv('MATCH_ARCHIVE_PATH', default_archive_path))
 
     """
-    This Function will be used to count requests done and if we've done more then 20 in sec, or 95 i minute, 
-    then sleep for 1 min and then continue to work normally.
+    This Function sends the request as soon as both the application and the method limits of the host allow it.
+    Limits and counters are kept in sync with X-App-Rate-Limit / X-Method-Rate-Limit headers, and if we still get 429
+    we wait as long as Retry-After says and try again. 5xx responses are retried with exponential backoff.
     """
 
-    def rate_limited_requests(self, url):
-        # max 20 per sec
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < 0.05:
-            time.sleep(0.05 - time_since_last_request)
+    def rate_limited_requests(self, url, method=None, raw=False):
+        host = urlsplit(url).netloc
+        method = method or RateLimiter.method_from_url(url)
+
+        for attempt in range(self.max_retries + 1):
+            self.metrics.observe_throttle(method, self.rate_limiter.acquire(host, method))
+            started = time.perf_counter()
+            response = self.session.get(url)
+            self.metrics.observe_request(method, response.status_code, time.perf_counter() - started,
+                                         len(response.content))
+            self.rate_limiter.update_from_headers(host, method, response.headers)
+
+            if response.status_code == 429:
+                retry_after = self.rate_limiter.on_rate_limited(host, method, response.headers)
+                logger.warning(f"Rate limited on {method} ({host}), retrying in {retry_after} seconds")
+                continue
+
+            if response.status_code >= 500 and attempt < self.max_retries:
+                backoff = self.retry_backoff * 2 ** attempt
+                logger.warning(f"{method} ({host}) returned {response.status_code}, retrying in {backoff} seconds")
+                time.sleep(backoff)
+                continue
 
-        # max 100 (95) every 2 minutes
-        self.api_requests_made += 1
-        if self.api_requests_made >= 95:
-            # elapsed_time = time.time() - self.start_time
-            # if elapsed_time < 120:
-            #     sleep_time = 120 - elapsed_time + 30  # +30s for safety,
-            #     print(f"Done 95 requests. Sleeping for {sleep_time} seconds")
-            #     time.sleep(sleep_time)
-            #
-            # # reset counters after sleeping
-            # self.api_requests_made = 0
-            # self.start_time = time.time()
-            print("Done 95 requests. Sleeping for 130 seconds.") #always sleep for 130s
-            time.sleep(130)
-            self.api_requests_made = 0
+            if response.status_code != 200:
+                raise Exception(f"{url} returned {response.status_code} : {response.text}")
 
-        self.last_request_time = time.time()
-        return self.make_request(url)
+            # raw - body as bytes, parsed by the caller (match details go straight to MatchFlattener.decode)
+            return response.content if raw else response.json()
+
+        raise Exception(f"{url} still rate limited after {self.max_retries} retries")
+
+    """
+    Urls of the endpoints we use - shared by the blocking and the async versions of the functions below.
+    """
+
+    def league_entries_url(self, tier, division, page):
+        # https://eun1.api.riotgames.com/tft/league/v1/entries/EMERALD/II?queue=RANKED_TFT&page=2&api_key=.....
+        return "{}/{}/league/v1/entries/{}/{}?queue={}&page={}&api_key={}".format(self.eune_base_url,
+                                                                                 self.game_type[0],
+                                                                                 tier,
+                                                                                 division,
+                                                                                 self.queue_tft,
+                                                                                 page,
+                                                                                 str(self.api_key))
+
+    def matches_ids_url(self, puuid, matches_per_player, start=0, start_time=None):
+        # https://europe.api.riotgames.com/tft/match/v1/matches/by-puuid/..../ids?start=0&count=20&startTime=...
+        url = "{}/{}/match/v1/matches/by-puuid/{}/ids?start={}&count={}&api_key={}".format(self.europe_base_url,
+                                                                                           self.game_type[0],
+                                                                                           puuid,
+                                                                                           start,
+                                                                                           matches_per_player,
+                                                                                           str(self.api_key))
+        # startTime - epoch seconds, only matches played since then are listed
+        return url if start_time is None else f"{url}&startTime={start_time}"
+
+    def league_by_puuid_url(self, puuid):
+        # https://eun1.api.riotgames.com/tft/league/v1/by-puuid/....
+        return "{}/{}/league/v1/by-puuid/{}?api_key={}".format(self.eune_base_url,
+                                                               self.game_type[0],
+                                                               puuid,
+                                                               self.api_key)
+
+    def match_details_url(self, match_id):
+        # https://europe.api.riotgames.com/tft/match/v1/matches/EUN1_3769226704?api_key=.....
+        return "{}/{}/match/v1/matches/{}?api_key={}".format(self.europe_base_url,
+                                                             self.game_type[0],
+                                                             match_id,
+                                                             str(self.api_key))
 
     """
     This function retrieves basic player data for each rank, including: puuid, tier, division, wins, and losses.
@@ -74,43 +159,83 @@ class DataPipeline:
     """
 
     def get_players_by_tier(self, tier, player_per_division):
-        # retrieving data from every division in each tier
-        # https://eun1.api.riotgames.com/tft/league/v1/entries/EMERALD/II?queue=RANKED_TFT&page=2&api_key=.....
+        # retrieving data from every division in each tier - from the rank snapshot, which is refreshed first if needed
         division_players_data = []
         for division in self.divisions:
-            #for page in range(1, 2):
-            url = "{}/{}/league/v1/entries/{}/{}?queue={}&page={}&api_key={}".format(self.eune_base_url,
-                                                                                     self.game_type[0],
-                                                                                     tier,
-                                                                                     division,
-                                                                                     self.queue_tft,
-                                                                                     2,
-                                                                                     str(self.api_key))
+            if not self.rank_snapshot.is_fresh(tier, division):
+                self.take_rank_snapshot(tier, division)
 
-            try:
-                #response = self.make_request(url)
-                response = self.rate_limited_requests(url)
-                for player in response[:player_per_division]:
-                    player_data = {
-                        'puuid': player.get('puuid'),
-                        'tier': player.get('tier'),
-                        'division': player.get('rank'),
-                        'wins': player.get('wins'),
-                        'losses': player.get('losses'),
-                    }
-                    division_players_data.append(player_data)
-
-                print("Collected data about players from {} {}", tier, division)
-
-                #If page is empty the next one will also be empty
-                if len(response) == 0:
-                    break
-
-            except Exception as e:
-                print(f"Error while downloading data ... : {e}")
+            division_players_data.extend(self.rank_snapshot.players(tier, division, player_per_division))
+            logger.info(f"Collected data about players from {tier} {division}")
 
         return division_players_data
 
+    async def get_players_by_tier_async(self, fetcher, tier, player_per_division):
+        async def get_division(division):
+            if not self.rank_snapshot.is_fresh(tier, division):
+                await self.take_rank_snapshot_async(fetcher, tier, division)
+            logger.info(f"Collected data about players from {tier} {division}")
+            return self.rank_snapshot.players(tier, division, player_per_division)
+
+        divisions = await asyncio.gather(*(get_division(division) for division in self.divisions))
+        return [player for division_players in divisions for player in division_players]
+
+    """
+    Walking all pages of league entries of one division into the rank snapshot (until the first empty page).
+    If a page can't be downloaded the walk isn't complete - players stored so far are used, the division 
+    is walked again next time.
+    """
+
+    def take_rank_snapshot(self, tier, division):
+        taken_at = time.time()
+        page = 1
+        while self.max_league_pages is None or page <= self.max_league_pages:
+            try:
+                response = self.rate_limited_requests(self.league_entries_url(tier, division, page))
+            except Exception as e:
+                logger.warning(f"Error while downloading data ... : {e}")
+                return
+
+            #If page is empty the next one will also be empty
+            if len(response) == 0:
+                break
+            self.rank_snapshot.store_page(tier, division, page, response, taken_at)
+            page += 1
+
+        players = self.rank_snapshot.complete(tier, division, taken_at, page - 1)
+        logger.info(f"Rank snapshot of {tier} {division}: {players} players on {page - 1} pages")
+
+    async def take_rank_snapshot_async(self, fetcher, tier, division):
+        taken_at = time.time()
+        page = 1
+        while self.max_league_pages is None or page <= self.max_league_pages:
+            try:
+                response = await fetcher.get(self.league_entries_url(tier, division, page))
+            except Exception as e:
+                logger.warning(f"Error while downloading data ... : {e}")
+                return
+
+            if len(response) == 0:
+                break
+            self.rank_snapshot.store_page(tier, division, page, response, taken_at)
+            page += 1
+
+        players = self.rank_snapshot.complete(tier, division, taken_at, page - 1)
+        logger.info(f"Rank snapshot of {tier} {division}: {players} players on {page - 1} pages")
+
+    @staticmethod
+    def parse_league_entries(entries):
+        return [
+            {
+                'puuid': player.get('puuid'),
+                'tier': player.get('tier'),
+                'division': player.get('rank'),
+                'wins': player.get('wins'),
+                'losses': player.get('losses'),
+            }
+            for player in entries
+        ]
+
     """
     Function to get unique match_ids 
     """
@@ -122,33 +247,90 @@ class DataPipeline:
             if not player.get('puuid'):
                 continue
 
-            # https://europe.api.riotgames.com/tft/match/v1/matches/by-puuid/....
-            url = "{}/{}/match/v1/matches/by-puuid/{}/ids?start=0&count={}&api_key={}".format(self.europe_base_url,
-                                                                                              self.game_type[0],
-                                                                                              player.get('puuid'),
-                                                                                              matches_per_player,
-                                                                                              str(self.api_key))
             try:
-                #response = self.make_request(url)
-                response = self.rate_limited_requests(url)
+                response = self.list_player_matches(player.get('puuid'), matches_per_player)
                 for match_id in response:
                     matches_ids.add(match_id)
 
-                print("Collected data about matches from {} {}", tier, player.get('puuid'))
+                logger.debug(f"Collected data about matches from {tier} {player.get('puuid')}")
 
             except Exception as e:
-                print(f"Error while downloading data ... : {e}")
+                logger.warning(f"Error while downloading data ... : {e}")
 
         return matches_ids
 
+    async def get_unique_matches_id_by_puuid_async(self, fetcher, players_data, tier, matches_per_player):
+        async def get_player_matches(puuid):
+            try:
+                response = await self.list_player_matches_async(fetcher, puuid, matches_per_player)
+                logger.debug(f"Collected data about matches from {tier} {puuid}")
+                return response
+            except Exception as e:
+                logger.warning(f"Error while downloading data ... : {e}")
+                return []
 
+        puuids = [player.get('puuid') for player in players_data if player.get('puuid')]
+        responses = await asyncio.gather(*(get_player_matches(puuid) for puuid in puuids))
+        return {match_id for response in responses for match_id in response}
 
+    """
+    Match ids of one player. The first listing (or every listing without incremental_crawl) is the newest
+    matches_per_player matches, later ones with incremental_crawl are only matches newer than the watermark of the
+    player (see MatchWatermarks) - pages of matches_per_player ids since startTime, until the watermark match shows up.
+    """
 
+    def list_player_matches(self, puuid, matches_per_player):
+        watermark = self.watermarks.get(puuid) if self.incremental_crawl else None
+        listed_at = time.time()
+        if watermark is None:
+            match_ids = self.rate_limited_requests(self.matches_ids_url(puuid, matches_per_player))
+            return self.record_listing(puuid, match_ids, None, 1, listed_at)
+
+        match_ids, pages = [], 0
+        while True:
+            page = self.rate_limited_requests(self.matches_ids_url(puuid, matches_per_player,
+                                                                   pages * matches_per_player, watermark[1]))
+            pages += 1
+            if self.add_listing_page(match_ids, page, watermark, matches_per_player, pages):
+                return self.record_listing(puuid, match_ids, watermark, pages, listed_at)
+
+    async def list_player_matches_async(self, fetcher, puuid, matches_per_player):
+        watermark = self.watermarks.get(puuid) if self.incremental_crawl else None
+        listed_at = time.time()
+        if watermark is None:
+            match_ids = await fetcher.get(self.matches_ids_url(puuid, matches_per_player))
+            return self.record_listing(puuid, match_ids, None, 1, listed_at)
+
+        match_ids, pages = [], 0
+        while True:
+            page = await fetcher.get(self.matches_ids_url(puuid, matches_per_player, pages * matches_per_player,
+                                                          watermark[1]))
+            pages += 1
+            if self.add_listing_page(match_ids, page, watermark, matches_per_player, pages):
+                return self.record_listing(puuid, match_ids, watermark, pages, listed_at)
+
+    def add_listing_page(self, match_ids, page, watermark, matches_per_player, pages):
+        """Adds ids of the page newer than the watermark match, True when the listing is complete"""
+        if watermark[0] in page:
+            match_ids.extend(page[:page.index(watermark[0])])
+            return True
+
+        match_ids.extend(page)
+        # a short page is the last one, max_listing_pages stops players who played a lot since the last crawl
+        return len(page) < matches_per_player or pages >= self.max_listing_pages
+
+    def record_listing(self, puuid, match_ids, watermark, pages, listed_at):
+        # the list is ordered from the newest match, the watermark moves once all the matches are saved
+        self.watermarks.listed(puuid, match_ids, listed_at)
+        self.watermarks.observe_listing(watermark is not None, pages)
+        return match_ids
 
     """
-    Collecting all match data from each tier - used in DataUploader class
+    Collecting all match data from each tier - used in DataUploader class.
+    It's a generator - rows of every analyzed match are yielded right away (see analyze_matches), 
+    so nothing is kept in memory for the whole tier.
     """
-    def collect_data_from_tier(self, players_per_division, matches_per_player, tier):
+    def collect_data_from_tier(self, players_per_division, matches_per_player, tier, match_filter=None):
         all_match_ids = set()
 
         players = self.get_players_by_tier(tier, players_per_division)
@@ -156,206 +338,457 @@ class DataPipeline:
         tier_match_ids = self.get_unique_matches_id_by_puuid(players, tier, matches_per_player)
         all_match_ids.update(tier_match_ids)
 
-        print(f"Collected {len(tier_match_ids)} unique ID from {tier}")
+        logger.info(f"Collected {len(tier_match_ids)} unique ID from {tier}")
+
+        all_match_ids = self.skip_known_matches(all_match_ids, match_filter)
 
         # after collecting all ids we just use analyze_matches to retrieve all required information
-        analyzed_matches = self.analyze_matches(all_match_ids)
-        print(f"Analyzed matches: {len(analyzed_matches)}")
+        analyzed_matches = 0
+        for match_rows in self.analyze_matches(all_match_ids):
+            analyzed_matches += 1
+            yield match_rows
+
+        logger.info(f"Analyzed matches: {analyzed_matches}")
+        logger.info(f"Rate limiter: {self.rate_limiter.report()}")
+        logger.info(f"League cache: {self.league_cache.stats()}")
+        logger.info(f"Rank snapshot: {self.rank_snapshot.stats()}")
+        logger.info(f"Match watermarks: {self.watermarks.stats()}")
+
+    """
+    Matches which are already stored don't have to be downloaded and parsed again - for the watermarks they count
+    as saved.
+    match_filter - function returning only new match ids, e.g. DatabaseConnection.filter_new_match_ids
+    """
 
-        return analyzed_matches
+    def skip_known_matches(self, match_ids, match_filter):
+        if match_filter is None:
+            return match_ids
 
+        new_match_ids = match_filter(match_ids)
+        known_match_ids = [match_id for match_id in match_ids if match_id not in new_match_ids]
+        self.watermarks.saved(known_match_ids)
+        if known_match_ids:
+            logger.info(f"Skipping {len(known_match_ids)} already ingested matches")
+        return new_match_ids
 
+    """
+    Async version of skip_known_matches - match_filter is usually a database query, so it runs in a worker thread
+    and the event loop keeps serving the requests in flight.
+    """
+    async def skip_known_matches_async(self, match_ids, match_filter):
+        if match_filter is None:
+            return match_ids
+        return await asyncio.to_thread(self.skip_known_matches, match_ids, match_filter)
 
+    """
+    Async version of collect_data_from_tier (async generator) - league pages, match id lists, match details 
+    and league lookups are sent concurrently, eun1 and europe hosts are limited separately (see AsyncFetcher).
+    """
+    async def collect_data_from_tier_async(self, players_per_division, matches_per_player, tier, match_filter=None,
+                                           fetcher=None):
+        if fetcher is None:
+            async with AsyncFetcher(self.rate_limiter, max_retries=self.max_retries,
+                                    retry_backoff=self.retry_backoff, metrics=self.metrics) as fetcher:
+                async for match_rows in self.collect_data_from_tier_async(players_per_division, matches_per_player,
+                                                                          tier, match_filter, fetcher):
+                    yield match_rows
+            return
+
+        players = await self.get_players_by_tier_async(fetcher, tier, players_per_division)
+
+        tier_match_ids = await self.get_unique_matches_id_by_puuid_async(fetcher, players, tier, matches_per_player)
+        logger.info(f"Collected {len(tier_match_ids)} unique ID from {tier}")
+
+        tier_match_ids = await self.skip_known_matches_async(tier_match_ids, match_filter)
+
+        analyzed_matches = 0
+        async for match_rows in self.analyze_matches_async(fetcher, tier_match_ids):
+            analyzed_matches += 1
+            yield match_rows
+
+        logger.info(f"Analyzed matches: {analyzed_matches}")
+        logger.info(f"Rate limiter: {self.rate_limiter.report()}")
+        logger.info(f"League cache: {self.league_cache.stats()}")
+        logger.info(f"Rank snapshot: {self.rank_snapshot.stats()}")
+        logger.info(f"Match watermarks: {self.watermarks.stats()}")
 
+    """
+    Version of collect_data_from_tier_async driven by WorkScheduler - league pages, id lists, match details and rank
+    lookups are work items with priorities and dependencies (rows of a match wait for the rank lookups of its players),
+    started whenever their endpoint has budget. Players of the first league pages are listed while the rest of the
+    division is still walked, and matches are written from the first minutes instead of after all id lists.
+    Rank lookups wait for the league walks of the tier (league_walk items, finished with the last page of
+    the division), so players of the walked divisions are taken from the rank snapshot, not asked for one by one.
+    """
+    async def crawl_tier_scheduled(self, players_per_division, matches_per_player, tier, match_filter=None,
+                                   fetcher=None, scheduler=None):
+        if fetcher is None:
+            async with AsyncFetcher(self.rate_limiter, max_retries=self.max_retries,
+                                    retry_backoff=self.retry_backoff, metrics=self.metrics) as fetcher:
+                async for match_rows in self.crawl_tier_scheduled(players_per_division, matches_per_player, tier,
+                                                                  match_filter, fetcher, scheduler):
+                    yield match_rows
+            return
+
+        scheduler = scheduler or WorkScheduler(self.rate_limiter)
+        taken_at = time.time()
+        # division -> players still to be listed
+        remaining = {division: players_per_division for division in self.divisions}
+
+        def add_players(puuids):
+            for puuid in puuids:
+                scheduler.add(WorkItem("id_list", puuid, lambda puuid=puuid: list_matches(puuid),
+                                       url=self.matches_ids_url(puuid, matches_per_player)))
+
+        def add_league_page(division, page):
+            return scheduler.add(WorkItem("league_page", (division, page), lambda: league_page(division, page),
+                                          url=self.league_entries_url(tier, division, page)))
+
+        async def walked():
+            return None
+
+        # division -> item finished when all pages of the division are walked
+        walks = {}
+
+        async def league_page(division, page):
+            entries = await fetcher.get(self.league_entries_url(tier, division, page))
+            if entries:
+                self.rank_snapshot.store_page(tier, division, page, entries, taken_at)
+                wanted = [entry['puuid'] for entry in entries if entry.get('puuid')][:remaining[division]]
+                remaining[division] -= len(wanted)
+                add_players(wanted)
+
+            if entries and (self.max_league_pages is None or page < self.max_league_pages):
+                scheduler.add_dependency(walks[division], add_league_page(division, page + 1))
+            else:
+                pages = page if entries else page - 1
+                players = self.rank_snapshot.complete(tier, division, taken_at, pages)
+                logger.info(f"Rank snapshot of {tier} {division}: {players} players on {pages} pages")
+
+        async def list_matches(puuid):
+            match_ids = await self.list_player_matches_async(fetcher, puuid, matches_per_player)
+            for match_id in await self.skip_known_matches_async(match_ids, match_filter):
+                # archived matches don't need any budget
+                url = None if match_id in self.match_archive else self.match_details_url(match_id)
+                scheduler.add(WorkItem("match_detail", match_id, lambda match_id=match_id: match_detail(match_id),
+                                       url=url))
+
+        async def match_detail(match_id):
+            match = await self.fetch_match_details_async(fetcher, match_id)
+            lookups = []
+            for puuid in MatchFlattener.puuids(match):
+                lookups.append(scheduler.add(WorkItem("rank_lookup", puuid,
+                                                      lambda puuid=puuid: self.get_players_info_async(fetcher, puuid),
+                                                      url=lambda puuid=puuid: lookup_url(puuid),
+                                                      depends_on=walks.values())))
+            scheduler.add(WorkItem("rows", match_id, lambda: match_rows(match_id, match, lookups), depends_on=lookups))
+
+        def lookup_url(puuid):
+            # players from the rank snapshot / league cache are local items as well - checked once the league walks
+            # are finished
+            if self.cached_player_info(puuid) is not LeagueCache.MISSING:
+                return None
+            return self.league_by_puuid_url(puuid)
+
+        async def match_rows(match_id, match, lookups):
+            return self.build_match_rows(match_id, match, {lookup.key: lookup.result for lookup in lookups})
+
+        for division in self.divisions:
+            if self.rank_snapshot.is_fresh(tier, division):
+                add_players([player['puuid'] for player in self.rank_snapshot.players(tier, division,
+                                                                                      players_per_division)])
+            else:
+                walks[division] = scheduler.add(WorkItem("league_walk", division, walked,
+                                                         depends_on=[add_league_page(division, 1)]))
+
+        analyzed_matches = 0
+        async for item in scheduler.run():
+            if item.kind == "rows" and item.error is None:
+                analyzed_matches += 1
+                match_rows_of_item, item.result = item.result, None
+                yield match_rows_of_item
+
+        logger.info(f"Analyzed matches: {analyzed_matches}")
+        logger.info(f"Scheduler: {scheduler.report()}")
+        logger.info(f"Rate limiter: {self.rate_limiter.report()}")
+        logger.info(f"League cache: {self.league_cache.stats()}")
+        logger.info(f"Rank snapshot: {self.rank_snapshot.stats()}")
+        logger.info(f"Match watermarks: {self.watermarks.stats()}")
+
+    """
+    Resumable version of collect_data_from_tier_async - every league page, player and match is a work item 
+    in crawl_state (see CrawlState), so after a crash only unfinished items are requested again.
+    Match items are marked as done by the caller, once their rows are saved (BatchSink on_flush).
+    """
+    async def crawl_tier_resumable(self, crawl_state, players_per_division, matches_per_player, tier,
+                                   match_filter=None, fetcher=None):
+        if fetcher is None:
+            async with AsyncFetcher(self.rate_limiter, max_retries=self.max_retries,
+                                    retry_backoff=self.retry_backoff, metrics=self.metrics) as fetcher:
+                async for match_rows in self.crawl_tier_resumable(crawl_state, players_per_division,
+                                                                  matches_per_player, tier, match_filter, fetcher):
+                    yield match_rows
+            return
+
+        if not crawl_state.has_items('division', tier):
+            crawl_state.enqueue('division', [f"{tier}/{division}" for division in self.divisions], tier)
+
+        async def crawl_division(key):
+            _, division = key.split('/')
+            if not self.rank_snapshot.is_fresh(tier, division):
+                await self.take_rank_snapshot_async(fetcher, tier, division)
+            players = self.rank_snapshot.players(tier, division, players_per_division)
+            if not players:
+                raise Exception(f"No players of {tier} {division} in the rank snapshot")
+            crawl_state.enqueue('puuid', [player['puuid'] for player in players], tier)
+            logger.info(f"Collected data about players from {tier} {division}")
+
+        async def crawl_player(puuid):
+            match_ids = await self.list_player_matches_async(fetcher, puuid, matches_per_player)
+            crawl_state.enqueue('match', match_ids, tier)
+            logger.debug(f"Collected data about matches from {tier} {puuid}")
+
+        async for _ in self.process_work_items(crawl_state, 'division', tier, crawl_division):
+            pass
+        async for _ in self.process_work_items(crawl_state, 'puuid', tier, crawl_player):
+            pass
+
+        # matches already stored are marked as done right away (and as saved for the watermarks)
+        known_filter = None if match_filter is None else lambda keys: self.skip_known_matches(keys, match_filter)
+        analyzed_matches = 0
+        async for _, match_rows in self.process_work_items(crawl_state, 'match', tier,
+                                                           lambda match_id: self.analyze_match_async(fetcher, match_id),
+                                                           key_filter=known_filter, mark_done=False):
+            analyzed_matches += 1
+            yield match_rows
+
+        logger.info(f"Analyzed matches: {analyzed_matches}")
+        logger.info(f"Crawl state: {crawl_state.summary()}")
+        logger.info(f"Rate limiter: {self.rate_limiter.report()}")
+        logger.info(f"League cache: {self.league_cache.stats()}")
+        logger.info(f"Rank snapshot: {self.rank_snapshot.stats()}")
+        logger.info(f"Match watermarks: {self.watermarks.stats()}")
+
+    """
+    Processing all work items of one kind concurrently - yields (key, result) of every successful item.
+    Failed items are rescheduled by crawl_state (backoff), so we wait for them here until they succeed
+    or land on the retry list.
+    key_filter - function returning keys which still have to be processed, other claimed items are done right away.
+    It runs in a worker thread, so it can block (e.g. query the database) without stopping the running items.
+    """
+    @staticmethod
+    async def process_work_items(crawl_state, kind, tier, handler, key_filter=None, mark_done=True, batch_size=100):
+        while True:
+            keys = crawl_state.claim(kind, tier, batch_size)
+            if not keys:
+                wait = crawl_state.next_retry_in(kind, tier)
+                if wait is None:
+                    return
+                logger.info(f"Waiting {wait:.0f} seconds before retrying failed {kind} items")
+                await asyncio.sleep(wait)
+                continue
+
+            if key_filter is not None:
+                new_keys = await asyncio.to_thread(key_filter, keys)
+                crawl_state.mark_done(kind, [key for key in keys if key not in new_keys])
+                keys = [key for key in keys if key in new_keys]
+
+            tasks = {asyncio.ensure_future(handler(key)): key for key in keys}
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        status = crawl_state.mark_failed(kind, key, e)
+                        logger.warning(f"Error while processing {kind} {key} ({status}): {e}")
+                        continue
+
+                    if mark_done:
+                        crawl_state.mark_done(kind, [key])
+                    yield key, result
 
     """
     Function to get players
     """
     def get_players_info(self, player_puuid):
         if player_puuid == "BOT" or not player_puuid:
-            print(f"Skipping bot player with puuid: {player_puuid}")
+            logger.debug(f"Skipping bot player with puuid: {player_puuid}")
+            return None
+
+        cached = self.cached_player_info(player_puuid)
+        if cached is not LeagueCache.MISSING:
+            return cached
+
+        url = self.league_by_puuid_url(player_puuid)
+        try:
+            player_info = self.parse_player_info(player_puuid, self.rate_limited_requests(url))
+            self.league_cache.set(player_puuid, player_info)
+            return player_info
+        except Exception as e:
+            logger.warning(f"Error while downloading data ... : {e}")
+            return None
+
+    async def get_players_info_async(self, fetcher, player_puuid):
+        if player_puuid == "BOT" or not player_puuid:
+            logger.debug(f"Skipping bot player with puuid: {player_puuid}")
             return None
 
-        #https://eun1.api.riotgames.com/tft/league/v1/by-puuid/....
-        url = "{}/{}/league/v1/by-puuid/{}?api_key={}".format(self.eune_base_url,
-                                                              self.game_type[0],
-                                                              player_puuid,
-                                                              self.api_key)
+        cached = self.cached_player_info(player_puuid)
+        if cached is not LeagueCache.MISSING:
+            return cached
+
         try:
-            #player_info = self.make_request(url)
-            player_info = self.rate_limited_requests(url)
-            if isinstance(player_info, list) and player_info:
-                return player_info[0]
-            print(f"No ranked data for player {player_puuid}")
+            player_info = self.parse_player_info(player_puuid, await fetcher.get(self.league_by_puuid_url(player_puuid)))
+            self.league_cache.set(player_puuid, player_info)
             return player_info
         except Exception as e:
-            print(f"Error while downloading data ... : {e}")
+            logger.warning(f"Error while downloading data ... : {e}")
             return None
 
+    def cached_player_info(self, player_puuid, include_expired=False):
+        """Rank from the rank snapshot, then from the league cache - LeagueCache.MISSING if we have to ask the api"""
+        ranked = self.rank_snapshot.get(player_puuid, include_expired)
+        if ranked is not RankSnapshot.MISSING:
+            return ranked
+        return self.league_cache.get(player_puuid, include_expired)
+
+    @staticmethod
+    def parse_player_info(player_puuid, player_info):
+        if isinstance(player_info, list) and player_info:
+            return player_info[0]
+        logger.debug(f"No ranked data for player {player_puuid}")
+        return player_info
+
     """
     Function to download all data about matches needed for analysis (raw data (json)).
     """
 
     def get_match_details(self, match_id):
-        # https://europe.api.riotgames.com/tft/match/v1/matches/EUN1_3769226704?api_key=.....
-        url = "{}/{}/match/v1/matches/{}?api_key={}".format(self.europe_base_url,
-                                                            self.game_type[0],
-                                                            match_id,
-                                                            str(self.api_key))
+        archived = self.match_archive.get_raw(match_id)
+        if archived is not None:
+            return MatchFlattener.decode(archived)
+
+        url = self.match_details_url(match_id)
+        try:
+            raw = self.rate_limited_requests(url, raw=True)
+            match = MatchFlattener.decode(raw)
+            self.match_archive.put(match_id, raw)
+            return match
+        except Exception as e:
+            logger.warning(f"Error while downloading data ... : {e}")
+            return None
+
+    async def get_match_details_async(self, fetcher, match_id):
         try:
-            # match_data = self.make_request(url)
-            match_data = self.rate_limited_requests(url)
-            return match_data
+            return await self.fetch_match_details_async(fetcher, match_id)
         except Exception as e:
-            print(f"Error while downloading data ... : {e}")
+            logger.warning(f"Error while downloading data ... : {e}")
             return None
 
+    async def fetch_match_details_async(self, fetcher, match_id):
+        archived = self.match_archive.get_raw(match_id)
+        if archived is not None:
+            return MatchFlattener.decode(archived)
+
+        raw = await fetcher.get(self.match_details_url(match_id), raw=True)
+        match = MatchFlattener.decode(raw)
+        self.match_archive.put(match_id, raw)
+        return match
+
     """
     Function to analyze and retrieve all necessary data for analysis. 
+    Generator - yields rows of one match at a time (dict: table name -> list of rows, see build_match_rows).
     """
 
     def analyze_matches(self, match_ids):
-        matches_data = []
-        players_data = []
-        traits = []
-        units = []
-        items = []
+        for match_id in match_ids:
+            match = self.get_match_details(match_id)
+            if not match:
+                continue
 
-        # for testing
-        # matches_count = 0
+            players_info = {}
+            for puuid in MatchFlattener.puuids(match):
+                logger.debug(f"Processing player {puuid} in match {match_id}")
+                players_info[puuid] = self.get_players_info(puuid)
 
-        for match_id in match_ids:
-            # for testing purposes
-            # if matches_count >= 5:
-            #     break
+            yield self.build_match_rows(match_id, match, players_info)
 
-            match_data = self.get_match_details(match_id)
-            if not match_data:
-                continue
+    """
+    Async generator - at most max_in_flight matches are analyzed at the same time, rows are yielded 
+    in the order the matches finish.
+    """
 
-            match_info = match_data['info']
+    async def analyze_matches_async(self, fetcher, match_ids, max_in_flight=50):
+        async def analyze_match(match_id):
+            try:
+                return await self.analyze_match_async(fetcher, match_id)
+            except Exception as e:
+                logger.warning(f"Error while downloading data ... : {e}")
+                return None
+
+        pending_ids = iter(match_ids)
+        in_flight = set()
+        while True:
+            for match_id in pending_ids:
+                in_flight.add(asyncio.ensure_future(analyze_match(match_id)))
+                if len(in_flight) >= max_in_flight:
+                    break
 
-            # adding basic match info (this will be stored in matches table in the database).
-            match_entry = {
-                "match_id": match_id,
-                "game_datetime": match_info['game_datetime'],
-                "game_length": match_info['game_length'],
-                "mapId": match_info['mapId'],
-                "tft_set_number": match_info['tft_set_number'],
-            }
-            matches_data.append(match_entry)
-
-            # now we will get info about players, traits, units and items (each will be stored separately)
-            for player in match_info['participants']:
-                try:
-                    # checking if player is not a BOT
-                    if player['puuid'] == "BOT" or not player['puuid']:
-                        print(f"Skipping BOT player in match {match_id}")
-                        continue
+            if not in_flight:
+                break
+
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                match_rows = task.result()
+                if match_rows:
+                    yield match_rows
+
+    async def analyze_match_async(self, fetcher, match_id):
+        """Rows of one match - raises if the match details can't be downloaded"""
+        match = await self.fetch_match_details_async(fetcher, match_id)
+
+        puuids = MatchFlattener.puuids(match)
+        infos = await asyncio.gather(*(self.get_players_info_async(fetcher, puuid) for puuid in puuids))
+        return self.build_match_rows(match_id, match, dict(zip(puuids, infos)))
+
+    """
+    Rebuilding rows of all tables from the local match archive, without any api calls.
+    Ranks of the players are taken from the rank snapshot and the league cache (even expired entries), players missing
+    there are UNRANKED.
+    """
+
+    def analyze_archived_matches(self, match_ids=None):
+        rebuilt_matches = 0
+        for match_id, raw in self.match_archive.iter_matches(match_ids, raw=True):
+            match = MatchFlattener.decode(raw)
+            players_info = {}
+            for puuid in MatchFlattener.puuids(match):
+                cached = self.cached_player_info(puuid, include_expired=True)
+                if cached is not LeagueCache.MISSING:
+                    players_info[puuid] = cached
+
+            rebuilt_matches += 1
+            yield self.build_match_rows(match_id, match, players_info)
+
+        logger.info(f"Rebuilt {rebuilt_matches} matches from the archive")
+
+    """
+    Flattening one match into rows of matches, players, traits, units and items tables - row tuples in the order of
+    DatabaseConnection.BULK_COLUMNS (see MatchFlattener), written with DatabaseConnection.add_match_rows_bulk.
+    match - decoded payload (MatchFlattener.decode) or raw json as a dict.
+    players_info - ranked data of the participants (puuid -> league entry), downloaded by the caller.
+    """
+
+    def build_match_rows(self, match_id, match, players_info):
+        if isinstance(match, dict):
+            match = MatchFlattener.from_dict(match)
 
-                    print(f"Processing player {player['puuid']} in match {match_id}")
-                    playerInfo = self.get_players_info(player['puuid'])
-
-                    player_entry = {
-                        "match_id": match_id,
-                        "puuid": player['puuid'],
-                        "placement": player['placement'],
-                        "level": player['level'],
-                        "gold_left": player['gold_left'],
-                        "last_round": player['last_round'],
-                        "players_eliminated": player['players_eliminated'],
-                        "time_eliminated": player['time_eliminated'],
-                        "total_damage": player['total_damage_to_players'],
-                        "companion_id": player['companion']['content_ID']
-                    }
-
-                    # adding ranking info if available, otherwise default values
-                    if playerInfo and isinstance(playerInfo, dict):
-                        if 'tier' in playerInfo and 'rank' in playerInfo:
-                            player_entry.update({
-                                "tier": playerInfo['tier'],
-                                "division": playerInfo['rank'],
-                                "leaguePoints": playerInfo.get('leaguePoints', 0),
-                                "wins": playerInfo.get('wins', 0),
-                                "losses": playerInfo.get('losses', 0)
-                            })
-                            # print(
-                            #     f"Added ranked data for player {player['puuid']}: {playerInfo['tier']} {playerInfo['rank']}")
-                        else:
-                            # print(f"Player {player['puuid']} has no tier/rank info")
-
-                            player_entry.update({
-                                "tier": "UNRANKED",
-                                "division": "NONE",
-                                "leaguePoints": 0,
-                                "wins": 0,
-                                "losses": 0
-                            })
-                    else:
-                        # print(f"No details for player {player['puuid']}")
-                        player_entry.update({
-                            "tier": "UNRANKED",
-                            "division": "NONE",
-                            "leaguePoints": 0,
-                            "wins": 0,
-                            "losses": 0
-                        })
-
-                    players_data.append(player_entry)
-                    # print(f"Added player data for {player['puuid']}")
-
-                    for trait in player['traits']:
-                        try:
-                            trait_entry = {
-                                "match_id": match_id,
-                                "puuid": player['puuid'],
-                                "trait_name": trait['name'],
-                                "num_units": trait['num_units'],
-                                "style": trait['style'],
-                                "tier_current": trait['tier_current'],
-                                "tier_total": trait['tier_total']
-                            }
-                            traits.append(trait_entry)
-                        except KeyError as e:
-                            print(f"Missing key in trait data for player {player['puuid']}: {e}")
-                            continue
-
-                    for unit in player['units']:
-                        try:
-                            unit_entry = {
-                                "match_id": match_id,
-                                "puuid": player['puuid'],
-                                "character_id": unit['character_id'],
-                                "rarity": unit['rarity'],
-                                "tier": unit['tier']
-                            }
-                            units.append(unit_entry)
-
-                            for item_name in unit['itemNames']:
-                                item_entry = {
-                                    "match_id": match_id,
-                                    "puuid": player['puuid'],
-                                    "character_id": unit['character_id'],
-                                    "item_id": item_name
-                                }
-                                items.append(item_entry)
-                        except KeyError as e:
-                            print(f"Missing key in unit data for player {player['puuid']}: {e}")
-                            continue
-
-                except Exception as e:
-                    print(f"Error processing player {player.get('puuid', 'unknown')} in match {match_id}: {e}")
-                    continue
-
-            # matches_count += 1
-
-        #return matches_data, players_data, traits, units, items
-        return {
-            "matches": matches_data,
-            "players": players_data,
-            "traits": traits,
-            "units": units,
-            "items": items
-        }
+        match_rows = MatchFlattener.rows(match_id, match, players_info)
+        # time of the match goes with the watermark pointing at it - the next incremental listing starts from it
+        self.watermarks.observe_match(match_id, match.info.game_datetime)
+        self.metrics.observe_match()
+        return match_rows
 
 #
@@ -1,40 +1,143 @@
+import asyncio
+import logging
 import os
 import sys
 import time
 
+from Data.BatchSink import BatchSink
+from Data.BoardIndex import BoardIndex
+from Data.Cooccurrence import Cooccurrence
+from Data.CrawlState import CrawlState
 from Data.DataPipeline import DataPipeline
 from Data.DatabaseConnection import DatabaseConnection
+from Data.ParallelRebuild import ParallelRebuild
 
+logger = logging.getLogger(__name__)
 
-def save_to_db_api_info(matches_data):
-    print("Saving data to database...")
 
-    try:
-        db.add_matches_bulk(matches_data["matches"])
-        db.add_players_bulk(matches_data["players"])
-        db.add_traits_bulk(matches_data["traits"])
-        db.add_units_bulk(matches_data["units"])
-        db.add_items_bulk(matches_data["items"])
+def index_batch(batch):
+    # every written batch updates the local indexes, so the notebooks never scan the raw tables
+    board_index.add_rows(batch)
+    cooccurrence.add_rows(batch)
 
-        print("Done! Everything saved successfully!")
 
-    except Exception as e:
-        print("Error while saving to the database", e)
+def saved_matches(on_flush=None):
+    def flushed(match_ids):
+        # players whose listed matches are all stored move their watermarks (see MatchWatermarks)
+        pipeline.watermarks.saved(match_ids)
+        if on_flush is not None:
+            on_flush(match_ids)
+    return flushed
+
+
+def save_to_db_api_info(match_rows_stream):
+    logger.info("Saving data to database...")
+
+    # rows are written in micro-batches while the matches are still being downloaded, a failed write is raised
+    # (after one more try when the sink is closed) - downloaded matches are never dropped silently
+    with BatchSink(db, on_flush=saved_matches(), metrics=pipeline.metrics, on_batch=index_batch) as sink:
+        for match_rows in match_rows_stream:
+            sink.add(match_rows)
+
+    logger.info(f"Done! {sink.flushed_matches} matches saved successfully in {sink.flushed_batches} batches!")
+
+
+async def save_to_db_api_info_async(match_rows_stream, on_flush=None):
+    logger.info("Saving data to database...")
+
+    with BatchSink(db, on_flush=saved_matches(on_flush), metrics=pipeline.metrics, on_batch=index_batch) as sink:
+        async for match_rows in match_rows_stream:
+            # writing in a thread, so requests in flight are not blocked by the database
+            await asyncio.to_thread(sink.add, match_rows)
+
+    logger.info(f"Done! {sink.flushed_matches} matches saved successfully in {sink.flushed_batches} batches!")
 
 
 if __name__ == "__main__":
+    # LOG_LEVEL=DEBUG shows every player / match, WARNING only problems
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
     dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
     pipeline = DataPipeline(dotenv_path)
     db = DatabaseConnection(dotenv_path)
+    # fingerprints of the boards of every written batch (see BoardIndex)
+    default_index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "indexes", "boards")
+    board_index = BoardIndex(os.getenv('BOARD_INDEX_PATH', default_index_path))
+    # trait / unit / item co-occurrence and placement matrices (see Cooccurrence)
+    default_cooccurrence_path = os.path.join(os.path.dirname(default_index_path), "cooccurrence")
+    cooccurrence = Cooccurrence(os.getenv('COOCCURRENCE_PATH', default_cooccurrence_path))
 
+    # METRICS_PORT - prometheus endpoint (http://localhost:PORT/metrics), METRICS_SNAPSHOT_PATH - json file updated
+    # every METRICS_SNAPSHOT_INTERVAL seconds
+    if os.getenv('METRICS_PORT'):
+        pipeline.metrics.serve(int(os.getenv('METRICS_PORT')))
+    snapshot_path = os.getenv('METRICS_SNAPSHOT_PATH')
+    if snapshot_path:
+        pipeline.metrics.start_snapshots(snapshot_path, int(os.getenv('METRICS_SNAPSHOT_INTERVAL', 30)))
+
+    exit_code = 0
     try:
+        # python DataUploader.py --rebuild-from-archive - reloading all tables from the local match archive (no api),
+        # matches are flattened by REBUILD_WORKERS processes and written by one loader per pooled connection
+        if "--rebuild-from-archive" in sys.argv:
+            rebuild = ParallelRebuild(db, pipeline.league_cache_path, pipeline.rank_snapshot_path,
+                                      workers=int(os.getenv('REBUILD_WORKERS', os.cpu_count())),
+                                      loaders=db.pool.maxconn)
+            rebuild.run(rebuild.archive_shards(pipeline.match_archive))
+            sys.exit(0)
+
+        # python DataUploader.py --rebuild-rollups - recomputing summary tables from all stored matches
+        if "--rebuild-rollups" in sys.argv:
+            db.rebuild_rollups()
+            sys.exit(0)
+
+        # python DataUploader.py --backfill-match-tiers - setting match_tier of matches stored before it existed
+        if "--backfill-match-tiers" in sys.argv:
+            db.backfill_match_tiers()
+            sys.exit(0)
+
+        # crawl progress is stored locally - after a crash the last unfinished run is resumed,
+        # python DataUploader.py --new-run starts from scratch, --retry-failed retries items from the retry list
+        default_state_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache", "crawl_state.sqlite")
+        crawl_state = CrawlState(os.getenv('CRAWL_STATE_PATH', default_state_path))
+        crawl_state.start_run(new_run="--new-run" in sys.argv)
+        # --incremental - players listed before are asked only for matches played since their watermark
+        pipeline.incremental_crawl = "--incremental" in sys.argv
+        if "--retry-failed" in sys.argv:
+            logger.info(f"Retrying {crawl_state.retry_failed()} failed items")
+
         for tier in pipeline.tiers:
-            analyzed_matches_data = pipeline.collect_data_from_tier(10, 1, tier)
-            save_to_db_api_info(analyzed_matches_data)
+            # --scheduled - league pages, id lists, match details and rank lookups share one priority queue
+            # (see WorkScheduler), without the resumable crawl state
+            if "--scheduled" in sys.argv:
+                asyncio.run(save_to_db_api_info_async(
+                    pipeline.crawl_tier_scheduled(10, 1, tier, match_filter=db.filter_new_match_ids)))
+                continue
 
+            # async version sends the requests concurrently (pipeline.collect_data_from_tier is the blocking one)
+            # matches already stored in the database are skipped before downloading their details
+            asyncio.run(save_to_db_api_info_async(
+                pipeline.crawl_tier_resumable(crawl_state, 10, 1, tier, match_filter=db.filter_new_match_ids),
+                on_flush=lambda match_ids: crawl_state.mark_done('match', match_ids)))
 
-        print("Data saved successfully!")
+        failed_items = crawl_state.failed_items()
+        for kind, key, tier, attempts, last_error in failed_items:
+            logger.warning(f"Failed {kind} {key} ({tier}) after {attempts} attempts: {last_error}")
+
+        # run is finished only when there is nothing left to retry
+        if not failed_items:
+            crawl_state.finish_run()
+
+        logger.info("Data saved successfully!")
 
     except Exception as e:
-        print(f"Błąd: {e}")
+        logger.exception(f"Błąd: {e}")
+        exit_code = 1
+
+    finally:
+        # report of the run - where the time went
+        if snapshot_path:
+            pipeline.metrics.stop_snapshots(snapshot_path)
+        logger.info(f"Run summary: {pipeline.metrics.summary()}")
+
+    sys.exit(exit_code)
@@ -1,20 +1,37 @@
+import io
+import logging
+
 import psycopg2
 import os
+import threading
+import uuid
 from dotenv import load_dotenv
 from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
+from datetime import datetime, timezone
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from Data.MatchTier import MatchTier
+
+logger = logging.getLogger(__name__)
 
 
 class DatabaseConnection:
-    def __init__(self, dotenv_path):
+    def __init__(self, dotenv_path, pool_size=None):
         load_dotenv(dotenv_path)
         envs = ['PG_DB_PASSWORD', 'PG_DB_USER', 'PG_DB_DATABASE', 'PG_DB_HOST', 'PG_DB_PORT']
         for env in envs:
             if not os.environ.get(env):
                 raise Exception(f'Environment variable {env} is not set')
 
-        self.conn = psycopg2.connect(
+        # pool of connections shared by threads (e.g. parallel writers) - minconn == maxconn, so healthy
+        # connections are never closed by the pool and prepared statements stay valid
+        pool_size = pool_size or int(os.getenv('PG_POOL_SIZE', 4))
+        self.pool = ThreadedConnectionPool(
+            pool_size,
+            pool_size,
             database=os.getenv('PG_DB_DATABASE'),
             user=os.getenv('PG_DB_USER'),
             password=os.getenv('PG_DB_PASSWORD'),
@@ -22,63 +39,227 @@ class DatabaseConnection:
             port=os.getenv('PG_DB_PORT'),
             sslmode="require"
         )
-        # otwieramy przy każdym połaczeniu bo tych danych jest bardzo duzo
-        # self.cursor = self.conn.cursor()  # to obiekt pozwalajacy na odbieranie i wysyłanie zapytan do bazy
-        # taki tunel do komunikacji z baza
+        # checkouts wait for a free connection instead of getconn raising PoolError when all are taken,
+        # PG_POOL_TIMEOUT - seconds after which waiting fails (e.g. a thread holding two connections)
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
+        self.pool_timeout = float(os.getenv('PG_POOL_TIMEOUT', 60))
+        # connection -> names of statements prepared on it (the set is used only by the thread holding the connection)
+        self.prepared = {}
+        self.prepared_lock = threading.Lock()
+
+        # compact layout (compact_schema.sql) - players / traits / units / items are views over *_compact tables
+        # and rows are written into those tables instead,
+        # partitioned layout (partitioned_schema.sql) - matches and the compact tables are partitioned by set and month
+        # (set, month) of the partitions created by this process (see create_partitions)
+        self.known_partitions = set()
+        self.compact_schema, self.partitioned_schema = self.query("""
+            SELECT to_regclass('traits_compact') IS NOT NULL,
+                COALESCE((SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('matches')), FALSE)""",
+                                                                  fetch_one=True)
 
     def __del__(self):
-        """Closing connection"""
-        if hasattr(self, 'conn') and self.conn:
-            self.conn.close()
+        """Closing all connections"""
+        if hasattr(self, 'pool') and not self.pool.closed:
+            self.pool.closeall()
+
+    """
+    Checking out a connection from the pool. Liveness is checked on checkout (conn.closed - no round-trip to the 
+    server) and on error - connection which raised OperationalError/InterfaceError is discarded instead of being 
+    returned to the pool.
+    """
+
+    @contextmanager
+    def connection(self):
+        if not self.pool_slots.acquire(timeout=self.pool_timeout):
+            raise Exception(f'No free database connection after {self.pool_timeout} seconds')
+        try:
+            conn = self.pool.getconn()
+            if conn.closed:
+                self.discard(conn)
+                conn = self.pool.getconn()
+
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                broken = True
+                raise
+            finally:
+                if broken or conn.closed:
+                    self.discard(conn)
+                else:
+                    self.pool.putconn(conn)
+        finally:
+            self.pool_slots.release()
+
+    def discard(self, conn):
+        with self.prepared_lock:
+            self.prepared.pop(conn, None)
+        self.pool.putconn(conn, close=True)
+
+    @contextmanager
+    def transaction(self):
+        """Cursor inside one transaction - commit at the end of the block, rollback on any exception"""
+        with self.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    yield cursor
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
 
     def query(self, query, args=None, fetch_one=False):
-        # self.ensure_connection()
-        with self.conn.cursor() as cursor:
+        # read only, so if the connection was dropped we just try again on another one
+        for attempt in range(2):
+            try:
+                with self.transaction() as cursor:
+                    cursor.execute(query, args)
+                    return cursor.fetchone() if fetch_one else cursor.fetchall()
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                if attempt:
+                    raise
+                logger.warning("Reconnecting to database...")
+
+    def query_frame(self, query, args=None):
+        """Query result as a pandas DataFrame with column names taken from the cursor"""
+        with self.transaction() as cursor:
             cursor.execute(query, args)
-            return cursor.fetchone() if fetch_one else cursor.fetchall()
+            return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+    """
+    Streaming reads - the result is kept by postgres in a named (server-side) cursor and sent itersize rows per 
+    round-trip, so memory of the client is bounded by the chunk size, not by the size of the result 
+    (query / fetchall loads everything at once). Connection stays checked out until the generator is exhausted 
+    or closed.
+    """
+
+    def _stream(self, query, args=None, itersize=20000):
+        """Yields (column names, list of at most itersize row tuples)"""
+        with self.connection() as conn:
+            try:
+                with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+                    cursor.itersize = itersize
+                    cursor.execute(query, args)
+                    while True:
+                        rows = cursor.fetchmany(itersize)
+                        if not rows:
+                            break
+                        yield [column[0] for column in cursor.description], rows
+                conn.commit()
+            except BaseException:
+                # also GeneratorExit - the caller stopped reading before the end
+                if not conn.closed:
+                    conn.rollback()
+                raise
+
+    def stream(self, query, args=None, itersize=20000):
+        """Rows of the query in chunks (lists of at most itersize tuples)"""
+        for _, rows in self._stream(query, args, itersize):
+            yield rows
+
+    def stream_frames(self, query, args=None, itersize=20000, dtypes=None):
+        """Rows of the query as DataFrames of at most itersize rows, dtypes - column name -> type (e.g. category)"""
+        for columns, rows in self._stream(query, args, itersize):
+            frame = pd.DataFrame(rows, columns=columns)
+            del rows
+            if dtypes:
+                frame = frame.astype({column: dtype for column, dtype in dtypes.items() if column in frame.columns})
+            yield frame
+
+    # column types of streamed tables - repeated names / ids as categories, small numbers as small (nullable) ints
+    FRAME_DTYPES = {
+        "matches": {"match_id": "string", "game_datetime": "Int64", "game_length": "float32", "map_id": "Int16",
+                    "tft_set_number": "Int16", "match_tier": "category"},
+        "players": {"puuid": "category", "match_id": "category", "placement": "Int8", "level": "Int8",
+                    "gold_left": "Int16", "last_round": "Int16", "players_eliminated": "Int8",
+                    "time_eliminated": "float32", "total_damage": "Int16", "companion_id": "category",
+                    "tier": "category", "division": "category", "leaguepoints": "Int16", "wins": "Int32",
+                    "losses": "Int32"},
+        "traits": {"id": "Int64", "match_id": "category", "puuid": "category", "trait_name": "category",
+                   "num_units": "Int8", "style": "Int8", "tier_current": "Int8", "tier_total": "Int8"},
+        "units": {"id": "Int64", "match_id": "category", "puuid": "category", "character_id": "category",
+                  "rarity": "Int8", "tier": "Int8"},
+        "items": {"id": "Int64", "match_id": "category", "puuid": "category", "character_id": "category",
+                  "item_id": "category"},
+    }
+
+    def stream_table(self, table, columns=None, set_number=None, itersize=20000, typed=True):
+        """
+        Rows of one table (matches, players, traits, units, items) as DataFrames of at most itersize rows.
+        columns - only these columns are read, set_number - only matches of this set (both filtered by postgres),
+        typed - columns converted with FRAME_DTYPES.
+        """
+        dtypes = self.FRAME_DTYPES[table]
+        columns = list(columns or dtypes)
+        unknown = [column for column in columns if column not in dtypes]
+        if unknown:
+            raise Exception(f"Unknown columns of {table}: {unknown}")
+
+        sql = f"SELECT {', '.join(columns)} FROM {table}"
+        args = None
+        if set_number is not None:
+            if table == "matches":
+                sql += " WHERE tft_set_number = %s"
+            else:
+                sql += " WHERE match_id IN (SELECT match_id FROM matches WHERE tft_set_number = %s)"
+            args = (set_number,)
+        return self.stream_frames(sql, args, itersize, dtypes if typed else None)
+
+    def load_table(self, table, columns=None, set_number=None, itersize=20000):
+        """
+        Whole table as one typed DataFrame, built chunk by chunk - the rows are never held as python tuples all at
+        once, only the (much smaller) typed chunks. Categories of all chunks are united.
+        """
+        frames = list(self.stream_table(table, columns, set_number, itersize))
+        if not frames:
+            return pd.DataFrame({column: pd.Series(dtype=self.FRAME_DTYPES[table][column])
+                                 for column in (columns or self.FRAME_DTYPES[table])})
+
+        data = {}
+        for column in frames[0].columns:
+            parts = [frame.pop(column) for frame in frames]
+            if isinstance(parts[0].dtype, pd.CategoricalDtype):
+                data[column] = union_categoricals(parts, ignore_order=True)
+            else:
+                data[column] = pd.concat(parts, ignore_index=True)
+        return pd.DataFrame(data)
 
     def execute_query(self, query, params=None):
-        # self.ensure_connection()
         try:
-            with self.conn.cursor() as cursor:
+            with self.transaction() as cursor:
                 cursor.execute(query, params)
-            self.conn.commit()
         except Exception as e:
-            print(f'Error while executing query: {e}')
-            self.conn.rollback()
+            logger.error(f'Error while executing query: {e}')
             raise e
 
-    # todo: tutaj trzeba bedzie optymalnie jakoś co jakiś czas sprawdzac stan połaczenia
-
-    def ensure_connection(self):
+    def execute_prepared(self, name, sql, params):
+        """
+        Executing statement prepared once per connection (PREPARE name AS sql, sql uses $1, $2, ... placeholders),
+        so the server parses and plans it only on the first call.
+        """
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("SELECT 1")
-        except (psycopg2.InterfaceError, psycopg2.OperationalError):
-            print("Reconnecting to database...")
-            self.reconnect()
+            with self.transaction() as cursor:
+                with self.prepared_lock:
+                    prepared = self.prepared.setdefault(cursor.connection, set())
+                if name not in prepared:
+                    cursor.execute(f"PREPARE {name} AS {sql}")
+                    prepared.add(name)
+                cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        except Exception as e:
+            logger.error(f'Error while executing query: {e}')
+            raise e
 
-    def reconnect(self):
-        try:
-            if self.conn:
-                self.conn.close()
-        except Exception:
-            pass
-        self.conn = psycopg2.connect(
-            database=os.getenv('PG_DB_DATABASE'),
-            user=os.getenv('PG_DB_USER'),
-            password=os.getenv('PG_DB_PASSWORD'),
-            host=os.getenv('PG_DB_HOST'),
-            port=os.getenv('PG_DB_PORT'),
-            sslmode="require"
-        )
     # matches table operations
     def add_match(self, match_data):
         """Adding a new match to the database - ignoring duplicate matches"""
+        if self.partitioned_schema:
+            return self.copy_bulk({"matches": self.matches_to_rows([match_data])})
+
         sql = """
-        INSERT INTO matches (match_id, game_datetime, game_length, map_id, tft_set_number) 
-        VALUES (%s, %s, %s, %s, %s) ON CONFLICT (match_id) DO NOTHING
-        RETURNING match_id """
+        INSERT INTO matches (match_id, game_datetime, game_length, map_id, tft_set_number, match_tier) 
+        VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (match_id) DO NOTHING"""
 
         params = (
             match_data["match_id"],
@@ -86,29 +267,57 @@ class DatabaseConnection:
             match_data["game_length"],
             match_data["mapId"],
             match_data["tft_set_number"],
+            match_data.get("match_tier"),
         )
         try:
-            self.execute_query(sql, params)
-            print("Match added successfully")
+            self.execute_prepared("add_match", sql, params)
+            logger.debug("Match added successfully")
         except Exception as e:
-            print(f'Error while adding match: {e}')
+            logger.error(f'Error while adding match: {e}')
+
+    # columns of the original table (compact / partitioned layouts have also match_sid)
+    MATCH_COLUMNS = "match_id, game_datetime, game_length, map_id, tft_set_number, match_tier"
 
     def get_match(self, match_id):
-        return self.query("SELECT * FROM matches WHERE match_id = %s", (match_id,), fetch_one=True)
+        return self.query(f"SELECT {self.MATCH_COLUMNS} FROM matches WHERE match_id = %s", (match_id,),
+                          fetch_one=True)
 
     def get_all_matches(self):
-        return self.query("SELECT * FROM matches")
+        return self.query(f"SELECT {self.MATCH_COLUMNS} FROM matches")
+
+    def filter_new_match_ids(self, match_ids):
+        """Returns only those match ids which are not in the database yet - one query for the whole batch"""
+        match_ids = list(match_ids)
+        if not match_ids:
+            return set()
+
+        existing = self.query("SELECT match_id FROM matches WHERE match_id = ANY(%s)", (match_ids,))
+        return set(match_ids) - {row[0] for row in existing}
+
+    def backfill_match_tiers(self):
+        """Setting match_tier of stored matches (e.g. matches added before the column existed) in one query"""
+        with self.transaction() as cursor:
+            cursor.execute(f"""
+                UPDATE matches m SET match_tier = t.match_tier
+                FROM ({MatchTier.SQL}) t
+                WHERE m.match_id = t.match_id AND m.match_tier IS DISTINCT FROM t.match_tier""")
+            updated = cursor.rowcount
+        logger.info(f"Match tier updated for {updated} matches")
+        return updated
 
     def delete_match(self, match_id):
         self.execute_query("DELETE FROM matches WHERE match_id = %s", (match_id,))
-        print("Match deleted successfully")
+        logger.info("Match deleted successfully")
 
     # players table - operations
     def add_player(self, player):
+        if self.compact_schema:
+            return self.copy_bulk({"players": self.players_to_rows([player])})
+
         sql = """
         INSERT INTO players(puuid, match_id, placement, level, gold_left, last_round,
             players_eliminated, time_eliminated, total_damage, companion_id, tier, division, leaguePoints, wins, losses) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15) 
         ON CONFLICT (puuid, match_id) DO NOTHING"""
 
         params = (
@@ -130,10 +339,10 @@ class DatabaseConnection:
         )
 
         try:
-            self.execute_query(sql, params)
-            print("Player added successfully")
+            self.execute_prepared("add_player", sql, params)
+            logger.debug("Player added successfully")
         except Exception as e:
-            print(f'Error while adding player info: {e}')
+            logger.error(f'Error while adding player info: {e}')
 
     def get_player(self, puuid):
         return self.query("SELECT * FROM players WHERE puuid = %s", (puuid,), fetch_one=True)
@@ -142,13 +351,16 @@ class DatabaseConnection:
         return self.query("SELECT * FROM players")
 
     def delete_player(self, puuid):
-        self.execute_query("DELETE FROM players WHERE puuid = %s", (puuid,))
+        self.delete_by_puuid("players", puuid)
 
     # traits table operations
     def add_traits(self, traits):
+        if self.compact_schema:
+            return self.copy_bulk({"traits": self.traits_to_rows([traits])})
+
         sql = """
             INSERT INTO traits (match_id, puuid, trait_name, num_units, style, tier_current, tier_total) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
             ON CONFLICT ON CONSTRAINT unique_trait DO NOTHING
             """
 
@@ -163,10 +375,10 @@ class DatabaseConnection:
         )
 
         try:
-            self.execute_query(sql, params)
-            print("Trait added successfully")
+            self.execute_prepared("add_traits", sql, params)
+            logger.debug("Trait added successfully")
         except Exception as e:
-            print(f'Error while adding trait info: {e}')
+            logger.error(f'Error while adding trait info: {e}')
 
     def get_traits(self, puuid):
         return self.query("SELECT * FROM traits WHERE puuid = %s", (puuid,))
@@ -175,13 +387,16 @@ class DatabaseConnection:
         return self.query("SELECT * FROM traits")
 
     def delete_traits(self, puuid):
-        self.execute_query("DELETE FROM traits WHERE puuid = %s", (puuid,))
+        self.delete_by_puuid("traits", puuid)
 
     # units table operations
     def add_unit(self, unit):
+        if self.compact_schema:
+            return self.copy_bulk({"units": self.units_to_rows([unit])})
+
         sql = """
         INSERT INTO units (match_id, puuid, character_id, rarity, tier)
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES ($1, $2, $3, $4, $5)
         ON CONFLICT ON CONSTRAINT unique_unit DO NOTHING
         """
         params = (
@@ -192,10 +407,10 @@ class DatabaseConnection:
             unit["tier"],
         )
         try:
-            self.execute_query(sql, params)
-            print("Unit added successfully")
+            self.execute_prepared("add_unit", sql, params)
+            logger.debug("Unit added successfully")
         except Exception as e:
-            print(f'Error while adding unit: {e}')
+            logger.error(f'Error while adding unit: {e}')
 
     def get_units(self, puuid):
         return self.query("SELECT * FROM units WHERE puuid = %s", (puuid,))
@@ -204,13 +419,16 @@ class DatabaseConnection:
         return self.query("SELECT * FROM units")
 
     def delete_units(self, puuid):
-        self.execute_query("DELETE FROM units WHERE puuid = %s", (puuid,))
+        self.delete_by_puuid("units", puuid)
 
     # items table operations
     def add_item(self, item):
+        if self.compact_schema:
+            return self.copy_bulk({"items": self.items_to_rows([item])})
+
         sql = """
         INSERT INTO items (match_id, puuid, character_id, item_id)
-        VALUES (%s, %s, %s, %s)
+        VALUES ($1, $2, $3, $4)
         ON CONFLICT ON CONSTRAINT unique_item DO NOTHING
         """
         params = (
@@ -220,10 +438,10 @@ class DatabaseConnection:
             item["item_id"],
         )
         try:
-            self.execute_query(sql, params)
-            print("Item added successfully")
+            self.execute_prepared("add_item", sql, params)
+            logger.debug("Item added successfully")
         except Exception as e:
-            print(f'Error while adding item: {e}')
+            logger.error(f'Error while adding item: {e}')
 
     def get_items(self, puuid):
         return self.query("SELECT * FROM items WHERE puuid = %s", (puuid,))
@@ -232,57 +450,508 @@ class DatabaseConnection:
         return self.query("SELECT * FROM items")
 
     def delete_items(self, puuid):
-        self.execute_query("DELETE FROM items WHERE puuid = %s", (puuid,))
+        self.delete_by_puuid("items", puuid)
+
+    def delete_by_puuid(self, table, puuid):
+        if self.compact_schema:
+            self.execute_query(f"""
+                DELETE FROM {table}_compact WHERE puuid_sid = (SELECT puuid_sid FROM puuids WHERE puuid = %s)""",
+                               (puuid,))
+        else:
+            self.execute_query(f"DELETE FROM {table} WHERE puuid = %s", (puuid,))
+
+    # analytics - aggregates computed by postgres (GROUP BY), only the small result goes over the network
+    """
+    Filters shared by the analytics methods:
+    set_number - e.g. 14 (matches.tft_set_number), tiers - list of player tiers, e.g. ["GOLD", "PLATINUM"].
+    Returns (sql condition, params).
+    """
+
+    @staticmethod
+    def analytics_filters(set_number=None, tiers=None):
+        conditions = ["TRUE"]
+        params = []
+        if set_number is not None:
+            conditions.append("m.tft_set_number = %s")
+            params.append(set_number)
+        if tiers:
+            conditions.append("p.tier = ANY(%s)")
+            params.append(list(tiers))
+        return " AND ".join(conditions), params
+
+    def placement_stats(self, table, group_columns, set_number=None, tiers=None, condition="TRUE", extra_columns=""):
+        """
+        Placement statistics of traits / units / items grouped by group_columns:
+        games (boards using it), avg_placement, top4_rate, win_rate and pick_rate (share of all boards).
+        """
+        filters, params = self.analytics_filters(set_number, tiers)
+        group = ", ".join(f"t.{column}" for column in group_columns)
+
+        sql = f"""
+        WITH boards AS (
+            SELECT COUNT(*) AS total
+            FROM players p JOIN matches m ON m.match_id = p.match_id
+            WHERE {filters}
+        )
+        SELECT {group},
+            COUNT(DISTINCT (t.match_id, t.puuid)) AS games,
+            ROUND(AVG(p.placement)::numeric, 3) AS avg_placement,
+            ROUND(AVG((p.placement <= 4)::int)::numeric, 4) AS top4_rate,
+            ROUND(AVG((p.placement = 1)::int)::numeric, 4) AS win_rate,
+            ROUND(COUNT(DISTINCT (t.match_id, t.puuid))::numeric / NULLIF(MAX(boards.total), 0), 4) AS pick_rate
+            {extra_columns}
+        FROM {table} t
+            JOIN players p ON p.match_id = t.match_id AND p.puuid = t.puuid
+            JOIN matches m ON m.match_id = t.match_id
+            CROSS JOIN boards
+        WHERE {filters} AND {condition}
+        GROUP BY {group}
+        ORDER BY games DESC
+        """
+        return self.query_frame(sql, params + params)
+
+    def placement_distribution(self, table, group_column, set_number=None, tiers=None, condition="TRUE"):
+        """Number of boards with the given trait / unit / item for every placement (1-8)"""
+        filters, params = self.analytics_filters(set_number, tiers)
+        sql = f"""
+        SELECT t.{group_column}, p.placement, COUNT(DISTINCT (t.match_id, t.puuid)) AS boards
+        FROM {table} t
+            JOIN players p ON p.match_id = t.match_id AND p.puuid = t.puuid
+            JOIN matches m ON m.match_id = t.match_id
+        WHERE {filters} AND {condition}
+        GROUP BY t.{group_column}, p.placement
+        ORDER BY t.{group_column}, p.placement
+        """
+        return self.query_frame(sql, params)
+
+    def trait_stats(self, set_number=None, tiers=None, active_only=True):
+        """Per trait: placement stats plus how often it was maxed and how maxed boards placed"""
+        extra_columns = """,
+            SUM((t.tier_current = t.tier_total)::int) AS maxed_count,
+            ROUND(AVG((t.tier_current = t.tier_total)::int)::numeric * 100, 1) AS maxed_percent,
+            ROUND(AVG((p.placement = 1)::int) FILTER (WHERE t.tier_current = t.tier_total)::numeric, 4)
+                AS maxed_win_rate,
+            ROUND(AVG((p.placement <= 4)::int) FILTER (WHERE t.tier_current = t.tier_total)::numeric, 4)
+                AS maxed_top4_rate"""
+        condition = "t.tier_current > 0" if active_only else "TRUE"
+        return self.placement_stats("traits", ["trait_name"], set_number, tiers, condition, extra_columns)
+
+    def trait_placement_distribution(self, set_number=None, tiers=None, active_only=True):
+        condition = "t.tier_current > 0" if active_only else "TRUE"
+        return self.placement_distribution("traits", "trait_name", set_number, tiers, condition)
+
+    def unit_stats(self, set_number=None, tiers=None):
+        """Per champion: placement stats and share of 3-star copies"""
+        extra_columns = """,
+            ROUND(AVG((t.tier = 3)::int)::numeric, 4) AS three_star_rate"""
+        return self.placement_stats("units", ["character_id", "rarity"], set_number, tiers,
+                                    extra_columns=extra_columns)
+
+    def unit_placement_distribution(self, set_number=None, tiers=None):
+        return self.placement_distribution("units", "character_id", set_number, tiers)
+
+    def item_stats(self, set_number=None, tiers=None, per_unit=False):
+        """Per item (or per champion and item when per_unit=True - item recommendations)"""
+        group_columns = ["character_id", "item_id"] if per_unit else ["item_id"]
+        return self.placement_stats("items", group_columns, set_number, tiers)
+
+    def item_placement_distribution(self, set_number=None, tiers=None):
+        return self.placement_distribution("items", "item_id", set_number, tiers)
 
     # bulk insert - czyli to co używamy podczas pobierania danych z api bo jest dużo szybciej
+    # columns loaded by the bulk methods, in the same order as values in the row tuples
+    BULK_COLUMNS = {
+        "matches": ("match_id", "game_datetime", "game_length", "map_id", "tft_set_number", "match_tier"),
+        "players": ("puuid", "match_id", "placement", "level", "gold_left", "last_round", "players_eliminated",
+                    "time_eliminated", "total_damage", "companion_id", "tier", "division", "leaguePoints", "wins",
+                    "losses"),
+        "traits": ("match_id", "puuid", "trait_name", "num_units", "style", "tier_current", "tier_total"),
+        "units": ("match_id", "puuid", "character_id", "rarity", "tier"),
+        "items": ("match_id", "puuid", "character_id", "item_id"),
+    }
+
+    # executemany - one round-trip per row, kept for comparison (see BulkLoadBenchmark)
     def execute_bulk(self, sql, values):
-        self.ensure_connection()
-        with self.conn.cursor() as cursor:
+        with self.transaction() as cursor:
             cursor.executemany(sql, values)
-        self.conn.commit()
 
-    def add_matches_bulk(self, matches_list):
-        """Bulk insert matches"""
-        if not matches_list:
+    # execute_values - many rows in one INSERT ... VALUES statement, sql has to contain single %s placeholder
+    def execute_values_bulk(self, sql, values, page_size=1000):
+        with self.transaction() as cursor:
+            execute_values(cursor, sql, values, page_size=page_size)
+
+    """
+    COPY based bulk load - rows of every table are streamed with COPY FROM STDIN into a temporary staging table
+    (temp tables are not WAL-logged and have no constraints, so COPY is as cheap as possible) and then moved with
+    a single INSERT ... SELECT ... ON CONFLICT DO NOTHING. All tables are loaded in one transaction, in the order 
+    of the dict (matches before players before traits, units and items - foreign keys).
+    Returns number of rows inserted into each table (without duplicates).
+    """
+
+    """
+    Inserts from the staging tables for the compact layout (compact_schema.sql). Staging tables have the columns of
+    the views, names are added to the dictionaries (only missing ones - so no sequence values are burned by
+    conflicts) and rows are inserted with the surrogate keys. In the partitioned layout (partitioned_schema.sql)
+    the compact tables have also the partition key (tft_set_number, game_datetime of the match) - {partition_key}.
+    """
+
+    COMPACT_INSERTS = {
+        "players": (
+            """INSERT INTO puuids (puuid) SELECT DISTINCT s.puuid FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM puuids k WHERE k.puuid = s.puuid) ON CONFLICT DO NOTHING""",
+            """INSERT INTO players_compact (match_sid, puuid_sid{partition_key}, placement, level,
+                gold_left, last_round, players_eliminated, time_eliminated, total_damage, companion_id, tier, division,
+                leaguePoints, wins, losses)
+            SELECT m.match_sid, k.puuid_sid{partition_values}, s.placement, s.level, s.gold_left,
+                s.last_round, s.players_eliminated, s.time_eliminated, s.total_damage, s.companion_id, s.tier,
+                s.division, s.leaguePoints, s.wins, s.losses
+            FROM {staging} s
+                JOIN matches m ON m.match_id = s.match_id
+                JOIN puuids k ON k.puuid = s.puuid
+            ON CONFLICT DO NOTHING""",
+        ),
+        "traits": (
+            """INSERT INTO trait_names (trait_name) SELECT DISTINCT s.trait_name FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM trait_names n WHERE n.trait_name = s.trait_name) ON CONFLICT DO NOTHING""",
+            """INSERT INTO traits_compact (match_sid, puuid_sid{partition_key}, trait_sid, num_units,
+                style, tier_current, tier_total)
+            SELECT m.match_sid, k.puuid_sid{partition_values}, n.trait_sid, s.num_units, s.style,
+                s.tier_current, s.tier_total
+            FROM {staging} s
+                JOIN matches m ON m.match_id = s.match_id
+                JOIN puuids k ON k.puuid = s.puuid
+                JOIN trait_names n ON n.trait_name = s.trait_name
+            ON CONFLICT DO NOTHING""",
+        ),
+        "units": (
+            """INSERT INTO unit_names (character_id) SELECT DISTINCT s.character_id FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM unit_names n WHERE n.character_id = s.character_id)
+            ON CONFLICT DO NOTHING""",
+            """INSERT INTO units_compact (match_sid, puuid_sid{partition_key}, unit_sid, rarity, tier)
+            SELECT m.match_sid, k.puuid_sid{partition_values}, n.unit_sid, s.rarity, s.tier
+            FROM {staging} s
+                JOIN matches m ON m.match_id = s.match_id
+                JOIN puuids k ON k.puuid = s.puuid
+                JOIN unit_names n ON n.character_id = s.character_id
+            ON CONFLICT DO NOTHING""",
+        ),
+        "items": (
+            """INSERT INTO unit_names (character_id) SELECT DISTINCT s.character_id FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM unit_names n WHERE n.character_id = s.character_id)
+            ON CONFLICT DO NOTHING""",
+            """INSERT INTO item_names (item_id) SELECT DISTINCT s.item_id FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM item_names i WHERE i.item_id = s.item_id) ON CONFLICT DO NOTHING""",
+            """INSERT INTO items_compact (match_sid, puuid_sid{partition_key}, unit_sid, item_sid)
+            SELECT m.match_sid, k.puuid_sid{partition_values}, n.unit_sid, i.item_sid
+            FROM {staging} s
+                JOIN matches m ON m.match_id = s.match_id
+                JOIN puuids k ON k.puuid = s.puuid
+                JOIN unit_names n ON n.character_id = s.character_id
+                JOIN item_names i ON i.item_id = s.item_id
+            ON CONFLICT DO NOTHING""",
+        ),
+    }
+
+    def copy_bulk(self, tables, refresh_rollups=False):
+        inserted = {}
+        if self.partitioned_schema and tables.get("matches"):
+            tables = self.partitionable(tables)
+            self.create_partitions(tables["matches"])
+        with self.transaction() as cursor:
+
+            # rows of stored matches (add_players_bulk, ...) - the rollup of every table is updated with matches
+            # which had no rows in it yet
+            fresh_match_ids = {}
+            if refresh_rollups and not tables.get("matches"):
+                fresh_match_ids = {table: self.matches_without_rows(cursor, table, rows)
+                                   for table, rows in tables.items() if rows}
+
+            new_match_ids = []
+            for table, rows in tables.items():
+                if not rows:
+                    continue
+                if table == "matches":
+                    new_match_ids = self.copy_table(cursor, table, rows, returning="match_id")
+                    inserted[table] = len(new_match_ids)
+                else:
+                    inserted[table] = self.copy_table(cursor, table, rows)
+
+            # summary tables are updated in the same transaction, only with matches inserted just now
+            if refresh_rollups and new_match_ids:
+                self.refresh_rollups(cursor, new_match_ids)
+            for table, match_ids in fresh_match_ids.items():
+                if match_ids:
+                    self.refresh_rollups(cursor, match_ids, sources=(table,))
+        return inserted
+
+    @staticmethod
+    def matches_without_rows(cursor, table, rows):
+        """Matches of the rows which have no rows in the table yet"""
+        # match_id is the second column of players, the first one of the other tables
+        match_ids = list({row[1 if table == "players" else 0] for row in rows})
+        cursor.execute(f"SELECT DISTINCT match_id FROM {table} WHERE match_id = ANY(%s)", (match_ids,))
+        stored = {row[0] for row in cursor.fetchall()}
+        if stored:
+            logger.warning(f"Rows of {len(stored)} matches added to {table} are not counted in the rollups "
+                           f"(the matches had {table} rows already) - run rebuild_rollups")
+        return [match_id for match_id in match_ids if match_id not in stored]
+
+    @staticmethod
+    def partitionable(tables):
+        """
+        Rows of the matches which can be routed to a partition - matches without tft_set_number or game_datetime
+        (and all their rows) are rejected with a warning, instead of failing the whole batch
+        """
+        columns = DatabaseConnection.BULK_COLUMNS["matches"]
+        datetime_index, set_index = columns.index("game_datetime"), columns.index("tft_set_number")
+        rejected = {row[0] for row in tables["matches"] if row[datetime_index] is None or row[set_index] is None}
+        if not rejected:
+            return tables
+
+        logger.warning(f"Skipping {len(rejected)} matches without tft_set_number / game_datetime (no partition): "
+                       f"{', '.join(sorted(rejected))}")
+        # match_id is the second column of players, the first one of the other tables
+        return {table: [row for row in rows if row[1 if table == "players" else 0] not in rejected]
+                for table, rows in tables.items()}
+
+    @staticmethod
+    def partition_keys(match_rows):
+        """(set, first day of the month) of the match rows"""
+        columns = DatabaseConnection.BULK_COLUMNS["matches"]
+        datetime_index, set_index = columns.index("game_datetime"), columns.index("tft_set_number")
+        partitions = set()
+        for row in match_rows:
+            # rows without the partition key are rejected by partitionable
+            if row[datetime_index] is None or row[set_index] is None:
+                continue
+            game_date = datetime.fromtimestamp(row[datetime_index] / 1000, tz=timezone.utc).date()
+            partitions.add((row[set_index], game_date.replace(day=1)))
+        return partitions
+
+    def create_partitions(self, match_rows):
+        """
+        Creating partitions (set / month) for the match rows, which don't have them yet - in a short transaction
+        of its own, serialized by an advisory lock (concurrent writers - BatchSink threads, ParallelRebuild loaders -
+        creating the same partition at once would fail), before the transaction writing the rows.
+        Partitions created by this process are remembered, so most batches don't need the transaction at all.
+        """
+        if not self.partitioned_schema or not match_rows:
             return
+        partitions = self.partition_keys(match_rows) - self.known_partitions
+        if not partitions:
+            return
+        with self.transaction() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('ensure_match_partitions'))")
+            for set_number, month_start in sorted(partitions):
+                cursor.execute("SELECT ensure_match_partitions(%s, %s)", (set_number, month_start))
+        self.known_partitions.update(partitions)
 
-        sql = """
-        INSERT INTO matches (match_id, game_datetime, game_length, map_id, tft_set_number) 
-        VALUES (%s, %s, %s, %s, %s) ON CONFLICT (match_id) DO NOTHING
+    def detach_set(self, set_number, drop=False):
+        """
+        Detaching all partitions of one set (e.g. a set which is not analyzed anymore) - the partitions stay in the
+        database as standalone tables (e.g. for pg_dump), with drop=True they are removed to free the space.
+        Rollups of the set are not changed.
+        """
+        if not self.partitioned_schema:
+            raise Exception("detach_set needs the partitioned layout (partitioned_schema.sql)")
+
+        self.known_partitions = {partition for partition in self.known_partitions if partition[0] != set_number}
+        with self.transaction() as cursor:
+            # children first - they reference the partitions of players / matches
+            for table in ("items_compact", "units_compact", "traits_compact", "players_compact", "matches"):
+                partition = f"{table}_s{int(set_number)}"
+                cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (partition,))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+
+                # detached table keeps its foreign keys to the parents, which would block detaching of the next ones
+                cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+                               (partition,))
+                for (constraint,) in cursor.fetchall():
+                    cursor.execute(f'ALTER TABLE {partition} DROP CONSTRAINT "{constraint}"')
+                if drop:
+                    cursor.execute(f"DROP TABLE {partition} CASCADE")
+        logger.info(f"Set {set_number} {'dropped' if drop else 'detached'}")
+
+    def copy_table(self, cursor, table, rows, columns=None, returning=None):
+        """Returns number of inserted rows, or list of values of the returning column of inserted rows"""
+        columns = ", ".join(columns or self.BULK_COLUMNS[table])
+        staging = f"staging_{table}"
+
+        cursor.execute(f"CREATE TEMP TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA")
+        cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN", self.copy_buffer(rows))
+        sql = f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT DO NOTHING"
+        if self.compact_schema and table in self.COMPACT_INSERTS:
+            # new dictionary values first, then the rows with their keys
+            partition_key = ", tft_set_number, game_datetime" if self.partitioned_schema else ""
+            partition_values = ", m.tft_set_number, m.game_datetime" if self.partitioned_schema else ""
+            *dictionaries, sql = [statement.format(staging=staging, partition_key=partition_key,
+                                                   partition_values=partition_values)
+                                  for statement in self.COMPACT_INSERTS[table]]
+            for statement in dictionaries:
+                cursor.execute(statement)
+        if returning:
+            cursor.execute(sql + f" RETURNING {returning}")
+            inserted = [row[0] for row in cursor.fetchall()]
+        else:
+            cursor.execute(sql)
+            inserted = cursor.rowcount
+        cursor.execute(f"DROP TABLE {staging}")
+        return inserted
+
+    """
+    Rollups - summary tables keyed by (set, day, player tier, trait / unit / item) with counts and placement sums.
+    They are updated incrementally with rows of new matches only (see copy_bulk), so dashboards read a few thousand
+    rows instead of aggregating the raw tables.
+    """
+
+    ROLLUP_DAY = "(to_timestamp(m.game_datetime / 1000.0) AT TIME ZONE 'UTC')::date"
+
+    def refresh_rollups(self, cursor, match_ids, sources=("players", "traits", "units", "items")):
+        """Adding rows of the matches to the rollups - sources: raw tables to count (rollup_matches from players)"""
+        match_ids = list(match_ids)
+        if "traits" in sources:
+            cursor.execute(f"""
+                INSERT INTO rollup_traits AS r (tft_set_number, day, tier, trait_name, boards, active, maxed,
+                    placement_sum, top4, wins)
+                SELECT m.tft_set_number, {self.ROLLUP_DAY}, COALESCE(p.tier, 'UNRANKED'), t.trait_name, COUNT(*),
+                    SUM((t.tier_current > 0)::int), SUM((t.tier_current = t.tier_total)::int), SUM(p.placement),
+                    SUM((p.placement <= 4)::int), SUM((p.placement = 1)::int)
+                FROM traits t
+                    JOIN players p ON p.match_id = t.match_id AND p.puuid = t.puuid
+                    JOIN matches m ON m.match_id = t.match_id
+                WHERE t.match_id = ANY(%s)
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (tft_set_number, day, tier, trait_name) DO UPDATE SET
+                    boards = r.boards + EXCLUDED.boards, active = r.active + EXCLUDED.active,
+                    maxed = r.maxed + EXCLUDED.maxed, placement_sum = r.placement_sum + EXCLUDED.placement_sum,
+                    top4 = r.top4 + EXCLUDED.top4, wins = r.wins + EXCLUDED.wins""", (match_ids,))
+
+        if "units" in sources:
+            cursor.execute(f"""
+                INSERT INTO rollup_units AS r (tft_set_number, day, tier, character_id, rarity, boards, three_stars,
+                    placement_sum, top4, wins)
+                SELECT m.tft_set_number, {self.ROLLUP_DAY}, COALESCE(p.tier, 'UNRANKED'), t.character_id,
+                    MAX(t.rarity), COUNT(*), SUM((t.tier = 3)::int), SUM(p.placement), SUM((p.placement <= 4)::int),
+                    SUM((p.placement = 1)::int)
+                FROM units t
+                    JOIN players p ON p.match_id = t.match_id AND p.puuid = t.puuid
+                    JOIN matches m ON m.match_id = t.match_id
+                WHERE t.match_id = ANY(%s)
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (tft_set_number, day, tier, character_id) DO UPDATE SET
+                    rarity = EXCLUDED.rarity, boards = r.boards + EXCLUDED.boards,
+                    three_stars = r.three_stars + EXCLUDED.three_stars,
+                    placement_sum = r.placement_sum + EXCLUDED.placement_sum,
+                    top4 = r.top4 + EXCLUDED.top4, wins = r.wins + EXCLUDED.wins""", (match_ids,))
+
+        if "items" in sources:
+            cursor.execute(f"""
+                INSERT INTO rollup_items AS r (tft_set_number, day, tier, item_id, uses, placement_sum, top4, wins)
+                SELECT m.tft_set_number, {self.ROLLUP_DAY}, COALESCE(p.tier, 'UNRANKED'), t.item_id, COUNT(*),
+                    SUM(p.placement), SUM((p.placement <= 4)::int), SUM((p.placement = 1)::int)
+                FROM items t
+                    JOIN players p ON p.match_id = t.match_id AND p.puuid = t.puuid
+                    JOIN matches m ON m.match_id = t.match_id
+                WHERE t.match_id = ANY(%s)
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (tft_set_number, day, tier, item_id) DO UPDATE SET
+                    uses = r.uses + EXCLUDED.uses, placement_sum = r.placement_sum + EXCLUDED.placement_sum,
+                    top4 = r.top4 + EXCLUDED.top4, wins = r.wins + EXCLUDED.wins""", (match_ids,))
+
+        if "players" in sources:
+            cursor.execute(f"""
+                INSERT INTO rollup_matches AS r (tft_set_number, day, tier, players, game_length_sum)
+                SELECT m.tft_set_number, {self.ROLLUP_DAY}, COALESCE(p.tier, 'UNRANKED'), COUNT(*), SUM(m.game_length)
+                FROM players p
+                    JOIN matches m ON m.match_id = p.match_id
+                WHERE p.match_id = ANY(%s)
+                GROUP BY 1, 2, 3
+                ON CONFLICT (tft_set_number, day, tier) DO UPDATE SET
+                    players = r.players + EXCLUDED.players,
+                    game_length_sum = r.game_length_sum + EXCLUDED.game_length_sum""", (match_ids,))
+
+    def rebuild_rollups(self, chunk_size=5000):
+        """Recomputing all rollups from the raw tables (first use, or after deleting data)"""
+        match_ids = [row[0] for row in self.query("SELECT match_id FROM matches")]
+        with self.transaction() as cursor:
+            cursor.execute("TRUNCATE rollup_traits, rollup_units, rollup_items, rollup_matches")
+            for start in range(0, len(match_ids), chunk_size):
+                self.refresh_rollups(cursor, match_ids[start:start + chunk_size])
+        logger.info(f"Rollups rebuilt from {len(match_ids)} matches")
+
+    def get_rollup(self, name, set_number=None, tiers=None, start_day=None, end_day=None, by_tier=False):
+        """
+        Reading one of the rollups (traits, units, items, matches) summed over the selected days and tiers.
+        by_tier - keep tiers as separate rows (e.g. average game length per tier).
         """
+        keys = {"traits": ["trait_name"], "units": ["character_id"], "items": ["item_id"], "matches": []}[name]
+        sums = {
+            "traits": ["boards", "active", "maxed", "placement_sum", "top4", "wins"],
+            "units": ["boards", "three_stars", "placement_sum", "top4", "wins"],
+            "items": ["uses", "placement_sum", "top4", "wins"],
+            "matches": ["players", "game_length_sum"],
+        }[name]
+        group = (["tier"] if by_tier else []) + keys
+
+        conditions = ["TRUE"]
+        params = []
+        for condition, value in (("tft_set_number = %s", set_number), ("tier = ANY(%s)", list(tiers or []) or None),
+                                 ("day >= %s", start_day), ("day <= %s", end_day)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        select = ", ".join(group + [f"SUM({column}) AS {column}" for column in sums])
+        sql = f"SELECT {select} FROM rollup_{name} WHERE {' AND '.join(conditions)}"
+        if group:
+            sql += f" GROUP BY {', '.join(group)}"
+        frame = self.query_frame(sql, params)
+
+        count = sums[0]
+        if name == "matches":
+            frame["avg_game_length"] = frame["game_length_sum"] / frame["players"]
+        else:
+            frame["avg_placement"] = frame["placement_sum"] / frame[count]
+            frame["top4_rate"] = frame["top4"] / frame[count]
+            frame["win_rate"] = frame["wins"] / frame[count]
+        return frame
+
+    @staticmethod
+    def copy_buffer(rows):
+        """Rows encoded in the COPY text format (tab separated, NULL as \\N)"""
+        def encode(value):
+            if value is None:
+                return "\\N"
+            return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+                    .replace("\n", "\\n").replace("\r", "\\r"))
+
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(encode(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        return buffer
 
-        values = [
+    # conversion of row dicts (single row methods, add_match_data_bulk) into row tuples (order of BULK_COLUMNS)
+    @staticmethod
+    def matches_to_rows(matches_list):
+        return [
             (
                 match['match_id'],
                 match['game_datetime'],
                 match['game_length'],
                 match['mapId'],
-                match['tft_set_number']
+                match['tft_set_number'],
+                match.get('match_tier')
             )
             for match in matches_list
         ]
 
-        try:
-            self.execute_bulk(sql, values)
-            print(f"Successfully inserted {len(values)} matches in bulk.")
-        except Exception as e:
-            print(f'Error during bulk insert of matches: {e}')
-            self.conn.rollback()
-            raise e
-
-    def add_players_bulk(self, players_list):
-        """Bulk insert players"""
-        if not players_list:
-            return
-
-        sql = """
-        INSERT INTO players(puuid, match_id, placement, level, gold_left, last_round,
-            players_eliminated, time_eliminated, total_damage, companion_id, tier, division, leaguePoints, wins, losses) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
-        ON CONFLICT (puuid, match_id) DO NOTHING
-        """
-
-        values = [
+    @staticmethod
+    def players_to_rows(players_list):
+        return [
             (
                 player['puuid'],
                 player['match_id'],
@@ -303,22 +972,9 @@ class DatabaseConnection:
             for player in players_list
         ]
 
-        try:
-            self.execute_bulk(sql, values)
-            print(f"Successfully inserted {len(values)} players in bulk.")
-        except Exception as e:
-            print(f'Error during bulk insert of players: {e}')
-            self.conn.rollback()
-            raise e
-
-    def add_traits_bulk(self, traits_list):
-        sql = """
-        INSERT INTO traits (match_id, puuid, trait_name, num_units, style, tier_current, tier_total)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (match_id, puuid, trait_name) DO NOTHING
-        """
-
-        values = [
+    @staticmethod
+    def traits_to_rows(traits_list):
+        return [
             (
                 trait['match_id'],
                 trait['puuid'],
@@ -331,25 +987,9 @@ class DatabaseConnection:
             for trait in traits_list
         ]
 
-        try:
-            self.execute_bulk(sql, values)
-            print(f"Successfully inserted {len(values)} traits in bulk.")
-        except Exception as e:
-            print(f'Error during bulk insert of traits: {e}')
-            self.conn.rollback()
-
-    def add_units_bulk(self, units_list):
-        """Bulk insert units"""
-        if not units_list:
-            return
-
-        sql = """
-        INSERT INTO units (match_id, puuid, character_id, rarity, tier)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT ON CONSTRAINT unique_unit DO NOTHING
-        """
-
-        values = [
+    @staticmethod
+    def units_to_rows(units_list):
+        return [
             (
                 unit['match_id'],
                 unit['puuid'],
@@ -360,12 +1000,70 @@ class DatabaseConnection:
             for unit in units_list
         ]
 
+    @staticmethod
+    def items_to_rows(items_list):
+        return [
+            (
+                item['match_id'],
+                item['puuid'],
+                item['character_id'],
+                item['item_id']
+            )
+            for item in items_list
+        ]
+
+    """
+    Bulk inserts of one table - the tables go in the order of the foreign keys (matches, players, then traits, units
+    and items) and every table updates its rollup with the matches which had no rows in it yet, so all rows of
+    a match should be added to a table in one call (the rest is counted only by rebuild_rollups).
+    New matches have no rows to count yet, add_matches_bulk doesn't touch the rollups.
+    """
+
+    def add_matches_bulk(self, matches_list):
+        """Bulk insert matches"""
+        if not matches_list:
+            return
+
         try:
-            self.execute_bulk(sql, values)
-            print(f"Successfully inserted {len(values)} units in bulk.")
+            inserted = self.copy_bulk({"matches": self.matches_to_rows(matches_list)})
+            logger.info(f"Successfully inserted {inserted.get('matches', 0)} of {len(matches_list)} matches in bulk.")
         except Exception as e:
-            print(f'Error during bulk insert of units: {e}')
-            self.conn.rollback()
+            logger.error(f'Error during bulk insert of matches: {e}')
+            raise e
+
+    def add_players_bulk(self, players_list):
+        """Bulk insert players"""
+        if not players_list:
+            return
+
+        try:
+            inserted = self.copy_bulk({"players": self.players_to_rows(players_list)}, refresh_rollups=True)
+            logger.info(f"Successfully inserted {inserted.get('players', 0)} of {len(players_list)} players in bulk.")
+        except Exception as e:
+            logger.error(f'Error during bulk insert of players: {e}')
+            raise e
+
+    def add_traits_bulk(self, traits_list):
+        """Bulk insert traits"""
+        if not traits_list:
+            return
+
+        try:
+            inserted = self.copy_bulk({"traits": self.traits_to_rows(traits_list)}, refresh_rollups=True)
+            logger.info(f"Successfully inserted {inserted.get('traits', 0)} of {len(traits_list)} traits in bulk.")
+        except Exception as e:
+            logger.error(f'Error during bulk insert of traits: {e}')
+
+    def add_units_bulk(self, units_list):
+        """Bulk insert units"""
+        if not units_list:
+            return
+
+        try:
+            inserted = self.copy_bulk({"units": self.units_to_rows(units_list)}, refresh_rollups=True)
+            logger.info(f"Successfully inserted {inserted.get('units', 0)} of {len(units_list)} units in bulk.")
+        except Exception as e:
+            logger.error(f'Error during bulk insert of units: {e}')
             raise e
 
     def add_items_bulk(self, items_list):
@@ -373,28 +1071,34 @@ class DatabaseConnection:
         if not items_list:
             return
 
-        sql = """
-        INSERT INTO items (match_id, puuid, character_id, item_id)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT ON CONSTRAINT unique_item DO NOTHING
-        """
+        try:
+            inserted = self.copy_bulk({"items": self.items_to_rows(items_list)}, refresh_rollups=True)
+            logger.info(f"Successfully inserted {inserted.get('items', 0)} of {len(items_list)} items in bulk.")
+        except Exception as e:
+            logger.error(f'Error during bulk insert of items: {e}')
+            raise e
 
-        values = [
-            (
-                item['match_id'],
-                item['puuid'],
-                item['character_id'],
-                item['item_id']
-            )
-            for item in items_list
-        ]
+    def add_match_data_bulk(self, matches_data):
+        """Bulk insert of row dicts (table name -> list of dicts) - converted into tuples for add_match_rows_bulk"""
+        return self.add_match_rows_bulk({
+            "matches": self.matches_to_rows(matches_data["matches"]),
+            "players": self.players_to_rows(matches_data["players"]),
+            "traits": self.traits_to_rows(matches_data["traits"]),
+            "units": self.units_to_rows(matches_data["units"]),
+            "items": self.items_to_rows(matches_data["items"]),
+        })
 
+    def add_match_rows_bulk(self, tables):
+        """
+        Bulk insert of everything returned by DataPipeline.analyze_matches (row tuples, see MatchFlattener) - all 
+        tables and rollups of the new matches in one transaction
+        """
         try:
-            self.execute_bulk(sql, values)
-            print(f"Successfully inserted {len(values)} items in bulk.")
+            inserted = self.copy_bulk(tables, refresh_rollups=True)
+            logger.info(f"Successfully inserted in bulk: {inserted}")
+            return inserted
         except Exception as e:
-            print(f'Error during bulk insert of items: {e}')
-            self.conn.rollback()
+            logger.error(f'Error during bulk insert of match data: {e}')
             raise e
 
     #
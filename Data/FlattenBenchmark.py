@@ -0,0 +1,101 @@
+"""
+Micro-benchmark of parsing + flattening of match payloads (no network, no database) - throughput of one core.
+
+Payloads are read into memory first (recorded matches from a MatchArchive or synthetic ones of MockRiotServer),
+then every payload is turned into row tuples (DataPipeline.build_match_rows) with:
+- json - json.loads into dicts, converted into the typed structs (MatchFlattener.from_dict), flattened,
+- typed - raw bytes decoded straight into the typed structs (MatchFlattener.decode), flattened - the pipeline path.
+Time is cpu time of the process, so matches/s is per core. Every run is appended to benchmarks/flatten.jsonl.
+
+    python -m Data.FlattenBenchmark --matches 2000
+    python -m Data.FlattenBenchmark --archive archive --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from Data.MatchFlattener import MatchFlattener
+from Data.PipelineBenchmark import REPO_PATH, current_commit
+
+MODES = {
+    "json": lambda raw: MatchFlattener.from_dict(json.loads(raw)),
+    "typed": MatchFlattener.decode,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--archive", help="MatchArchive path - recorded matches instead of synthetic ones")
+    parser.add_argument("--matches", type=int, default=1000, help="number of payloads (all of the archive if 0)")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the payloads, the best one is reported")
+    parser.add_argument("--results", default=os.path.join(REPO_PATH, "benchmarks", "flatten.jsonl"))
+    return parser.parse_args(argv)
+
+
+def load_payloads(args):
+    if args.archive:
+        from Data.MatchArchive import MatchArchive
+        payloads = []
+        for match_id, raw in MatchArchive(args.archive).iter_matches(raw=True):
+            payloads.append((match_id, raw))
+            if len(payloads) == args.matches:
+                break
+        return payloads
+
+    from Data.MockRiotServer import MockRiotServer
+    mock_server = MockRiotServer()
+    # only the payload generator is used, the server is never started
+    mock_server.server.server_close()
+    return [(f"EUN1_{3_700_000_000 + i}", json.dumps(mock_server.match_details(f"EUN1_{3_700_000_000 + i}"))
+             .encode("utf-8")) for i in range(args.matches or 1000)]
+
+
+def measure(payloads, decode, repeat):
+    """Best of repeat passes: (cpu seconds, rows)"""
+    best = None
+    for _ in range(repeat):
+        rows = 0
+        started = time.process_time()
+        for match_id, raw in payloads:
+            match_rows = MatchFlattener.rows(match_id, decode(raw), {})
+            rows += sum(len(table_rows) for table_rows in match_rows.values())
+        elapsed = time.process_time() - started
+        best = min(best or (elapsed, rows), (elapsed, rows))
+    return best
+
+
+def run(args):
+    payloads = load_payloads(args)
+
+    results = {}
+    for mode, decode in MODES.items():
+        seconds, rows = measure(payloads, decode, args.repeat)
+        results[mode] = {
+            "cpu_seconds": round(seconds, 3),
+            "matches_per_second": round(len(payloads) / seconds, 1) if seconds else None,
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        }
+
+    return {
+        "commit": current_commit(),
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key != "results"},
+        "matches": len(payloads),
+        "payload_mb": round(sum(len(raw) for _, raw in payloads) / 1024 / 1024, 1),
+        "modes": results,
+    }
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    result = run(arguments)
+
+    os.makedirs(os.path.dirname(arguments.results), exist_ok=True)
+    with open(arguments.results, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps(result) + "\n")
+
+    print(f"{result['matches']} matches, {result['payload_mb']} MB of json")
+    for mode, numbers in result["modes"].items():
+        print(f"{mode:>8}: {numbers['matches_per_second']} matches/s, {numbers['rows_per_second']} rows/s per core")
@@ -0,0 +1,111 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LeagueCache:
+    """
+    Cache of league lookups (/tft/league/v1/by-puuid) keyed by puuid.
+
+    The same players show up in many matches of a tier crawl, so most of the lookups are repeats.
+    Entries live in two layers:
+    - in-memory LRU (OrderedDict) limited to max_memory_entries,
+    - local SQLite file, so the cache survives between runs.
+    Every entry expires after ttl_seconds - ranks change, so we don't want to keep them forever.
+    """
+
+    MISSING = object()
+
+    def __init__(self, path, ttl_seconds=24 * 60 * 60, max_memory_entries=50000, clock=time.time):
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # puuid -> (expires_at, player_info)
+        self.memory = OrderedDict()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS league_cache (
+                puuid TEXT PRIMARY KEY,
+                player_info TEXT,
+                expires_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, puuid, include_expired=False):
+        """
+        Returns cached league entry of the player or LeagueCache.MISSING if there is no valid entry.
+        include_expired - used when we rebuild tables offline and an old rank is better than no rank at all.
+        """
+        now = 0 if include_expired else self.clock()
+        with self.lock:
+            cached = self.memory.get(puuid)
+            if cached is not None:
+                expires_at, player_info = cached
+                if expires_at > now:
+                    self.memory.move_to_end(puuid)
+                    self.memory_hits += 1
+                    return player_info
+                del self.memory[puuid]
+
+            row = self.conn.execute("SELECT player_info, expires_at FROM league_cache WHERE puuid = ?",
+                                    (puuid,)).fetchone()
+            if row is not None and row[1] > now:
+                player_info = json.loads(row[0])
+                self._remember(puuid, row[1], player_info)
+                self.disk_hits += 1
+                return player_info
+
+            self.misses += 1
+            return self.MISSING
+
+    def set(self, puuid, player_info):
+        expires_at = self.clock() + self.ttl_seconds
+        with self.lock:
+            self._remember(puuid, expires_at, player_info)
+            self.conn.execute("INSERT OR REPLACE INTO league_cache (puuid, player_info, expires_at) VALUES (?, ?, ?)",
+                              (puuid, json.dumps(player_info), expires_at))
+            self.conn.commit()
+
+    def _remember(self, puuid, expires_at, player_info):
+        self.memory[puuid] = (expires_at, player_info)
+        self.memory.move_to_end(puuid)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def purge_expired(self):
+        """Deleting expired entries from the SQLite file."""
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM league_cache WHERE expires_at <= ?", (self.clock(),)).rowcount
+            self.conn.commit()
+        return deleted
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
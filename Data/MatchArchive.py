@@ -0,0 +1,173 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+
+class MatchArchive:
+    """
+    Local, immutable archive of raw match payloads (json returned by /tft/match/v1/matches/{match_id}).
+
+    Finished matches never change, so every payload we download is kept here and the api is never asked for it again.
+    Layout of the archive directory:
+    - segments/YYYY-MM-DD.seg - one append-only segment per day, every record is
+      [4 bytes length][32 bytes sha256][zlib compressed json],
+    - index.sqlite - content address (sha256) -> (segment, offset, length) and match_id -> sha256.
+    The address is sha256 of the stored bytes - parsed payloads are stored as canonical json, raw api responses
+    as they were received (not re-encoded), so the same bytes are stored only once (a finished match is always
+    returned with the same body). The index can be rebuilt by scanning the segments.
+    """
+
+    HEADER = struct.Struct('>I32s')
+
+    def __init__(self, path, compression_level=6):
+        self.path = path
+        self.segments_path = os.path.join(path, "segments")
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        os.makedirs(self.segments_path, exist_ok=True)
+
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 BLOB PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS matches (
+                match_id TEXT PRIMARY KEY,
+                sha256 BLOB NOT NULL
+            );""")
+        self.conn.commit()
+
+    def __contains__(self, match_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM matches WHERE match_id = ?", (match_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+
+    @staticmethod
+    def encode(match_data):
+        """Canonical json - the same payload always gives the same bytes (and the same address)."""
+        return json.dumps(match_data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+    def put(self, match_id, match_data):
+        """
+        Appending payload to today's segment (if we don't have the same content already).
+        match_data - parsed json (stored as canonical json) or the raw bytes of the api response (stored and
+        addressed as they are, without re-encoding - the same content in a different byte form is stored twice).
+        """
+        raw = match_data if isinstance(match_data, bytes) else self.encode(match_data)
+        digest = hashlib.sha256(raw).digest()
+
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM matches WHERE match_id = ?", (match_id,)).fetchone():
+                return False
+
+            if not self.conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (digest,)).fetchone():
+                compressed = zlib.compress(raw, self.compression_level)
+                segment = datetime.date.today().isoformat() + ".seg"
+                with open(os.path.join(self.segments_path, segment), "ab") as f:
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                    f.write(self.HEADER.pack(len(compressed), digest))
+                    f.write(compressed)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.conn.execute("INSERT INTO blobs (sha256, segment, offset, length) VALUES (?, ?, ?, ?)",
+                                  (digest, segment, offset + self.HEADER.size, len(compressed)))
+
+            self.conn.execute("INSERT INTO matches (match_id, sha256) VALUES (?, ?)", (match_id, digest))
+            self.conn.commit()
+        return True
+
+    def get(self, match_id):
+        """Returns archived payload of the match or None."""
+        raw = self.get_raw(match_id)
+        return json.loads(raw) if raw is not None else None
+
+    def get_raw(self, match_id):
+        """Returns archived payload of the match as json bytes (not parsed) or None."""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT b.segment, b.offset, b.length FROM matches m JOIN blobs b ON b.sha256 = m.sha256
+                WHERE m.match_id = ?""", (match_id,)).fetchone()
+        if row is None:
+            return None
+
+        segment, offset, length = row
+        with open(os.path.join(self.segments_path, segment), "rb") as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def match_ids(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT match_id FROM matches")]
+
+    def iter_matches(self, match_ids=None, raw=False):
+        """
+        Yields (match_id, match_data) in the order they are stored on disk (segment by segment, sequential reads).
+        match_ids - optional subset of matches to read.
+        raw - match_data as json bytes, not parsed.
+        """
+        rows = self.locations()
+        wanted = set(match_ids) if match_ids is not None else None
+        current_segment, f = None, None
+        try:
+            for match_id, segment, offset, length in rows:
+                if wanted is not None and match_id not in wanted:
+                    continue
+                if segment != current_segment:
+                    if f:
+                        f.close()
+                    f = open(os.path.join(self.segments_path, segment), "rb")
+                    current_segment = segment
+                f.seek(offset)
+                payload = zlib.decompress(f.read(length))
+                yield match_id, payload if raw else json.loads(payload)
+        finally:
+            if f:
+                f.close()
+
+    def locations(self):
+        """(match_id, segment, offset, length) of all matches in the order they are stored on disk"""
+        with self.lock:
+            return self.conn.execute("""
+                SELECT m.match_id, b.segment, b.offset, b.length FROM matches m JOIN blobs b ON b.sha256 = m.sha256
+                ORDER BY b.segment, b.offset""").fetchall()
+
+    def rebuild_index(self):
+        """Recreating index.sqlite from the segments (match_id is taken from payload metadata)."""
+        with self.lock:
+            self.conn.execute("DELETE FROM matches")
+            self.conn.execute("DELETE FROM blobs")
+            for segment in sorted(os.listdir(self.segments_path)):
+                with open(os.path.join(self.segments_path, segment), "rb") as f:
+                    while True:
+                        header = f.read(self.HEADER.size)
+                        if len(header) < self.HEADER.size:
+                            break
+                        length, digest = self.HEADER.unpack(header)
+                        offset = f.tell()
+                        compressed = f.read(length)
+                        if len(compressed) < length:
+                            # torn write at the end of the segment
+                            break
+                        match_data = json.loads(zlib.decompress(compressed))
+                        self.conn.execute("INSERT OR IGNORE INTO blobs (sha256, segment, offset, length) "
+                                          "VALUES (?, ?, ?, ?)", (digest, segment, offset, length))
+                        self.conn.execute("INSERT OR IGNORE INTO matches (match_id, sha256) VALUES (?, ?)",
+                                          (match_data['metadata']['match_id'], digest))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
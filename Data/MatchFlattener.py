@@ -0,0 +1,121 @@
+import msgspec
+
+from Data.MatchTier import MatchTier
+
+
+# typed structs of the /tft/match/v1/matches/{match_id} payload - only the fields we store, the rest of the json
+# (augments, missions, gameCreation, ...) is skipped by the decoder without creating any python object
+class Companion(msgspec.Struct):
+    content_ID: str | None = None
+
+
+class Trait(msgspec.Struct):
+    name: str | None = None
+    num_units: int | None = None
+    style: int | None = None
+    tier_current: int | None = None
+    tier_total: int | None = None
+
+
+class Unit(msgspec.Struct):
+    character_id: str | None = None
+    itemNames: list[str] = []
+    rarity: int | None = None
+    tier: int | None = None
+
+
+class Participant(msgspec.Struct):
+    puuid: str | None = None
+    placement: int | None = None
+    level: int | None = None
+    gold_left: int | None = None
+    last_round: int | None = None
+    players_eliminated: int | None = None
+    time_eliminated: float | None = None
+    total_damage_to_players: int | None = None
+    companion: Companion | None = None
+    traits: list[Trait] = []
+    units: list[Unit] = []
+
+
+class Info(msgspec.Struct):
+    game_datetime: int | None = None
+    game_length: float | None = None
+    mapId: int | None = None
+    tft_set_number: int | None = None
+    participants: list[Participant] = []
+
+
+class Metadata(msgspec.Struct):
+    match_id: str | None = None
+
+
+class Match(msgspec.Struct):
+    info: Info
+    metadata: Metadata | None = None
+
+
+class MatchFlattener:
+    """
+    Match payload -> row tuples of matches, players, traits, units and items (order of
+    DatabaseConnection.BULK_COLUMNS), ready for COPY without any intermediate dict per row.
+
+    decode parses the raw bytes of the api response (or of the archive) straight into the typed structs above,
+    from_dict converts already parsed json (e.g. a payload replayed by MockRiotServer). rows flattens one match,
+    players_info - ranked data of the participants (puuid -> league entry), downloaded by the caller.
+    """
+
+    decoder = msgspec.json.Decoder(Match)
+
+    @classmethod
+    def decode(cls, raw):
+        return cls.decoder.decode(raw)
+
+    @staticmethod
+    def from_dict(match_data):
+        return msgspec.convert(match_data, Match)
+
+    @staticmethod
+    def puuids(match):
+        """Participants of the match without bots"""
+        return [player.puuid for player in match.info.participants if player.puuid and player.puuid != "BOT"]
+
+    @staticmethod
+    def rows(match_id, match, players_info):
+        info = match.info
+        players, traits, units, items = [], [], [], []
+
+        for player in info.participants:
+            puuid = player.puuid
+            if not puuid or puuid == "BOT":
+                continue
+
+            # ranking info if available, otherwise default values
+            league = players_info.get(puuid)
+            if isinstance(league, dict) and 'tier' in league and 'rank' in league:
+                rank = (league['tier'], league['rank'], league.get('leaguePoints', 0), league.get('wins', 0),
+                        league.get('losses', 0))
+            else:
+                rank = ("UNRANKED", "NONE", 0, 0, 0)
+
+            players.append((puuid, match_id, player.placement, player.level, player.gold_left, player.last_round,
+                            player.players_eliminated, player.time_eliminated, player.total_damage_to_players,
+                            player.companion.content_ID if player.companion else None) + rank)
+            # traits / units without a name (incomplete payloads) are skipped instead of failing the whole match
+            traits.extend((match_id, puuid, trait.name, trait.num_units, trait.style, trait.tier_current,
+                           trait.tier_total) for trait in player.traits if trait.name is not None)
+            for unit in player.units:
+                if unit.character_id is None:
+                    continue
+                units.append((match_id, puuid, unit.character_id, unit.rarity, unit.tier))
+                items.extend((match_id, puuid, unit.character_id, item_name) for item_name in unit.itemNames)
+
+        # computed once here, so the analyses don't have to recompute it from the players table
+        match_tier = MatchTier.for_players(player[10] for player in players)
+        return {
+            "matches": [(match_id, info.game_datetime, info.game_length, info.mapId, info.tft_set_number, match_tier)],
+            "players": players,
+            "traits": traits,
+            "units": units,
+            "items": items
+        }
@@ -0,0 +1,64 @@
+import pandas as pd
+
+
+class MatchTier:
+    """
+    Tier of a match - the most common tier among its players (IRON..DIAMOND only, UNRANKED and MASTER+ players
+    are not counted). When several tiers have the same number of players the lowest one is chosen.
+    Match without any counted player has no tier (None).
+
+    The same rule in three forms:
+    - for_players - one match at ingest (DataPipeline.build_match_rows stores it in matches.match_tier),
+    - assign - all matches of a players DataFrame at once (grouped, no loop over matches),
+    - SQL - one query for matches already stored in the database (DatabaseConnection.backfill_match_tiers).
+    """
+
+    TIER_HIERARCHY = {
+        "IRON": 0,
+        "BRONZE": 1,
+        "SILVER": 2,
+        "GOLD": 3,
+        "PLATINUM": 4,
+        "EMERALD": 5,
+        "DIAMOND": 6
+    }
+
+    # match_id -> match tier of all matches with at least one counted player
+    SQL = """
+        SELECT DISTINCT ON (match_id) match_id, tier AS match_tier
+        FROM players
+        WHERE tier IN ('IRON', 'BRONZE', 'SILVER', 'GOLD', 'PLATINUM', 'EMERALD', 'DIAMOND')
+        GROUP BY match_id, tier
+        ORDER BY match_id, COUNT(*) DESC,
+            array_position(ARRAY['IRON', 'BRONZE', 'SILVER', 'GOLD', 'PLATINUM', 'EMERALD', 'DIAMOND'], tier::text)"""
+
+    @classmethod
+    def for_players(cls, tiers):
+        """Tier of one match from the tiers of its players"""
+        counts = {}
+        for tier in tiers:
+            if tier in cls.TIER_HIERARCHY:
+                counts[tier] = counts.get(tier, 0) + 1
+        if not counts:
+            return None
+
+        # more players first, then lower tier
+        return min(counts, key=lambda tier: (-counts[tier], cls.TIER_HIERARCHY[tier]))
+
+    @classmethod
+    def assign(cls, players):
+        """
+        Tiers of all matches of a players DataFrame (columns match_id and tier).
+        Returns DataFrame match_id, match_tier with one row per match (match_tier NaN if it can't be established).
+        """
+        counts = (players[players['tier'].isin(cls.TIER_HIERARCHY.keys())]
+                  .groupby(['match_id', 'tier'], observed=True).size().reset_index(name='player_count'))
+        counts['tier_rank'] = counts['tier'].map(cls.TIER_HIERARCHY)
+
+        # after sorting the first row of every match is its dominant tier (tie -> lowest rank)
+        dominant = (counts.sort_values(['match_id', 'player_count', 'tier_rank'], ascending=[True, False, True])
+                    .drop_duplicates('match_id')[['match_id', 'tier']]
+                    .rename(columns={'tier': 'match_tier'}))
+
+        all_matches = pd.DataFrame({'match_id': players['match_id'].unique()})
+        return all_matches.merge(dominant, on='match_id', how='left')
@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class MatchWatermarks:
+    """
+    High-water marks of the crawled players (local SQLite file) - the newest match_id seen in the match list of every
+    puuid, its game_datetime and the time of the listing.
+
+    With a watermark the match list is requested only from startTime (game_datetime of the watermark match) and paged
+    until the watermark match shows up, so a periodic refresh costs one call per player plus one per page of games
+    played since the last crawl, instead of re-listing the same matches_per_player recent matches every time.
+    If game_datetime of the watermark match isn't known (e.g. it was already stored and never downloaded again),
+    startTime is not sent and only the paging stops at the watermark match.
+    overlap_seconds - startTime is moved back by it, the listing has to reach the watermark match itself
+    (matches show up in the list only after the game is over and the api filters by the start of the game).
+
+    A listing moves the watermark only once all its matches are stored (listed -> saved, called by BatchSink
+    on_flush and for matches which were already in the database). Until then, or if the crawl dies or some match
+    can't be downloaded, the old watermark stays, so no match below the watermark is left unsaved.
+    """
+
+    def __init__(self, path, overlap_seconds=60 * 60, clock=time.time):
+        self.overlap_seconds = overlap_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                puuid TEXT PRIMARY KEY,
+                match_id TEXT NOT NULL,
+                game_datetime INTEGER,
+                listed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS watermarks_match ON watermarks (match_id);""")
+        self.conn.commit()
+
+        # listings waiting for their matches: puuid -> (newest match_id, match ids not saved yet, listed_at)
+        self.pending = {}
+        # match_id -> puuids of the pending listings with the match
+        self.waiting = {}
+        # match_id -> game_datetime of the listed matches flattened in this run
+        self.datetimes = {}
+
+        self.incremental_listings = 0
+        self.full_listings = 0
+        self.pages = 0
+
+    def get(self, puuid):
+        """(match_id, startTime in epoch seconds or None) of the player or None if the player was never listed"""
+        with self.lock:
+            row = self.conn.execute("SELECT match_id, game_datetime FROM watermarks WHERE puuid = ?",
+                                    (puuid,)).fetchone()
+        if row is None:
+            return None
+
+        match_id, game_datetime = row
+        if game_datetime is None:
+            return match_id, None
+        return match_id, max(int(game_datetime / 1000 - self.overlap_seconds), 0)
+
+    def listed(self, puuid, match_ids, listed_at=None):
+        """Match ids of one listing (newest first) - the watermark moves to the first one once all of them are saved"""
+        if not match_ids:
+            return
+        with self.lock:
+            self.pending[puuid] = (match_ids[0], set(match_ids), self.clock() if listed_at is None else listed_at)
+            for match_id in match_ids:
+                self.waiting.setdefault(match_id, set()).add(puuid)
+
+    def observe_match(self, match_id, game_datetime):
+        """game_datetime (ms, as in match details) of a flattened match, stored with the watermark pointing at it"""
+        with self.lock:
+            if match_id in self.waiting and game_datetime is not None:
+                self.datetimes[match_id] = game_datetime
+
+    def saved(self, match_ids):
+        """Matches stored in the database (or already there) - players with all listed matches saved move forward"""
+        advanced = []
+        with self.lock:
+            for match_id in match_ids:
+                for puuid in self.waiting.pop(match_id, ()):
+                    pending = self.pending.get(puuid)
+                    if pending is None:
+                        continue
+                    newest, unsaved, listed_at = pending
+                    unsaved.discard(match_id)
+                    if not unsaved:
+                        del self.pending[puuid]
+                        advanced.append((puuid, newest, self.datetimes.get(newest), listed_at))
+
+            if advanced:
+                self.conn.executemany("""
+                    INSERT INTO watermarks (puuid, match_id, game_datetime, listed_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (puuid) DO UPDATE SET match_id = excluded.match_id,
+                        game_datetime = excluded.game_datetime, listed_at = excluded.listed_at""", advanced)
+                self.conn.commit()
+        return len(advanced)
+
+    def observe_listing(self, incremental, pages):
+        with self.lock:
+            if incremental:
+                self.incremental_listings += 1
+            else:
+                self.full_listings += 1
+            self.pages += pages
+
+    def stats(self):
+        with self.lock:
+            players = self.conn.execute("SELECT COUNT(*) FROM watermarks").fetchone()[0]
+            listings = self.incremental_listings + self.full_listings
+            return {
+                "players": players,
+                "pending_players": len(self.pending),
+                "incremental_listings": self.incremental_listings,
+                "full_listings": self.full_listings,
+                "pages_per_listing": round(self.pages / listings, 2) if listings else 0.0,
+            }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, start_http_server
+
+
+class PipelineMetrics:
+    """
+    Metrics of one crawl: api requests (per endpoint - method of the RateLimiter, e.g. tft/match/v1/matches),
+    latency, received bytes, 429 responses, time spent waiting for the rate limiter, parsed matches and rows written
+    to the database per table.
+
+    Every instance has its own prometheus registry, which can be:
+    - scraped - serve(port) starts the prometheus text endpoint (http://localhost:port/metrics),
+    - dumped as json - write_snapshot(path) once, or start_snapshots(path, interval) every interval seconds,
+    - summarized at the end of the run - summary() (totals and per second rates).
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    WRITE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.started = time.time()
+        self.snapshot_thread = None
+        self.snapshot_stop = threading.Event()
+
+        self.requests = Counter("tft_api_requests", "Api responses", ["endpoint", "status"],
+                                registry=self.registry)
+        self.latency = Histogram("tft_api_request_seconds", "Api request latency", ["endpoint"],
+                                 buckets=self.LATENCY_BUCKETS, registry=self.registry)
+        self.received_bytes = Counter("tft_api_received_bytes", "Bytes of api responses", ["endpoint"],
+                                      registry=self.registry)
+        self.rate_limited = Counter("tft_api_rate_limited", "429 responses", ["endpoint"],
+                                    registry=self.registry)
+        self.throttled = Counter("tft_api_throttled_seconds", "Time spent waiting for the rate limiter",
+                                 ["endpoint"], registry=self.registry)
+        self.parsed_matches = Counter("tft_parsed_matches", "Matches turned into table rows",
+                                      registry=self.registry)
+        self.written_rows = Counter("tft_db_written_rows", "Rows sent to the database", ["table"],
+                                    registry=self.registry)
+        self.write_latency = Histogram("tft_db_write_seconds", "Duration of one batch write",
+                                       buckets=self.WRITE_BUCKETS, registry=self.registry)
+
+    # recording - called by DataPipeline, AsyncFetcher and BatchSink
+    def observe_request(self, endpoint, status, seconds, received_bytes):
+        self.requests.labels(endpoint, str(status)).inc()
+        self.latency.labels(endpoint).observe(seconds)
+        self.received_bytes.labels(endpoint).inc(received_bytes)
+        if status == 429:
+            self.rate_limited.labels(endpoint).inc()
+
+    def observe_throttle(self, endpoint, seconds):
+        if seconds > 0:
+            self.throttled.labels(endpoint).inc(seconds)
+
+    def observe_match(self):
+        self.parsed_matches.inc()
+
+    def observe_write(self, rows_per_table, seconds):
+        for table, rows in rows_per_table.items():
+            self.written_rows.labels(table).inc(rows)
+        self.write_latency.observe(seconds)
+
+    # exposing
+    def serve(self, port):
+        start_http_server(port, registry=self.registry)
+
+    def prometheus_text(self):
+        return generate_latest(self.registry).decode("utf-8")
+
+    def snapshot(self):
+        """All samples as {metric name: [{"labels": {...}, "value": ...}]}"""
+        samples = {}
+        for metric in self.registry.collect():
+            for sample in metric.samples:
+                samples.setdefault(sample.name, []).append({"labels": sample.labels, "value": sample.value})
+        return {"timestamp": time.time(), "elapsed_seconds": time.time() - self.started, "samples": samples}
+
+    def write_snapshot(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # written next to the target and renamed, so a reader never sees half of the file
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def start_snapshots(self, path, interval=30):
+        def run():
+            while not self.snapshot_stop.wait(interval):
+                self.write_snapshot(path)
+
+        self.snapshot_stop.clear()
+        self.snapshot_thread = threading.Thread(target=run, name="metrics-snapshots", daemon=True)
+        self.snapshot_thread.start()
+
+    def stop_snapshots(self, path=None):
+        self.snapshot_stop.set()
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+        # last snapshot with the final values
+        if path:
+            self.write_snapshot(path)
+
+    def summary(self):
+        """Report of the run: totals per endpoint / table and rates per second"""
+        elapsed = max(time.time() - self.started, 1e-9)
+        samples = self.snapshot()["samples"]
+
+        def total(name, label=None):
+            values = {}
+            for sample in samples.get(name, []):
+                key = sample["labels"].get(label) if label else None
+                values[key] = values.get(key, 0) + sample["value"]
+            return values if label else values.get(None, 0)
+
+        requests = total("tft_api_requests_total", "endpoint")
+        latency_sum = total("tft_api_request_seconds_sum", "endpoint")
+        parsed_matches = total("tft_parsed_matches_total")
+        written_rows = total("tft_db_written_rows_total", "table")
+
+        return {
+            "elapsed_seconds": round(elapsed, 1),
+            "requests": requests,
+            "mean_latency_seconds": {endpoint: round(latency_sum.get(endpoint, 0) / count, 3)
+                                     for endpoint, count in requests.items() if count},
+            "received_bytes": total("tft_api_received_bytes_total", "endpoint"),
+            "rate_limited_responses": total("tft_api_rate_limited_total", "endpoint"),
+            "throttled_seconds": {endpoint: round(seconds, 1) for endpoint, seconds
+                                  in total("tft_api_throttled_seconds_total", "endpoint").items()},
+            "parsed_matches": parsed_matches,
+            "matches_per_second": round(parsed_matches / elapsed, 3),
+            "written_rows": written_rows,
+            "rows_per_second": {table: round(rows / elapsed, 1) for table, rows in written_rows.items()},
+            "db_write_seconds": round(total("tft_db_write_seconds_sum"), 1),
+        }
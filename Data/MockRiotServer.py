@@ -0,0 +1,332 @@
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from Data.RateLimiter import RateLimiter
+
+
+class MockRiotServer:
+    """
+    Local stand-in for the TFT endpoints of the Riot API, so the pipeline can be measured without the real key.
+
+    Serves league entries, league by puuid, match ids by puuid and match details. Payloads are synthetic (the same
+    request always gets the same payload) or, for match details, replayed from a MatchArchive of recorded matches.
+    Rate limits are enforced like Riot does it (sliding windows per application and per method, X-App-Rate-Limit /
+    X-Method-Rate-Limit headers with counts, 429 with Retry-After and X-Rate-Limit-Type), latency and faults
+    (spurious 429, 5xx) can be injected.
+
+        python -m Data.MockRiotServer 8080
+        RIOT_EUNE_BASE_URL=http://127.0.0.1:8080 RIOT_EUROPE_BASE_URL=http://127.0.0.1:8080 python -m Data.DataUploader
+    """
+
+    TRAITS = [f"TFT14_Trait{i}" for i in range(28)]
+    CHAMPIONS = [f"TFT14_Champion{i}" for i in range(60)]
+    ITEMS = [f"TFT_Item_Item{i}" for i in range(45)]
+    TIERS = ["IRON", "BRONZE", "SILVER", "GOLD", "PLATINUM", "EMERALD", "DIAMOND"]
+
+    def __init__(self, host="127.0.0.1", port=0, app_limits="20:1,100:120", method_limits="500:10",
+                 latency=0.0, jitter=0.0, throttle_rate=0.0, error_rate=0.0, entries_per_page=200, league_pages=3,
+                 matches_per_tier=5000, history_size=200, archive=None, seed=0):
+        self.app_limits = RateLimiter.parse_limits(app_limits)
+        self.method_limits = RateLimiter.parse_limits(method_limits)
+        # seconds added to every response: latency +- jitter
+        self.latency = latency
+        self.jitter = jitter
+        # share of the requests answered with a spurious 429 (X-Rate-Limit-Type: service) / 503
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.entries_per_page = entries_per_page
+        # pages of league entries per division, the next page is empty
+        self.league_pages = league_pages
+        self.matches_per_tier = matches_per_tier
+        # matches listed for one player (newest first)
+        self.history_size = history_size
+        # optional MatchArchive - recorded match payloads are replayed instead of the synthetic ones
+        self.archive = archive
+        self.archived_ids = archive.match_ids() if archive else []
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        # bucket key -> timestamps of the requests counted in it
+        self.history = {}
+        # (method, status) -> number of responses
+        self.responses = {}
+
+        self.server = ThreadingHTTPServer((host, port), self.handler_class(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # default listen backlog is 5 - connections of concurrent clients over it are dropped and reach the server
+        # a second later (SYN retry), which looks like the client broke the rate limit
+        self.server.request_queue_size = 128
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-riot-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self):
+        """Number of responses: {"requests": total, "by_method": {method: {status: count}}}"""
+        with self.lock:
+            by_method = {}
+            for (method, status), count in self.responses.items():
+                by_method.setdefault(method, {})[status] = count
+            return {"requests": sum(self.responses.values()), "by_method": by_method}
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, headers, body = server.respond(self.path)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json;charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    # rate limits
+    def count_request(self, method):
+        """Counts the request in the application and method windows. Returns (headers, 429 headers or None)."""
+        with self.lock:
+            now = time.monotonic()
+            buckets = ((("app",), self.app_limits, "X-App-Rate-Limit", "application"),
+                       (("method", method), self.method_limits, "X-Method-Rate-Limit", "method"))
+
+            # riot doesn't count the request which was rejected
+            for key, limits, _, limit_type in buckets:
+                history = self.history.setdefault(key, deque())
+                longest_window = max((window for _, window in limits), default=0)
+                while history and history[0] <= now - longest_window:
+                    history.popleft()
+                for max_requests, window in limits:
+                    in_window = [timestamp for timestamp in history if timestamp > now - window]
+                    if len(in_window) >= max_requests:
+                        retry_after = in_window[-max_requests] + window - now
+                        return {}, {"Retry-After": str(max(1, math.ceil(retry_after))),
+                                    "X-Rate-Limit-Type": limit_type}
+
+            headers = {}
+            for key, limits, prefix, _ in buckets:
+                history = self.history[key]
+                history.append(now)
+                headers[prefix] = ",".join(f"{count}:{window}" for count, window in limits)
+                headers[prefix + "-Count"] = ",".join(
+                    f"{sum(1 for timestamp in history if timestamp > now - window)}:{window}" for _, window in limits)
+            return headers, None
+
+    def respond(self, path):
+        url = urlsplit(path)
+        method = RateLimiter.method_from_url(path)
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter) if self.latency or self.jitter else 0
+        if delay > 0:
+            time.sleep(delay)
+
+        headers, limited = self.count_request(method)
+        status, body = 200, None
+        if limited:
+            status, headers, body = 429, limited, {"status": {"message": "Rate limit exceeded", "status_code": 429}}
+        else:
+            with self.lock:
+                fault = self.random.random()
+            if fault < self.throttle_rate:
+                status, headers = 429, {"X-Rate-Limit-Type": "service"}
+                body = {"status": {"message": "Rate limit exceeded", "status_code": 429}}
+            elif fault < self.throttle_rate + self.error_rate:
+                status, body = 503, {"status": {"message": "Service unavailable", "status_code": 503}}
+            else:
+                body = self.payload(url.path, parse_qs(url.query))
+                if body is None:
+                    status, body = 404, {"status": {"message": "Data not found", "status_code": 404}}
+
+        with self.lock:
+            self.responses[(method, status)] = self.responses.get((method, status), 0) + 1
+        return status, headers, body
+
+    # payloads
+    def payload(self, path, query):
+        segments = [segment for segment in path.split("/") if segment]
+        if segments[:4] == ["tft", "league", "v1", "entries"] and len(segments) == 6:
+            return self.league_entries(segments[4], segments[5], int(query.get("page", ["1"])[0]))
+        if segments[:4] == ["tft", "league", "v1", "by-puuid"] and len(segments) == 5:
+            return self.league_by_puuid(segments[4])
+        if segments[:5] == ["tft", "match", "v1", "matches", "by-puuid"] and len(segments) == 7:
+            start_time = int(query["startTime"][0]) if "startTime" in query else None
+            return self.match_ids(segments[5], int(query.get("start", ["0"])[0]), int(query.get("count", ["20"])[0]),
+                                  start_time)
+        if segments[:4] == ["tft", "match", "v1", "matches"] and len(segments) == 5:
+            return self.match_details(segments[4])
+        return None
+
+    def rng(self, *key):
+        # the same request always gets the same payload
+        return random.Random(f"{self.seed}:{':'.join(map(str, key))}")
+
+    @staticmethod
+    def puuid(*key):
+        # real puuids have 78 characters
+        return "-".join(map(str, ("mock",) + key)).ljust(78, "x")
+
+    def league_entries(self, tier, division, page):
+        if tier not in self.TIERS:
+            return None
+        if page > self.league_pages:
+            return []
+        rng = self.rng("entries", tier, division, page)
+        return [{
+            "puuid": self.puuid(tier, division, page, i),
+            "leagueId": f"mock-league-{tier}",
+            "queueType": "RANKED_TFT",
+            "tier": tier,
+            "rank": division,
+            "leaguePoints": rng.randint(0, 99),
+            "wins": rng.randint(0, 60),
+            "losses": rng.randint(0, 300),
+        } for i in range(self.entries_per_page)]
+
+    def league_by_puuid(self, puuid):
+        rng = self.rng("league", puuid)
+        parts = puuid.split("-")
+        tier = parts[1] if len(parts) > 1 and parts[1] in self.TIERS else rng.choice(self.TIERS)
+        return [{
+            "puuid": puuid,
+            "queueType": "RANKED_TFT",
+            "tier": tier,
+            "rank": rng.choice(["I", "II", "III", "IV"]),
+            "leaguePoints": rng.randint(0, 99),
+            "wins": rng.randint(0, 60),
+            "losses": rng.randint(0, 300),
+        }]
+
+    def match_ids(self, puuid, start, count, start_time=None):
+        rng = self.rng("ids", puuid)
+        if self.archived_ids:
+            ids = rng.sample(list(self.archived_ids), min(len(self.archived_ids), start + count))[start:]
+            return [match_id if isinstance(match_id, str) else f"EUN1_{match_id}" for match_id in ids]
+
+        # players of one tier share a pool of matches, so some matches are found more than once
+        parts = puuid.split("-")
+        tier_index = self.TIERS.index(parts[1]) if len(parts) > 1 and parts[1] in self.TIERS else 0
+        first = 3_700_000_000 + tier_index * self.matches_per_tier
+        pool = range(first, first + self.matches_per_tier)
+        # history of the player - from the newest match, like riot lists it, startTime (seconds) cuts older matches
+        history = sorted((f"EUN1_{match_id}" for match_id in rng.sample(pool, min(len(pool), self.history_size))),
+                         key=self.game_datetime, reverse=True)
+        if start_time is not None:
+            history = [match_id for match_id in history if self.game_datetime(match_id) >= start_time * 1000]
+        return history[start:start + count]
+
+    def game_datetime(self, match_id):
+        # time of the synthetic match, also used to order the match lists
+        return 1_740_000_000_000 + self.rng("match", match_id).randint(0, 120 * 24 * 3600) * 1000
+
+    def match_details(self, match_id):
+        if self.archive:
+            return self.archive.get(match_id)
+
+        rng = self.rng("match", match_id)
+        # participants are players of the league pages of the tier, the match was listed for
+        number = int(match_id.rsplit("_", 1)[-1]) if match_id.rsplit("_", 1)[-1].isdigit() else 0
+        tier = self.TIERS[min(max(number - 3_700_000_000, 0) // self.matches_per_tier, len(self.TIERS) - 1)]
+        divisions = ["I", "II", "III", "IV"]
+        population = len(divisions) * self.league_pages * self.entries_per_page
+        game_datetime = self.game_datetime(match_id)
+        placements = list(range(1, 9))
+        rng.shuffle(placements)
+
+        participants = []
+        for index, placement in zip(rng.sample(range(population), len(placements)), placements):
+            units = []
+            for character_id in rng.sample(self.CHAMPIONS, rng.randint(5, 10)):
+                units.append({
+                    "character_id": character_id,
+                    "itemNames": rng.sample(self.ITEMS, rng.choice([0, 0, 1, 2, 3])),
+                    "name": "",
+                    "rarity": rng.randint(0, 6),
+                    "tier": rng.choice([1, 1, 2, 2, 2, 3]),
+                })
+            participants.append({
+                "companion": {"content_ID": f"mock-companion-{rng.randint(0, 200)}", "item_ID": 1, "skin_ID": 1,
+                              "species": "PetMock"},
+                "gold_left": rng.randint(0, 60),
+                "last_round": rng.randint(15, 40),
+                "level": rng.randint(5, 10),
+                "placement": placement,
+                "players_eliminated": rng.randint(0, 3),
+                "puuid": self.puuid(tier, divisions[index // (self.league_pages * self.entries_per_page)],
+                                    index // self.entries_per_page % self.league_pages + 1,
+                                    index % self.entries_per_page),
+                "time_eliminated": rng.uniform(900, 2400),
+                "total_damage_to_players": rng.randint(0, 250),
+                "traits": [{
+                    "name": name,
+                    "num_units": rng.randint(1, 9),
+                    "style": rng.randint(0, 4),
+                    "tier_current": rng.randint(0, 4),
+                    "tier_total": 4,
+                } for name in rng.sample(self.TRAITS, rng.randint(6, 14))],
+                "units": units,
+            })
+
+        return {
+            "metadata": {"data_version": "5", "match_id": match_id,
+                         "participants": [participant["puuid"] for participant in participants]},
+            "info": {
+                "endOfGameResult": "GameComplete",
+                "gameCreation": game_datetime - 2_000_000,
+                "game_datetime": game_datetime,
+                "game_length": rng.uniform(1800, 2400),
+                "game_version": "Version 15.5",
+                "mapId": 22,
+                "participants": participants,
+                "queueId": 1100,
+                "tft_game_type": "standard",
+                "tft_set_core_name": "TFTSet14",
+                "tft_set_number": 14,
+            },
+        }
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    with MockRiotServer(port=port) as mock_server:
+        print(f"Mock Riot API on {mock_server.base_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
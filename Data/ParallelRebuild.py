@@ -0,0 +1,194 @@
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from Data.LeagueCache import LeagueCache
+from Data.MatchFlattener import MatchFlattener
+from Data.RankSnapshot import RankSnapshot
+
+logger = logging.getLogger(__name__)
+
+# rank snapshot and league cache of a worker process, opened once by init_worker
+worker_rank_snapshot = None
+worker_league_cache = None
+
+
+def init_worker(league_cache_path, rank_snapshot_path):
+    global worker_league_cache, worker_rank_snapshot
+    worker_league_cache = LeagueCache(league_cache_path) if league_cache_path else None
+    worker_rank_snapshot = RankSnapshot(rank_snapshot_path) if rank_snapshot_path else None
+
+
+def cached_rank(puuid):
+    """Rank from the rank snapshot or the league cache (even expired entries), None if the player is in neither"""
+    for source in (worker_rank_snapshot, worker_league_cache):
+        if source:
+            cached = source.get(puuid, include_expired=True)
+            if cached is not source.MISSING:
+                return cached
+    return None
+
+
+def read_shard(shard):
+    """Yields (match_id, raw json) of one shard - ("archive", segment path, [(match_id, offset, length)]) or
+    ("files", [path])"""
+    kind, *location = shard
+    if kind == "archive":
+        segment_path, records = location
+        with open(segment_path, "rb") as f:
+            for match_id, offset, length in records:
+                f.seek(offset)
+                yield match_id, zlib.decompress(f.read(length))
+    else:
+        for path in location[0]:
+            with open(path, "rb") as f:
+                yield None, f.read()
+
+
+def flatten_shard(shard):
+    """Runs in a worker process - rows of all matches of the shard (table name -> list of row tuples)"""
+    tables = {table: [] for table in ("matches", "players", "traits", "units", "items")}
+    for match_id, raw in read_shard(shard):
+        try:
+            match = MatchFlattener.decode(raw)
+        except Exception as e:
+            logger.warning(f"Skipping match {match_id}, payload can't be decoded: {e}")
+            continue
+        match_id = match_id or (match.metadata.match_id if match.metadata else None)
+        if not match_id:
+            continue
+
+        # players missing in the rank snapshot and the league cache are UNRANKED
+        players_info = {puuid: cached_rank(puuid) for puuid in MatchFlattener.puuids(match)}
+
+        for table, rows in MatchFlattener.rows(match_id, match, players_info).items():
+            tables[table].extend(rows)
+    return tables
+
+
+class ParallelRebuild:
+    """
+    Reloading the tables from raw match payloads without the api - e.g. after a change of what we extract
+    from a match. Every match has to be flattened again, which is cpu bound, so it's spread over processes:
+    - the payloads are split into shards (shard_size matches read sequentially from one archive segment, or files
+      of a directory with raw json responses),
+    - workers (ProcessPoolExecutor) decode and flatten the shards (MatchFlattener),
+    - loaders (threads with connections of the db pool) write the rows of every shard with COPY in its own transaction.
+    At most 2 shards per worker / loader are in flight, so memory doesn't depend on the size of the archive.
+    Rollups are rebuilt once at the end instead of being updated by every (concurrent) transaction.
+
+    Rows which already exist are skipped (ON CONFLICT DO NOTHING), so the tables should be emptied first when the
+    extracted values change.
+
+        python -m Data.ParallelRebuild --workers 8 --loaders 4
+        python -m Data.ParallelRebuild --directory /path/to/json/matches
+    """
+
+    def __init__(self, db, league_cache_path=None, rank_snapshot_path=None, workers=None, loaders=4, shard_size=200):
+        self.db = db
+        self.league_cache_path = league_cache_path
+        self.rank_snapshot_path = rank_snapshot_path
+        self.workers = workers or os.cpu_count()
+        self.loaders = loaders
+        self.shard_size = shard_size
+
+    def archive_shards(self, archive):
+        """Shards of consecutive records of one segment (sequential reads in the workers)"""
+        shards, records, current_segment = [], [], None
+        for match_id, segment, offset, length in archive.locations():
+            if records and (segment != current_segment or len(records) >= self.shard_size):
+                shards.append(("archive", os.path.join(archive.segments_path, current_segment), records))
+                records = []
+            current_segment = segment
+            records.append((match_id, offset, length))
+        if records:
+            shards.append(("archive", os.path.join(archive.segments_path, current_segment), records))
+        return shards
+
+    def directory_shards(self, path):
+        """Shards of *.json files (one match details response per file, match_id is taken from its metadata)"""
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path)
+                       for name in names if name.endswith(".json"))
+        return [("files", files[start:start + self.shard_size]) for start in range(0, len(files), self.shard_size)]
+
+    def load(self, tables):
+        # partitions are created by copy_bulk in a short transaction of their own, concurrent loaders don't race on them
+        return self.db.copy_bulk(tables)
+
+    def run(self, shards):
+        started = time.perf_counter()
+        rebuilt = {"shards": 0, "matches": 0, "rows": 0}
+
+        workers = ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                      initargs=(self.league_cache_path, self.rank_snapshot_path))
+        loaders = ThreadPoolExecutor(self.loaders, thread_name_prefix="rebuild-loader")
+        with workers, loaders:
+            pending_shards = iter(shards)
+            flattening, loading = set(), set()
+            while True:
+                for shard in pending_shards:
+                    flattening.add(workers.submit(flatten_shard, shard))
+                    if len(flattening) >= 2 * self.workers:
+                        break
+                if not flattening and not loading:
+                    break
+
+                done, _ = wait(flattening | loading, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in flattening:
+                        flattening.remove(future)
+                        tables = future.result()
+                        if tables["matches"]:
+                            loading.add(loaders.submit(self.load, tables))
+                            rebuilt["matches"] += len(tables["matches"])
+                            rebuilt["rows"] += sum(len(rows) for rows in tables.values())
+                    else:
+                        loading.remove(future)
+                        future.result()
+                        rebuilt["shards"] += 1
+
+                # loaders are slower than the workers - flattened shards wait in memory, so they are limited too
+                while len(loading) >= 2 * self.loaders:
+                    done, loading = wait(loading, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        rebuilt["shards"] += 1
+
+        self.db.rebuild_rollups()
+        elapsed = time.perf_counter() - started
+        logger.info(f"Rebuilt {rebuilt['matches']} matches ({rebuilt['rows']} rows) in {elapsed:.1f} s "
+                    f"- {rebuilt['matches'] / max(elapsed, 1e-9):.1f} matches/s with {self.workers} workers "
+                    f"and {self.loaders} loaders")
+        return rebuilt
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from Data.DatabaseConnection import DatabaseConnection
+    from Data.MatchArchive import MatchArchive
+
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+    parser = argparse.ArgumentParser(description="Reloading the tables from archived match payloads")
+    parser.add_argument("--archive", default=os.getenv('MATCH_ARCHIVE_PATH',
+                                                       os.path.join(repo_path, "archive", "matches")))
+    parser.add_argument("--directory", help="directory with raw json files instead of the archive")
+    parser.add_argument("--league-cache", default=os.getenv('LEAGUE_CACHE_PATH',
+                                                            os.path.join(repo_path, "cache", "league_cache.sqlite")))
+    parser.add_argument("--rank-snapshot", default=os.getenv('RANK_SNAPSHOT_PATH',
+                                                             os.path.join(repo_path, "cache", "rank_snapshot.sqlite")))
+    parser.add_argument("--workers", type=int, default=None, help="flattening processes (cpu count by default)")
+    parser.add_argument("--loaders", type=int, default=4, help="parallel database writers")
+    parser.add_argument("--shard-size", type=int, default=200, help="matches per shard")
+    args = parser.parse_args()
+
+    # one connection per loader (rollups are rebuilt after the loaders are finished)
+    database = DatabaseConnection(os.path.join(repo_path, ".env"), pool_size=args.loaders)
+    rebuild = ParallelRebuild(database, args.league_cache, args.rank_snapshot, args.workers, args.loaders,
+                              args.shard_size)
+    rebuild.run(rebuild.directory_shards(args.directory) if args.directory
+                else rebuild.archive_shards(MatchArchive(args.archive)))
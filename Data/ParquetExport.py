@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from Data.DatabaseConnection import DatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+
+class ParquetExporter:
+    """
+    Local columnar mirror of the database for the notebooks.
+
+    Every table is exported to a parquet dataset partitioned by set and month of the game
+    (<root>/<table>/tft_set_number=14/month=2025-05/...parquet). Export is incremental - only matches which are not
+    in the local mirror yet are pulled from the database (all rows of one match are written by one transaction
+    of add_match_rows_bulk, so a match is either complete or missing).
+    Every chunk of matches is written to <root>/_staging/<chunk>/ first and its files are moved to the datasets
+    only when all tables of the chunk are written (matches last), so an interrupted export never leaves rows
+    of a chunk in the mirror - a chunk written completely is moved by the next export, an incomplete one is
+    deleted and exported again.
+
+    Reading (load) is local and memory-mapped, with column projection and filters pushed down to the parquet files:
+        exporter.load("units", columns=["character_id", "tier"], filters=[("tft_set_number", "=", 14)])
+    """
+
+    TABLES = ("matches", "players", "traits", "units", "items")
+
+    SCHEMAS = {
+        "matches": pa.schema([("match_id", pa.string()), ("game_datetime", pa.int64()), ("game_length", pa.float64()),
+                              ("map_id", pa.int32()), ("match_tier", pa.string())]),
+        "players": pa.schema([("puuid", pa.string()), ("match_id", pa.string()), ("placement", pa.int16()),
+                              ("level", pa.int16()), ("gold_left", pa.int32()), ("last_round", pa.int16()),
+                              ("players_eliminated", pa.int16()), ("time_eliminated", pa.float64()),
+                              ("total_damage", pa.int32()), ("companion_id", pa.string()), ("tier", pa.string()),
+                              ("division", pa.string()), ("leaguePoints", pa.int32()), ("wins", pa.int32()),
+                              ("losses", pa.int32())]),
+        "traits": pa.schema([("match_id", pa.string()), ("puuid", pa.string()), ("trait_name", pa.string()),
+                             ("num_units", pa.int16()), ("style", pa.int16()), ("tier_current", pa.int16()),
+                             ("tier_total", pa.int16())]),
+        "units": pa.schema([("match_id", pa.string()), ("puuid", pa.string()), ("character_id", pa.string()),
+                            ("rarity", pa.int16()), ("tier", pa.int16())]),
+        "items": pa.schema([("match_id", pa.string()), ("puuid", pa.string()), ("character_id", pa.string()),
+                            ("item_id", pa.string())]),
+    }
+
+    PARTITIONING = ds.partitioning(pa.schema([("tft_set_number", pa.int32()), ("month", pa.string())]), flavor="hive")
+
+    def __init__(self, db, root):
+        self.db = db
+        self.root = root
+        # memory-mapped reads of local files
+        self.filesystem = pafs.LocalFileSystem(use_mmap=True)
+
+    def table_path(self, table):
+        return os.path.join(self.root, table)
+
+    def staging_path(self, basename=""):
+        return os.path.join(self.root, "_staging", basename)
+
+    def export(self, chunk_size=5000):
+        """Appending matches which are not in the local mirror yet. Returns number of exported matches."""
+        self.publish_staged()
+        exported = set()
+        if os.path.isdir(self.table_path("matches")):
+            exported = set(self.load("matches", columns=["match_id"], as_arrow=True).column("match_id").to_pylist())
+
+        all_match_ids = {row[0] for row in self.db.query("SELECT match_id FROM matches")}
+        new_match_ids = sorted(all_match_ids - exported)
+        logger.info(f"Exporting {len(new_match_ids)} new matches to {self.root}")
+
+        for start in range(0, len(new_match_ids), chunk_size):
+            chunk = new_match_ids[start:start + chunk_size]
+            basename = hashlib.sha1("\n".join(chunk).encode("utf-8")).hexdigest()[:16]
+            staging = self.staging_path(basename)
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            for table in self.TABLES:
+                self.export_table(table, chunk, basename, os.path.join(staging, table))
+            # all tables of the chunk are written - from now on the chunk is moved, not exported again
+            open(os.path.join(staging, "READY"), "w").close()
+            self.publish(staging)
+
+        return len(new_match_ids)
+
+    def publish(self, staging):
+        """Moving files of a written chunk to the datasets - matches last, a match counts as exported only then"""
+        for table in ("players", "traits", "units", "items", "matches"):
+            source = os.path.join(staging, table)
+            for directory, _, files in os.walk(source):
+                target = os.path.join(self.table_path(table), os.path.relpath(directory, source))
+                os.makedirs(target, exist_ok=True)
+                for file in files:
+                    os.replace(os.path.join(directory, file), os.path.join(target, file))
+        shutil.rmtree(staging)
+
+    def publish_staged(self):
+        """Chunks of an interrupted export - written ones are moved, the rest is deleted (exported again)"""
+        if not os.path.isdir(self.staging_path()):
+            return
+        for basename in sorted(os.listdir(self.staging_path())):
+            staging = self.staging_path(basename)
+            if os.path.exists(os.path.join(staging, "READY")):
+                logger.info(f"Moving chunk {basename} of an interrupted export")
+                self.publish(staging)
+            else:
+                shutil.rmtree(staging)
+
+    def export_table(self, table, match_ids, basename, path):
+        columns = self.SCHEMAS[table].names
+        select = ", ".join(f't.{column} AS "{column}"' for column in columns)
+        source = "matches t" if table == "matches" else f"{table} t JOIN matches m ON m.match_id = t.match_id"
+        match_table = "t" if table == "matches" else "m"
+
+        frame = self.db.query_frame(f"""
+            SELECT {select},
+                {match_table}.tft_set_number AS tft_set_number,
+                to_char(to_timestamp({match_table}.game_datetime / 1000.0) AT TIME ZONE 'UTC', 'YYYY-MM') AS month
+            FROM {source}
+            WHERE t.match_id = ANY(%s)""", (list(match_ids),))
+        if frame.empty:
+            return
+
+        schema = self.SCHEMAS[table]
+        for field in self.PARTITIONING.schema:
+            schema = schema.append(field)
+        ds.write_dataset(pa.Table.from_pandas(frame, schema=schema, preserve_index=False),
+                         path,
+                         format="parquet",
+                         partitioning=self.PARTITIONING,
+                         basename_template=f"{basename}-{{i}}.parquet",
+                         existing_data_behavior="overwrite_or_ignore")
+
+    def dataset(self, table):
+        return ds.dataset(self.table_path(table), format="parquet", partitioning=self.PARTITIONING,
+                          filesystem=self.filesystem)
+
+    def load(self, table, columns=None, filters=None, as_arrow=False):
+        """
+        Reading one table from the local mirror.
+        columns - list of columns to read (only those are read from disk),
+        filters - pyarrow expression or list of (column, op, value) tuples, e.g. [("tft_set_number", "=", 14)];
+                  filters on tft_set_number / month skip whole partitions.
+        """
+        if filters is not None and not isinstance(filters, ds.Expression):
+            filters = pq.filters_to_expression(filters)
+
+        arrow_table = self.dataset(table).to_table(columns=columns, filter=filters)
+        return arrow_table if as_arrow else arrow_table.to_pandas()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    dotenv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
+    default_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "exports", "parquet")
+    exporter = ParquetExporter(DatabaseConnection(dotenv_path), os.getenv('PARQUET_EXPORT_PATH', default_root))
+    exporter.export()
@@ -0,0 +1,181 @@
+"""
+End-to-end benchmark of the crawl without the real api key. Two MockRiotServers stand in for the platform (eun1) and
+the regional (europe) host, DataPipeline.collect_data_from_tier (the async version or crawl_tier_scheduled) downloads
+and parses the matches and, if BENCHMARK_DOTENV points at a local PostgreSQL, the rows are written with
+DatabaseConnection.add_match_rows_bulk (through BatchSink). League cache, rank snapshot, match watermarks and match
+archive are empty for every run.
+
+Every run is appended to benchmarks/pipeline.jsonl with the current commit (matches/hour, api calls per match,
+peak RSS, ...), so the numbers of different commits can be compared:
+
+    python -m Data.PipelineBenchmark --players 5 --matches 5 --latency 0.05
+    python -m Data.PipelineBenchmark --riot-limits --throttle-rate 0.01 --error-rate 0.01
+    BENCHMARK_DOTENV=/path/to/.env.local python -m Data.PipelineBenchmark --async
+    python -m Data.PipelineBenchmark --scheduled --riot-limits
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from Data.MockRiotServer import MockRiotServer
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tier", default="GOLD")
+    parser.add_argument("--players", type=int, default=5, help="players per division")
+    parser.add_argument("--matches", type=int, default=5, help="matches per player")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="collect_data_from_tier_async")
+    parser.add_argument("--scheduled", action="store_true", help="crawl_tier_scheduled (WorkScheduler)")
+    parser.add_argument("--riot-limits", action="store_true",
+                        help="development key limits (20:1,100:120) instead of practically unlimited ones")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of spurious 429 responses")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument("--archive", help="MatchArchive path - replays recorded matches instead of synthetic ones")
+    parser.add_argument("--results", default=os.path.join(REPO_PATH, "benchmarks", "pipeline.jsonl"))
+    return parser.parse_args(argv)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def current_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def consume(pipeline, args, sink):
+    if args.scheduled:
+        async def run_scheduled():
+            async for match_rows in pipeline.crawl_tier_scheduled(args.players, args.matches, args.tier):
+                sink.add(match_rows)
+
+        asyncio.run(run_scheduled())
+        return
+
+    if not args.use_async:
+        for match_rows in pipeline.collect_data_from_tier(args.players, args.matches, args.tier):
+            sink.add(match_rows)
+        return
+
+    async def run():
+        async for match_rows in pipeline.collect_data_from_tier_async(args.players, args.matches, args.tier):
+            sink.add(match_rows)
+
+    asyncio.run(run())
+
+
+class DiscardSink:
+    """Stand-in for BatchSink when there is no database - rows are only counted"""
+
+    def __init__(self):
+        self.flushed_matches = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def add(self, match_rows):
+        self.flushed_matches += 1
+
+
+def run(args):
+    limits = ("20:1,100:120", "500:10") if args.riot_limits else ("100000:1", "100000:1")
+    archive = None
+    if args.archive:
+        from Data.MatchArchive import MatchArchive
+        archive = MatchArchive(args.archive)
+
+    servers = [MockRiotServer(app_limits=limits[0], method_limits=limits[1], latency=args.latency,
+                              jitter=args.jitter, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                              archive=archive)
+               for _ in range(2)]
+
+    with tempfile.TemporaryDirectory() as local_state, servers[0], servers[1]:
+        os.environ.update({
+            "RIOT_GAMES_KEY": "mock",
+            "RIOT_EUNE_BASE_URL": servers[0].base_url,
+            "RIOT_EUROPE_BASE_URL": servers[1].base_url,
+            "LEAGUE_CACHE_PATH": os.path.join(local_state, "league_cache.sqlite"),
+            "RANK_SNAPSHOT_PATH": os.path.join(local_state, "rank_snapshot.sqlite"),
+            "MATCH_WATERMARKS_PATH": os.path.join(local_state, "match_watermarks.sqlite"),
+            "MATCH_ARCHIVE_PATH": os.path.join(local_state, "archive"),
+        })
+        # imported here - DataPipeline reads the environment when it's created
+        from Data.BatchSink import BatchSink
+        from Data.DataPipeline import DataPipeline
+
+        db = None
+        if os.getenv("BENCHMARK_DOTENV"):
+            from Data.DatabaseConnection import DatabaseConnection
+            db = DatabaseConnection(os.getenv("BENCHMARK_DOTENV"))
+        pipeline = DataPipeline(os.path.join(REPO_PATH, ".env"))
+
+        start = time.perf_counter()
+        with (BatchSink(db, metrics=pipeline.metrics) if db else DiscardSink()) as sink:
+            consume(pipeline, args, sink)
+        elapsed = time.perf_counter() - start
+
+        api_calls = sum(server.stats()["requests"] for server in servers)
+        summary = pipeline.metrics.summary()
+
+    matches = sink.flushed_matches
+    return {
+        "commit": current_commit(),
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key != "results"},
+        "database": db is not None,
+        "matches": matches,
+        "elapsed_seconds": round(elapsed, 2),
+        "matches_per_hour": round(matches / elapsed * 3600, 1) if elapsed else None,
+        "api_calls": api_calls,
+        "api_calls_per_match": round(api_calls / matches, 2) if matches else None,
+        "rate_limited_responses": sum(summary["rate_limited_responses"].values()),
+        "throttled_seconds": round(sum(summary["throttled_seconds"].values()), 1),
+        "written_rows": summary["written_rows"],
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def previous_result(path, config):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            result = json.loads(line)
+            if result.get("config") == config:
+                previous = result
+    return previous
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    result = run(arguments)
+    previous = previous_result(arguments.results, result["config"])
+
+    os.makedirs(os.path.dirname(arguments.results), exist_ok=True)
+    with open(arguments.results, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps(result) + "\n")
+
+    for name in ("matches", "elapsed_seconds", "matches_per_hour", "api_calls_per_match", "rate_limited_responses",
+                 "throttled_seconds", "peak_rss_mb"):
+        change = ""
+        if previous and previous.get(name) and result[name] is not None:
+            change = f"  ({(result[name] - previous[name]) / previous[name]:+.1%} vs {previous['commit']})"
+        print(f"{name:>24}: {result[name]}{change}")
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class RankSnapshot:
+    """
+    Ranks of all players of a tier / division (local SQLite file) - every page of /tft/league/v1/entries is stored
+    as puuid -> (tier, division, LP, wins, losses) with the time of the walk.
+
+    One walk over the league pages costs (players / ~200) calls and gives the rank of every player of the division,
+    so ranks of match participants are joined locally instead of one /league/v1/by-puuid call per participant
+    (up to 8 calls per match). Only players missing here (e.g. MASTER+, unranked, newly placed) are looked up.
+    A division is walked again when its last complete walk is older than ttl_seconds.
+    """
+
+    MISSING = object()
+
+    def __init__(self, path, ttl_seconds=24 * 60 * 60, clock=time.time):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ranks (
+                puuid TEXT PRIMARY KEY,
+                tier TEXT NOT NULL,
+                division TEXT NOT NULL,
+                league_points INTEGER,
+                wins INTEGER,
+                losses INTEGER,
+                page INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                taken_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ranks_division ON ranks (tier, division, page, position);
+            -- complete walks over all pages of a division
+            CREATE TABLE IF NOT EXISTS walks (
+                tier TEXT NOT NULL,
+                division TEXT NOT NULL,
+                taken_at REAL NOT NULL,
+                pages INTEGER NOT NULL,
+                players INTEGER NOT NULL,
+                PRIMARY KEY (tier, division)
+            );""")
+        self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def store_page(self, tier, division, page, entries, taken_at):
+        """Entries of one league page (as returned by the api), taken_at - start of the walk"""
+        rows = [(entry['puuid'], entry.get('tier', tier), entry.get('rank', division), entry.get('leaguePoints', 0),
+                 entry.get('wins', 0), entry.get('losses', 0), page, position, taken_at)
+                for position, entry in enumerate(entries) if entry.get('puuid')]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO ranks (puuid, tier, division, league_points, wins, losses, "
+                                  "page, position, taken_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+        return len(rows)
+
+    def complete(self, tier, division, taken_at, pages):
+        """Walk over all pages of the division is finished - players who left the division are dropped"""
+        with self.lock:
+            self.conn.execute("DELETE FROM ranks WHERE tier = ? AND division = ? AND taken_at < ?",
+                              (tier, division, taken_at))
+            players = self.conn.execute("SELECT COUNT(*) FROM ranks WHERE tier = ? AND division = ?",
+                                        (tier, division)).fetchone()[0]
+            self.conn.execute("INSERT OR REPLACE INTO walks (tier, division, taken_at, pages, players) "
+                              "VALUES (?, ?, ?, ?, ?)", (tier, division, taken_at, pages, players))
+            self.conn.commit()
+        return players
+
+    def is_fresh(self, tier, division):
+        with self.lock:
+            row = self.conn.execute("SELECT taken_at FROM walks WHERE tier = ? AND division = ?",
+                                    (tier, division)).fetchone()
+        return row is not None and row[0] + self.ttl_seconds > self.clock()
+
+    def players(self, tier, division, limit=None):
+        """Players of the division in the order of the league pages (format of DataPipeline.parse_league_entries)"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT puuid, wins, losses FROM ranks WHERE tier = ? AND division = ?
+                ORDER BY page, position LIMIT ?""", (tier, division, -1 if limit is None else limit)).fetchall()
+        return [{'puuid': puuid, 'tier': tier, 'division': division, 'wins': wins, 'losses': losses}
+                for puuid, wins, losses in rows]
+
+    def get(self, puuid, include_expired=False):
+        """
+        Rank of the player as a league entry (the same keys as /league/v1/by-puuid) or RankSnapshot.MISSING.
+        include_expired - used when we rebuild tables offline and an old rank is better than no rank at all.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT tier, division, league_points, wins, losses, taken_at FROM ranks "
+                                    "WHERE puuid = ?", (puuid,)).fetchone()
+            if row is None or (not include_expired and row[5] + self.ttl_seconds <= self.clock()):
+                self.misses += 1
+                return self.MISSING
+
+            self.hits += 1
+            tier, division, league_points, wins, losses, _ = row
+            return {'puuid': puuid, 'tier': tier, 'rank': division, 'leaguePoints': league_points, 'wins': wins,
+                    'losses': losses}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self.lock:
+            players, divisions = self.conn.execute(
+                "SELECT (SELECT COUNT(*) FROM ranks), (SELECT COUNT(*) FROM walks)").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "players": players,
+            "divisions": divisions,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
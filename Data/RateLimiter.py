@@ -0,0 +1,210 @@
+import math
+import threading
+import time
+from bisect import insort
+from urllib.parse import urlsplit
+
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter for the Riot API.
+
+    Riot enforces two kinds of limits per routing host (eun1, europe, ...):
+    - application limits - shared by every call made with our key to that host,
+    - method limits - separate budget for every endpoint.
+    Both are announced in the response headers, e.g.
+        X-App-Rate-Limit: 20:1,100:120         (20 calls per 1s, 100 calls per 120s)
+        X-App-Rate-Limit-Count: 3:1,57:120     (how many calls riot already counted)
+    so we start from the documented development key limits and then keep the limits and
+    counts in sync with whatever the server tells us.
+    """
+
+    DEFAULT_APP_LIMITS = "20:1,100:120"
+
+    def __init__(self, app_limits=DEFAULT_APP_LIMITS, margin=0.25, clock=time.monotonic, sleep=time.sleep):
+        self.default_app_limits = self.parse_limits(app_limits)
+        # small safety margin added to every window, riot counts a request when it arrives, not when we send it
+        self.margin = margin
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+        # bucket key -> list of (max_requests, window_seconds)
+        self.limits = {}
+        # bucket key -> sorted list of timestamps of requests made (or reserved) in that bucket
+        self.history = {}
+        # bucket key -> timestamp until which the bucket is blocked (Retry-After)
+        self.blocked_until = {}
+
+        # statistics
+        self.requests_made = {}
+        self.throttled_seconds = 0.0
+        self.retry_after_seconds = 0.0
+        self.rate_limited_responses = 0
+        self.first_request_time = None
+        self.last_request_time = None
+
+    @staticmethod
+    def parse_limits(header_value):
+        """'20:1,100:120' -> [(20, 1), (100, 120)]"""
+        limits = []
+        if not header_value:
+            return limits
+        for part in header_value.split(','):
+            count, window = part.strip().split(':')
+            limits.append((int(count), int(window)))
+        return limits
+
+    @staticmethod
+    def method_from_url(url):
+        """
+        Name of the riot method (endpoint) used for the method rate limit, without the path parameters, e.g.
+        /tft/league/v1/entries/GOLD/II -> tft/league/v1/entries
+        /tft/match/v1/matches/by-puuid/<puuid>/ids -> tft/match/v1/matches/by-puuid
+        """
+        segments = [segment for segment in urlsplit(url).path.split('/') if segment]
+        method = segments[:4]
+        if len(segments) > 4 and segments[4] == 'by-puuid':
+            method.append('by-puuid')
+        return '/'.join(method)
+
+    @staticmethod
+    def _app_key(host):
+        return 'app', host
+
+    @staticmethod
+    def _method_key(host, method):
+        return 'method', host, method
+
+    def _buckets(self, host, method):
+        app_key = self._app_key(host)
+        if app_key not in self.limits:
+            self.limits[app_key] = list(self.default_app_limits)
+        return app_key, self._method_key(host, method)
+
+    def reserve(self, host, method):
+        """
+        Reserves the earliest moment at which a request to this host/method fits into every window and returns
+        how many seconds the caller has to wait for it. Reservations are recorded immediately, so concurrent callers
+        (threads or asyncio tasks) never get the same slot.
+        """
+        with self.lock:
+            now = self.clock()
+            buckets = self._buckets(host, method)
+            start = self._earliest(buckets, now)
+
+            for key in buckets:
+                history = self.history.setdefault(key, [])
+                history.append(start)
+                self._prune(key, start)
+                self.requests_made[key] = self.requests_made.get(key, 0) + 1
+
+            if self.first_request_time is None:
+                self.first_request_time = start
+            self.last_request_time = start
+
+            wait = start - now
+            self.throttled_seconds += wait
+            return wait
+
+    def next_slot(self, host, method):
+        """Seconds until a request to this host/method would fit into every window - nothing is reserved."""
+        with self.lock:
+            now = self.clock()
+            return self._earliest(self._buckets(host, method), now) - now
+
+    def _earliest(self, buckets, now):
+        start = now
+        for key in buckets:
+            start = max(start, self.blocked_until.get(key, 0))
+            history = self.history.get(key, [])
+            if history:
+                start = max(start, history[-1])
+            for max_requests, window in self.limits.get(key, []):
+                if len(history) >= max_requests:
+                    start = max(start, history[-max_requests] + window + self.margin)
+        return start
+
+    def acquire(self, host, method):
+        """Blocking version of reserve - sleeps until the request can be sent."""
+        wait = self.reserve(host, method)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def _prune(self, key, now):
+        longest_window = max((window for _, window in self.limits.get(key, [])), default=0)
+        history = self.history[key]
+        cutoff = now - longest_window - self.margin
+        drop = 0
+        while drop < len(history) and history[drop] < cutoff:
+            drop += 1
+        if drop:
+            del history[:drop]
+
+    def update_from_headers(self, host, method, headers):
+        """Synchronizes limits and counts with X-App-Rate-Limit(-Count) and X-Method-Rate-Limit(-Count) headers."""
+        with self.lock:
+            app_key, method_key = self._buckets(host, method)
+            for key, prefix in ((app_key, 'X-App-Rate-Limit'), (method_key, 'X-Method-Rate-Limit')):
+                limits = self.parse_limits(headers.get(prefix))
+                if limits:
+                    self.limits[key] = limits
+
+                # if riot counted more calls than we did (e.g. another process uses the same key, or we just started)
+                # we add the missing calls to our history, so we don't exceed the limit
+                counts = self.parse_limits(headers.get(prefix + '-Count'))
+                if not counts:
+                    continue
+                now = self.clock()
+                history = self.history.setdefault(key, [])
+                for counted, window in counts:
+                    ours = sum(1 for timestamp in history if now - window < timestamp <= now)
+                    for _ in range(counted - ours):
+                        insort(history, now)
+
+    def on_rate_limited(self, host, method, headers, default_retry_after=1):
+        """
+        Handles 429 response - blocks the bucket named in X-Rate-Limit-Type for Retry-After seconds.
+        Returns the number of seconds the bucket is blocked for.
+        """
+        try:
+            retry_after = float(headers.get('Retry-After', default_retry_after))
+        except (TypeError, ValueError):
+            retry_after = default_retry_after
+
+        with self.lock:
+            app_key, method_key = self._buckets(host, method)
+            key = app_key if headers.get('X-Rate-Limit-Type') == 'application' else method_key
+            until = self.clock() + retry_after
+            self.blocked_until[key] = max(self.blocked_until.get(key, 0), until)
+            self.rate_limited_responses += 1
+            self.retry_after_seconds += retry_after
+        return retry_after
+
+    def theoretical_minimum_seconds(self):
+        """
+        Shortest time in which the requests made so far could have been sent without breaking any of the known
+        limits - n requests with limit (max_requests, window) need at least (ceil(n / max_requests) - 1) windows.
+        """
+        minimum = 0
+        for key, made in self.requests_made.items():
+            for max_requests, window in self.limits.get(key, []):
+                minimum = max(minimum, (math.ceil(made / max_requests) - 1) * window)
+        return minimum
+
+    def report(self):
+        """Summary of how much time we spent throttled compared with the theoretical minimum."""
+        elapsed = 0
+        if self.first_request_time is not None:
+            elapsed = self.last_request_time - self.first_request_time
+        total_requests = sum(made for key, made in self.requests_made.items() if key[0] == 'app')
+        return {
+            "requests": total_requests,
+            "requests_per_method": {key[2]: made for key, made in self.requests_made.items() if key[0] == 'method'},
+            "elapsed_seconds": round(elapsed, 3),
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "theoretical_minimum_seconds": round(self.theoretical_minimum_seconds(), 3),
+            "rate_limited_responses": self.rate_limited_responses,
+            "retry_after_seconds": round(self.retry_after_seconds, 3),
+        }
@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from urllib.parse import urlsplit
+
+from Data.RateLimiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class WorkItem:
+    """
+    One unit of work of the crawl - kind (league_page, id_list, match_detail, rank_lookup or a local step like rows
+    or league_walk),
+    key (unique within the kind), run - async callable doing the work, url - the api call it makes (host and method
+    of the rate limiter, None for local steps, which never wait for the budget) or a function returning it, called
+    when the item becomes ready (e.g. a lookup which can be answered locally once its dependencies are finished),
+    depends_on - items which have to be finished first (their result / error is available to run through
+    item.depends_on).
+    """
+
+    def __init__(self, kind, key, run, url=None, priority=None, depends_on=()):
+        self.kind = kind
+        self.key = key
+        self.run = run
+        self.url = url
+        self.host = None
+        self.method = None
+        self.priority = priority
+        self.depends_on = list(depends_on)
+        self.dependents = []
+        self.waiting_for = 0
+        self.attempts = 0
+        self.queued_at = None
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class WorkScheduler:
+    """
+    Priority scheduler of the crawl - one queue of typed work items with dependency edges, instead of strict phases
+    (all league pages, then all id lists, then all match details with their rank lookups).
+
+    An item is ready once all its dependencies are finished (successfully or not). Ready items wait in one heap per
+    endpoint (host, method of the rate limiter) and the dispatcher always starts the most important item among
+    the endpoints which have budget right now (RateLimiter.next_slot), so the europe host keeps downloading match
+    details while eun1 walks league pages, and a method out of its own limit doesn't block the others.
+    By default items which finish a match go first (rank lookups, then match details), then id lists and league
+    pages - matches are written continuously and nothing waits for a whole phase.
+
+        scheduler = WorkScheduler(pipeline.rate_limiter)
+        scheduler.add(WorkItem("league_page", ("GOLD", "I", 1), run, url=...))
+        async for item in scheduler.run():
+            ...
+
+    Items with the same kind and key are added once (add returns the existing item), e.g. a player of many matches
+    is looked up only once. A failed item is tried again max_attempts times, then it's finished with item.error.
+    report() - throughput of every kind (endpoint class): finished and failed items, items per second and
+    average time from ready to started.
+    """
+
+    PRIORITIES = {"rows": 0, "league_walk": 0, "rank_lookup": 1, "match_detail": 2, "id_list": 3, "league_page": 4}
+
+    def __init__(self, rate_limiter, max_in_flight=50, max_attempts=3, clock=time.monotonic):
+        self.rate_limiter = rate_limiter
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.clock = clock
+
+        # (kind, key) -> item
+        self.items = {}
+        # (host, method) -> heap of (priority, sequence, item), host None - local items
+        self.ready = {}
+        self.sequence = itertools.count()
+        self.in_flight = {}
+        self.started = None
+
+        # kind -> statistics
+        self.finished = {}
+        self.failed = {}
+        self.queue_seconds = {}
+
+    def add(self, item):
+        existing = self.items.get((item.kind, item.key))
+        if existing is not None:
+            return existing
+
+        self.items[item.kind, item.key] = item
+        if item.priority is None:
+            item.priority = self.PRIORITIES.get(item.kind, len(self.PRIORITIES))
+        for dependency in item.depends_on:
+            if not dependency.done:
+                item.waiting_for += 1
+                dependency.dependents.append(item)
+        if not item.waiting_for:
+            self._push(item)
+        return item
+
+    @staticmethod
+    def add_dependency(item, dependency):
+        """
+        One more dependency of an item which is still waiting (e.g. the next league page of a division walk, added
+        while the current one is running)
+        """
+        if not item.waiting_for:
+            raise Exception(f"{item.kind} {item.key} is already ready, it can't wait for {dependency.kind}")
+        item.depends_on.append(dependency)
+        if not dependency.done:
+            item.waiting_for += 1
+            dependency.dependents.append(item)
+
+    def _push(self, item):
+        if item.queued_at is None:
+            url = item.url() if callable(item.url) else item.url
+            item.host = urlsplit(url).netloc if url else None
+            item.method = RateLimiter.method_from_url(url) if url else None
+        item.queued_at = self.clock()
+        heapq.heappush(self.ready.setdefault((item.host, item.method), []),
+                       (item.priority, next(self.sequence), item))
+
+    def _next_item(self):
+        """
+        The most important ready item which can be started now - (item, None), or (None, seconds) until the first
+        endpoint with ready items gets budget.
+        """
+        heads = sorted((heap[0], endpoint) for endpoint, heap in self.ready.items() if heap)
+        wait = None
+        for (_, _, item), endpoint in heads:
+            slot = 0 if item.host is None else self.rate_limiter.next_slot(item.host, item.method)
+            if slot <= 0:
+                heapq.heappop(self.ready[endpoint])
+                return item, None
+            wait = slot if wait is None else min(wait, slot)
+        return None, wait
+
+    async def _start(self, item):
+        item.attempts += 1
+        self.queue_seconds.setdefault(item.kind, []).append(self.clock() - item.queued_at)
+        task = asyncio.ensure_future(item.run())
+        self.in_flight[task] = item
+        # the task takes its rate limiter reservation right away, so the next next_slot already counts it
+        await asyncio.sleep(0)
+
+    def _finish(self, item, result=None, error=None):
+        item.done, item.result, item.error = True, result, error
+        # closures of finished items (e.g. decoded matches) are not kept until the end of the crawl
+        item.run = None
+        counter = self.failed if error is not None else self.finished
+        counter[item.kind] = counter.get(item.kind, 0) + 1
+        for dependent in item.dependents:
+            dependent.waiting_for -= 1
+            if not dependent.waiting_for:
+                self._push(dependent)
+
+    async def run(self):
+        """Async generator - runs until there is nothing left, yields every finished item (also the failed ones)"""
+        self.started = self.clock()
+        while True:
+            wait = None
+            while len(self.in_flight) < self.max_in_flight:
+                item, wait = self._next_item()
+                if item is None:
+                    break
+                await self._start(item)
+
+            if not self.in_flight:
+                if wait is None:
+                    return
+                await asyncio.sleep(wait)
+                continue
+
+            # woken up by the first finished item or when the budget of a waiting endpoint comes back
+            done, _ = await asyncio.wait(self.in_flight, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = self.in_flight.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    if item.attempts < self.max_attempts:
+                        logger.debug(f"Retrying {item.kind} {item.key} after: {e}")
+                        self._push(item)
+                        continue
+                    logger.warning(f"Error while processing {item.kind} {item.key} after {item.attempts} attempts: {e}")
+                    self._finish(item, error=e)
+                    yield item
+                    continue
+
+                self._finish(item, result)
+                yield item
+
+    def report(self):
+        elapsed = self.clock() - self.started if self.started is not None else 0
+        report = {}
+        for kind in sorted(set(self.finished) | set(self.failed), key=lambda kind: self.PRIORITIES.get(kind, 99)):
+            queued = self.queue_seconds.get(kind, [])
+            report[kind] = {
+                "finished": self.finished.get(kind, 0),
+                "failed": self.failed.get(kind, 0),
+                "per_second": round(self.finished.get(kind, 0) / elapsed, 2) if elapsed else 0.0,
+                "avg_queue_seconds": round(sum(queued) / len(queued), 3) if queued else 0.0,
+            }
+        return report
@@ -0,0 +1,172 @@
+-- compact layout of players / traits / units / items - run once after init_db.sql (on an empty or a filled database)
+--
+-- match_id and puuid (VARCHAR(100) in every row of every table and in the wide UNIQUE constraints) are replaced by
+-- integer surrogate keys, trait / champion / item names by SMALLINT keys of small dictionary tables and small numbers
+-- by SMALLINT. A traits row goes from ~150 bytes (+ ~120 bytes in unique_trait) to ~40 bytes (+ ~25 bytes in its key).
+-- Views with the old table names and columns are created on top, so the notebooks and all SELECTs work unchanged.
+-- DatabaseConnection detects this layout (compact_schema) and writes into the compact tables.
+--
+-- old tables are kept as *_legacy - after checking the counts:
+-- DROP TABLE items_legacy, units_legacy, traits_legacy, players_legacy;
+
+BEGIN;
+
+ALTER TABLE matches ADD COLUMN IF NOT EXISTS match_sid SERIAL UNIQUE;
+
+CREATE TABLE IF NOT EXISTS puuids (
+    puuid_sid SERIAL PRIMARY KEY,
+    puuid VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS trait_names (
+    trait_sid SMALLSERIAL PRIMARY KEY,
+    trait_name VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS unit_names (
+    unit_sid SMALLSERIAL PRIMARY KEY,
+    character_id VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS item_names (
+    item_sid SMALLSERIAL PRIMARY KEY,
+    item_id VARCHAR(100) NOT NULL UNIQUE
+);
+
+-- placement is in the primary key index, so joins of traits / units / items with placement are index-only
+CREATE TABLE IF NOT EXISTS players_compact (
+    match_sid INT NOT NULL REFERENCES matches(match_sid) ON DELETE CASCADE,
+    puuid_sid INT NOT NULL REFERENCES puuids(puuid_sid),
+    placement SMALLINT,
+    level SMALLINT,
+    gold_left SMALLINT,
+    last_round SMALLINT,
+    players_eliminated SMALLINT,
+    time_eliminated DOUBLE PRECISION,
+    total_damage SMALLINT,
+    companion_id VARCHAR(100),
+    tier VARCHAR(50),
+    division VARCHAR(10),
+    leaguePoints SMALLINT,
+    wins INT,
+    losses INT,
+    PRIMARY KEY (match_sid, puuid_sid) INCLUDE (placement)
+);
+
+CREATE TABLE IF NOT EXISTS traits_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    trait_sid SMALLINT NOT NULL REFERENCES trait_names(trait_sid),
+    num_units SMALLINT,
+    style SMALLINT,
+    tier_current SMALLINT,
+    tier_total SMALLINT,
+    PRIMARY KEY (match_sid, puuid_sid, trait_sid),
+    FOREIGN KEY (match_sid, puuid_sid) REFERENCES players_compact(match_sid, puuid_sid) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS units_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    unit_sid SMALLINT NOT NULL REFERENCES unit_names(unit_sid),
+    rarity SMALLINT,
+    tier SMALLINT,
+    PRIMARY KEY (match_sid, puuid_sid, unit_sid),
+    FOREIGN KEY (match_sid, puuid_sid) REFERENCES players_compact(match_sid, puuid_sid) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS items_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    unit_sid SMALLINT NOT NULL REFERENCES unit_names(unit_sid),
+    item_sid SMALLINT NOT NULL REFERENCES item_names(item_sid),
+    PRIMARY KEY (match_sid, puuid_sid, unit_sid, item_sid),
+    FOREIGN KEY (match_sid, puuid_sid) REFERENCES players_compact(match_sid, puuid_sid) ON DELETE CASCADE
+);
+
+-- indexes for the notebook queries: matches of one set, all games of one player, all rows of one trait / unit / item
+CREATE INDEX IF NOT EXISTS matches_set ON matches (tft_set_number) INCLUDE (match_sid);
+CREATE INDEX IF NOT EXISTS players_compact_puuid ON players_compact (puuid_sid, match_sid);
+CREATE INDEX IF NOT EXISTS traits_compact_trait ON traits_compact (trait_sid, match_sid);
+CREATE INDEX IF NOT EXISTS units_compact_unit ON units_compact (unit_sid, match_sid);
+CREATE INDEX IF NOT EXISTS items_compact_item ON items_compact (item_sid, match_sid);
+
+-- migration of the existing rows
+ALTER TABLE items RENAME TO items_legacy;
+ALTER TABLE units RENAME TO units_legacy;
+ALTER TABLE traits RENAME TO traits_legacy;
+ALTER TABLE players RENAME TO players_legacy;
+
+INSERT INTO puuids (puuid) SELECT DISTINCT puuid FROM players_legacy ORDER BY 1;
+INSERT INTO trait_names (trait_name) SELECT DISTINCT trait_name FROM traits_legacy ORDER BY 1;
+INSERT INTO unit_names (character_id)
+SELECT character_id FROM units_legacy UNION SELECT character_id FROM items_legacy ORDER BY 1;
+INSERT INTO item_names (item_id) SELECT DISTINCT item_id FROM items_legacy ORDER BY 1;
+
+INSERT INTO players_compact
+SELECT m.match_sid, k.puuid_sid, p.placement, p.level, p.gold_left, p.last_round, p.players_eliminated,
+    p.time_eliminated, p.total_damage, p.companion_id, p.tier, p.division, p.leaguePoints, p.wins, p.losses
+FROM players_legacy p
+    JOIN matches m ON m.match_id = p.match_id
+    JOIN puuids k ON k.puuid = p.puuid
+ON CONFLICT DO NOTHING;
+
+INSERT INTO traits_compact
+SELECT m.match_sid, k.puuid_sid, n.trait_sid, t.num_units, t.style, t.tier_current, t.tier_total
+FROM traits_legacy t
+    JOIN matches m ON m.match_id = t.match_id
+    JOIN puuids k ON k.puuid = t.puuid
+    JOIN trait_names n ON n.trait_name = t.trait_name
+ON CONFLICT DO NOTHING;
+
+INSERT INTO units_compact
+SELECT m.match_sid, k.puuid_sid, n.unit_sid, u.rarity, u.tier
+FROM units_legacy u
+    JOIN matches m ON m.match_id = u.match_id
+    JOIN puuids k ON k.puuid = u.puuid
+    JOIN unit_names n ON n.character_id = u.character_id
+ON CONFLICT DO NOTHING;
+
+INSERT INTO items_compact
+SELECT m.match_sid, k.puuid_sid, n.unit_sid, i.item_sid
+FROM items_legacy t
+    JOIN matches m ON m.match_id = t.match_id
+    JOIN puuids k ON k.puuid = t.puuid
+    JOIN unit_names n ON n.character_id = t.character_id
+    JOIN item_names i ON i.item_id = t.item_id
+ON CONFLICT DO NOTHING;
+
+-- views with the old names and columns (id of traits / units / items doesn't exist anymore - it's NULL)
+CREATE VIEW players AS
+SELECT k.puuid, m.match_id, p.placement, p.level, p.gold_left, p.last_round, p.players_eliminated,
+    p.time_eliminated, p.total_damage, p.companion_id, p.tier, p.division, p.leaguePoints, p.wins, p.losses
+FROM players_compact p
+    JOIN matches m ON m.match_sid = p.match_sid
+    JOIN puuids k ON k.puuid_sid = p.puuid_sid;
+
+CREATE VIEW traits AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.trait_name, t.num_units, t.style, t.tier_current, t.tier_total
+FROM traits_compact t
+    JOIN matches m ON m.match_sid = t.match_sid
+    JOIN puuids k ON k.puuid_sid = t.puuid_sid
+    JOIN trait_names n ON n.trait_sid = t.trait_sid;
+
+CREATE VIEW units AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.character_id, u.rarity, u.tier
+FROM units_compact u
+    JOIN matches m ON m.match_sid = u.match_sid
+    JOIN puuids k ON k.puuid_sid = u.puuid_sid
+    JOIN unit_names n ON n.unit_sid = u.unit_sid;
+
+CREATE VIEW items AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.character_id, i.item_id
+FROM items_compact t
+    JOIN matches m ON m.match_sid = t.match_sid
+    JOIN puuids k ON k.puuid_sid = t.puuid_sid
+    JOIN unit_names n ON n.unit_sid = t.unit_sid
+    JOIN item_names i ON i.item_sid = t.item_sid;
+
+COMMIT;
+
+ANALYZE matches, puuids, trait_names, unit_names, item_names,
+    players_compact, traits_compact, units_compact, items_compact;
@@ -64,6 +64,11 @@ ADD COLUMN leaguePoints INT,
 ADD COLUMN wins INT,
 ADD COLUMN losses INT;
 
+-- dominant tier of the players of the match (Data/MatchTier.py), set at ingest,
+-- for older rows: DatabaseConnection.backfill_match_tiers
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS match_tier VARCHAR(50);
+
 -- adding constraint because we need to have unique values in those columns too - this is necessary for data accuracy
 -- if we are constantly retrieving data from the api, but in our case where we want to just store data,
 -- that we once get and then use it for the analysis it's not crucial.
@@ -85,3 +90,54 @@ ALTER TABLE items ADD CONSTRAINT unique_item UNIQUE (match_id, puuid, character_
 
 
 
+
+-- summary tables (rollups) for the dashboards, updated incrementally with every ingested batch of matches
+-- (DatabaseConnection.refresh_rollups), day is the UTC date of the game, tier is the tier of the player
+CREATE TABLE IF NOT EXISTS rollup_traits (
+    tft_set_number INT NOT NULL,
+    day DATE NOT NULL,
+    tier VARCHAR(50) NOT NULL,
+    trait_name VARCHAR(100) NOT NULL,
+    boards INT NOT NULL,
+    active INT NOT NULL,
+    maxed INT NOT NULL,
+    placement_sum INT NOT NULL,
+    top4 INT NOT NULL,
+    wins INT NOT NULL,
+    PRIMARY KEY (tft_set_number, day, tier, trait_name)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_units (
+    tft_set_number INT NOT NULL,
+    day DATE NOT NULL,
+    tier VARCHAR(50) NOT NULL,
+    character_id VARCHAR(100) NOT NULL,
+    rarity INT,
+    boards INT NOT NULL,
+    three_stars INT NOT NULL,
+    placement_sum INT NOT NULL,
+    top4 INT NOT NULL,
+    wins INT NOT NULL,
+    PRIMARY KEY (tft_set_number, day, tier, character_id)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_items (
+    tft_set_number INT NOT NULL,
+    day DATE NOT NULL,
+    tier VARCHAR(50) NOT NULL,
+    item_id VARCHAR(100) NOT NULL,
+    uses INT NOT NULL,
+    placement_sum INT NOT NULL,
+    top4 INT NOT NULL,
+    wins INT NOT NULL,
+    PRIMARY KEY (tft_set_number, day, tier, item_id)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_matches (
+    tft_set_number INT NOT NULL,
+    day DATE NOT NULL,
+    tier VARCHAR(50) NOT NULL,
+    players INT NOT NULL,
+    game_length_sum DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (tft_set_number, day, tier)
+);
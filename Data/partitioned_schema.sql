@@ -0,0 +1,278 @@
+-- partitioning of matches and the compact tables by set and month - run once after compact_schema.sql
+--
+-- every table is partitioned by LIST (tft_set_number) and every set by RANGE (game_datetime) per calendar month (UTC),
+-- e.g. traits_compact -> traits_compact_s14 -> traits_compact_s14_202505. Queries filtered by set (and game_datetime)
+-- read only the partitions of that set, an old set can be detached as a whole (DatabaseConnection.detach_set).
+-- Partitions are created on ingest by ensure_match_partitions (DatabaseConnection.create_partitions, called by
+-- copy_bulk before the rows are written, calls it for every new set / month of the batch under an advisory lock,
+-- postgres routes every row to its partition).
+--
+-- unique keys of a partitioned table have to contain the partition key, so (tft_set_number, game_datetime) is a part
+-- of every primary key - it's the same for all rows of one match, so uniqueness of the rows doesn't change.
+-- The compact tables of compact_schema.sql don't have these columns, they are added (and filled from matches) first.
+--
+-- Matches without tft_set_number / game_datetime can't be routed to any partition. They are not migrated and not
+-- dropped - they stay in matches_unpartitioned (with their rows in *_compact_unpartitioned) and their number is
+-- reported, DatabaseConnection rejects such matches on ingest with a warning.
+
+CREATE OR REPLACE FUNCTION ensure_match_partitions(set_number INT, month_start DATE) RETURNS VOID AS $$
+DECLARE
+    parent TEXT;
+    set_partition TEXT;
+    month_partition TEXT;
+    range_start BIGINT := (extract(EPOCH FROM month_start::TIMESTAMP) * 1000)::BIGINT;
+    range_end BIGINT := (extract(EPOCH FROM (month_start + INTERVAL '1 month')::TIMESTAMP) * 1000)::BIGINT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['matches', 'players_compact', 'traits_compact', 'units_compact', 'items_compact'] LOOP
+        set_partition := format('%s_s%s', parent, set_number);
+        month_partition := format('%s_%s', set_partition, to_char(month_start, 'YYYYMM'));
+        IF to_regclass(set_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%s) PARTITION BY RANGE (game_datetime)',
+                           set_partition, parent, set_number);
+        END IF;
+        IF to_regclass(month_partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                           month_partition, set_partition, range_start, range_end);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+
+DROP VIEW items, units, traits, players;
+
+ALTER TABLE players_compact
+    ADD COLUMN IF NOT EXISTS tft_set_number SMALLINT, ADD COLUMN IF NOT EXISTS game_datetime BIGINT;
+ALTER TABLE traits_compact
+    ADD COLUMN IF NOT EXISTS tft_set_number SMALLINT, ADD COLUMN IF NOT EXISTS game_datetime BIGINT;
+ALTER TABLE units_compact
+    ADD COLUMN IF NOT EXISTS tft_set_number SMALLINT, ADD COLUMN IF NOT EXISTS game_datetime BIGINT;
+ALTER TABLE items_compact
+    ADD COLUMN IF NOT EXISTS tft_set_number SMALLINT, ADD COLUMN IF NOT EXISTS game_datetime BIGINT;
+
+UPDATE players_compact p SET tft_set_number = m.tft_set_number, game_datetime = m.game_datetime
+FROM matches m WHERE m.match_sid = p.match_sid AND (p.tft_set_number IS NULL OR p.game_datetime IS NULL);
+UPDATE traits_compact t SET tft_set_number = m.tft_set_number, game_datetime = m.game_datetime
+FROM matches m WHERE m.match_sid = t.match_sid AND (t.tft_set_number IS NULL OR t.game_datetime IS NULL);
+UPDATE units_compact u SET tft_set_number = m.tft_set_number, game_datetime = m.game_datetime
+FROM matches m WHERE m.match_sid = u.match_sid AND (u.tft_set_number IS NULL OR u.game_datetime IS NULL);
+UPDATE items_compact i SET tft_set_number = m.tft_set_number, game_datetime = m.game_datetime
+FROM matches m WHERE m.match_sid = i.match_sid AND (i.tft_set_number IS NULL OR i.game_datetime IS NULL);
+
+ALTER TABLE matches RENAME TO matches_unpartitioned;
+ALTER TABLE players_compact RENAME TO players_compact_unpartitioned;
+ALTER TABLE traits_compact RENAME TO traits_compact_unpartitioned;
+ALTER TABLE units_compact RENAME TO units_compact_unpartitioned;
+ALTER TABLE items_compact RENAME TO items_compact_unpartitioned;
+
+-- index names are unique in the schema, so the names are freed for the new tables
+ALTER INDEX matches_pkey RENAME TO matches_unpartitioned_pkey;
+ALTER INDEX matches_match_sid_key RENAME TO matches_unpartitioned_match_sid_key;
+ALTER INDEX matches_set RENAME TO matches_unpartitioned_set;
+ALTER INDEX players_compact_pkey RENAME TO players_compact_unpartitioned_pkey;
+ALTER INDEX players_compact_puuid RENAME TO players_compact_unpartitioned_puuid;
+ALTER INDEX traits_compact_pkey RENAME TO traits_compact_unpartitioned_pkey;
+ALTER INDEX traits_compact_trait RENAME TO traits_compact_unpartitioned_trait;
+ALTER INDEX units_compact_pkey RENAME TO units_compact_unpartitioned_pkey;
+ALTER INDEX units_compact_unit RENAME TO units_compact_unpartitioned_unit;
+ALTER INDEX items_compact_pkey RENAME TO items_compact_unpartitioned_pkey;
+ALTER INDEX items_compact_item RENAME TO items_compact_unpartitioned_item;
+
+CREATE TABLE matches (
+    match_id VARCHAR(100) NOT NULL,
+    game_datetime BIGINT NOT NULL,
+    game_length DOUBLE PRECISION,
+    map_id INT,
+    tft_set_number INT NOT NULL,
+    match_tier VARCHAR(50),
+    match_sid INT NOT NULL DEFAULT nextval('matches_match_sid_seq'),
+    PRIMARY KEY (match_id, tft_set_number, game_datetime),
+    UNIQUE (match_sid, tft_set_number, game_datetime)
+) PARTITION BY LIST (tft_set_number);
+
+ALTER SEQUENCE matches_match_sid_seq OWNED BY matches.match_sid;
+
+CREATE TABLE players_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL REFERENCES puuids(puuid_sid),
+    tft_set_number SMALLINT NOT NULL,
+    game_datetime BIGINT NOT NULL,
+    placement SMALLINT,
+    level SMALLINT,
+    gold_left SMALLINT,
+    last_round SMALLINT,
+    players_eliminated SMALLINT,
+    time_eliminated DOUBLE PRECISION,
+    total_damage SMALLINT,
+    companion_id VARCHAR(100),
+    tier VARCHAR(50),
+    division VARCHAR(10),
+    leaguePoints SMALLINT,
+    wins INT,
+    losses INT,
+    PRIMARY KEY (match_sid, puuid_sid, tft_set_number, game_datetime) INCLUDE (placement),
+    FOREIGN KEY (match_sid, tft_set_number, game_datetime)
+        REFERENCES matches(match_sid, tft_set_number, game_datetime) ON DELETE CASCADE
+) PARTITION BY LIST (tft_set_number);
+
+CREATE TABLE traits_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    tft_set_number SMALLINT NOT NULL,
+    game_datetime BIGINT NOT NULL,
+    trait_sid SMALLINT NOT NULL REFERENCES trait_names(trait_sid),
+    num_units SMALLINT,
+    style SMALLINT,
+    tier_current SMALLINT,
+    tier_total SMALLINT,
+    PRIMARY KEY (match_sid, puuid_sid, trait_sid, tft_set_number, game_datetime),
+    FOREIGN KEY (match_sid, puuid_sid, tft_set_number, game_datetime)
+        REFERENCES players_compact(match_sid, puuid_sid, tft_set_number, game_datetime) ON DELETE CASCADE
+) PARTITION BY LIST (tft_set_number);
+
+CREATE TABLE units_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    tft_set_number SMALLINT NOT NULL,
+    game_datetime BIGINT NOT NULL,
+    unit_sid SMALLINT NOT NULL REFERENCES unit_names(unit_sid),
+    rarity SMALLINT,
+    tier SMALLINT,
+    PRIMARY KEY (match_sid, puuid_sid, unit_sid, tft_set_number, game_datetime),
+    FOREIGN KEY (match_sid, puuid_sid, tft_set_number, game_datetime)
+        REFERENCES players_compact(match_sid, puuid_sid, tft_set_number, game_datetime) ON DELETE CASCADE
+) PARTITION BY LIST (tft_set_number);
+
+CREATE TABLE items_compact (
+    match_sid INT NOT NULL,
+    puuid_sid INT NOT NULL,
+    tft_set_number SMALLINT NOT NULL,
+    game_datetime BIGINT NOT NULL,
+    unit_sid SMALLINT NOT NULL REFERENCES unit_names(unit_sid),
+    item_sid SMALLINT NOT NULL REFERENCES item_names(item_sid),
+    PRIMARY KEY (match_sid, puuid_sid, unit_sid, item_sid, tft_set_number, game_datetime),
+    FOREIGN KEY (match_sid, puuid_sid, tft_set_number, game_datetime)
+        REFERENCES players_compact(match_sid, puuid_sid, tft_set_number, game_datetime) ON DELETE CASCADE
+) PARTITION BY LIST (tft_set_number);
+
+CREATE INDEX players_compact_puuid ON players_compact (puuid_sid, match_sid);
+CREATE INDEX traits_compact_trait ON traits_compact (trait_sid, match_sid);
+CREATE INDEX units_compact_unit ON units_compact (unit_sid, match_sid);
+CREATE INDEX items_compact_item ON items_compact (item_sid, match_sid);
+
+-- partitions of the stored matches, then the rows (matches without game_datetime / set can't be partitioned)
+DO $$
+DECLARE
+    bounds RECORD;
+BEGIN
+    FOR bounds IN
+        SELECT DISTINCT tft_set_number,
+            date_trunc('month', to_timestamp(game_datetime / 1000.0) AT TIME ZONE 'UTC')::DATE AS month_start
+        FROM matches_unpartitioned
+        WHERE game_datetime IS NOT NULL AND tft_set_number IS NOT NULL
+    LOOP
+        PERFORM ensure_match_partitions(bounds.tft_set_number, bounds.month_start);
+    END LOOP;
+END;
+$$;
+
+INSERT INTO matches (match_id, game_datetime, game_length, map_id, tft_set_number, match_tier, match_sid)
+SELECT match_id, game_datetime, game_length, map_id, tft_set_number, match_tier, match_sid
+FROM matches_unpartitioned
+WHERE game_datetime IS NOT NULL AND tft_set_number IS NOT NULL;
+
+-- columns are listed - the added columns are at the end of the old tables, but after match_sid / puuid_sid here
+INSERT INTO players_compact (match_sid, puuid_sid, tft_set_number, game_datetime, placement, level, gold_left,
+    last_round, players_eliminated, time_eliminated, total_damage, companion_id, tier, division, leaguePoints, wins,
+    losses)
+SELECT match_sid, puuid_sid, tft_set_number, game_datetime, placement, level, gold_left, last_round,
+    players_eliminated, time_eliminated, total_damage, companion_id, tier, division, leaguePoints, wins, losses
+FROM players_compact_unpartitioned
+WHERE tft_set_number IS NOT NULL AND game_datetime IS NOT NULL;
+
+INSERT INTO traits_compact (match_sid, puuid_sid, tft_set_number, game_datetime, trait_sid, num_units, style,
+    tier_current, tier_total)
+SELECT match_sid, puuid_sid, tft_set_number, game_datetime, trait_sid, num_units, style, tier_current, tier_total
+FROM traits_compact_unpartitioned
+WHERE tft_set_number IS NOT NULL AND game_datetime IS NOT NULL;
+
+INSERT INTO units_compact (match_sid, puuid_sid, tft_set_number, game_datetime, unit_sid, rarity, tier)
+SELECT match_sid, puuid_sid, tft_set_number, game_datetime, unit_sid, rarity, tier
+FROM units_compact_unpartitioned
+WHERE tft_set_number IS NOT NULL AND game_datetime IS NOT NULL;
+
+INSERT INTO items_compact (match_sid, puuid_sid, tft_set_number, game_datetime, unit_sid, item_sid)
+SELECT match_sid, puuid_sid, tft_set_number, game_datetime, unit_sid, item_sid
+FROM items_compact_unpartitioned
+WHERE tft_set_number IS NOT NULL AND game_datetime IS NOT NULL;
+
+-- old tables are dropped only if every match was moved, otherwise the migrated matches are deleted from them
+-- (their compact rows go too - ON DELETE CASCADE) and the rest is kept for a manual fix.
+-- The *_legacy tables of compact_schema.sql (kept for checking the counts) still have foreign keys to the old matches
+-- table with ON DELETE CASCADE - the keys are dropped first, so the legacy rows are neither deleted nor in the way.
+DO $$
+DECLARE
+    unpartitionable BIGINT;
+    legacy_key RECORD;
+BEGIN
+    FOR legacy_key IN
+        SELECT conrelid::regclass AS table_name, conname FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = 'matches_unpartitioned'::regclass
+            AND conrelid::regclass::TEXT NOT LIKE '%\_compact\_unpartitioned'
+    LOOP
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', legacy_key.table_name, legacy_key.conname);
+    END LOOP;
+
+    SELECT COUNT(*) INTO unpartitionable FROM matches_unpartitioned
+    WHERE game_datetime IS NULL OR tft_set_number IS NULL;
+
+    IF unpartitionable = 0 THEN
+        DROP TABLE items_compact_unpartitioned, units_compact_unpartitioned, traits_compact_unpartitioned,
+            players_compact_unpartitioned, matches_unpartitioned;
+    ELSE
+        DELETE FROM matches_unpartitioned WHERE game_datetime IS NOT NULL AND tft_set_number IS NOT NULL;
+        RAISE WARNING '% matches without tft_set_number / game_datetime were not partitioned, they are kept in '
+            'matches_unpartitioned and *_compact_unpartitioned', unpartitionable;
+    END IF;
+END;
+$$;
+
+-- the same views as in compact_schema.sql, now on top of the partitioned tables - joined also on the partition key,
+-- so a filter on matches.tft_set_number prunes the partitions of the child table too
+CREATE VIEW players AS
+SELECT k.puuid, m.match_id, p.placement, p.level, p.gold_left, p.last_round, p.players_eliminated,
+    p.time_eliminated, p.total_damage, p.companion_id, p.tier, p.division, p.leaguePoints, p.wins, p.losses
+FROM players_compact p
+    JOIN matches m
+        ON m.match_sid = p.match_sid AND m.tft_set_number = p.tft_set_number AND m.game_datetime = p.game_datetime
+    JOIN puuids k ON k.puuid_sid = p.puuid_sid;
+
+CREATE VIEW traits AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.trait_name, t.num_units, t.style, t.tier_current, t.tier_total
+FROM traits_compact t
+    JOIN matches m
+        ON m.match_sid = t.match_sid AND m.tft_set_number = t.tft_set_number AND m.game_datetime = t.game_datetime
+    JOIN puuids k ON k.puuid_sid = t.puuid_sid
+    JOIN trait_names n ON n.trait_sid = t.trait_sid;
+
+CREATE VIEW units AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.character_id, u.rarity, u.tier
+FROM units_compact u
+    JOIN matches m
+        ON m.match_sid = u.match_sid AND m.tft_set_number = u.tft_set_number AND m.game_datetime = u.game_datetime
+    JOIN puuids k ON k.puuid_sid = u.puuid_sid
+    JOIN unit_names n ON n.unit_sid = u.unit_sid;
+
+CREATE VIEW items AS
+SELECT NULL::INT AS id, m.match_id, k.puuid, n.character_id, i.item_id
+FROM items_compact t
+    JOIN matches m
+        ON m.match_sid = t.match_sid AND m.tft_set_number = t.tft_set_number AND m.game_datetime = t.game_datetime
+    JOIN puuids k ON k.puuid_sid = t.puuid_sid
+    JOIN unit_names n ON n.unit_sid = t.unit_sid
+    JOIN item_names i ON i.item_sid = t.item_sid;
+
+COMMIT;
+
+ANALYZE matches, players_compact, traits_compact, units_compact, items_compact;
@@ -0,0 +1,50 @@
+import asyncio
+import os
+
+import pytest
+
+from Data.MockRiotServer import MockRiotServer
+
+# practically unlimited - tests which don't check the rate limiting shouldn't wait for it
+UNLIMITED = {"app_limits": "100000:1", "method_limits": "100000:1"}
+
+
+@pytest.fixture
+def mock_pipeline(tmp_path, monkeypatch):
+    """
+    Factory of DataPipelines pointed at two MockRiotServers (eun1 and europe) with empty local state:
+        pipeline, servers = mock_pipeline(**server_options)
+    """
+    servers = []
+
+    def create(**server_options):
+        options = {**UNLIMITED, **server_options}
+        platform, regional = MockRiotServer(**options).start(), MockRiotServer(**options).start()
+        servers.extend((platform, regional))
+
+        state = tmp_path / f"state_{len(servers) // 2}"
+        monkeypatch.setenv("RIOT_GAMES_KEY", "mock")
+        monkeypatch.setenv("RIOT_EUNE_BASE_URL", platform.base_url)
+        monkeypatch.setenv("RIOT_EUROPE_BASE_URL", regional.base_url)
+        monkeypatch.setenv("LEAGUE_CACHE_PATH", str(state / "league_cache.sqlite"))
+        monkeypatch.setenv("RANK_SNAPSHOT_PATH", str(state / "rank_snapshot.sqlite"))
+        monkeypatch.setenv("MATCH_WATERMARKS_PATH", str(state / "match_watermarks.sqlite"))
+        monkeypatch.setenv("MATCH_ARCHIVE_PATH", str(state / "archive"))
+
+        from Data.DataPipeline import DataPipeline
+        return DataPipeline(os.path.join(tmp_path, ".env")), (platform, regional)
+
+    yield create
+    for server in servers:
+        server.stop()
+
+
+def collect(generator):
+    """All rows of an async crawl (collect_data_from_tier_async, crawl_tier_scheduled, ...)"""
+    async def run():
+        return [match_rows async for match_rows in generator]
+    return asyncio.run(run())
+
+
+def requests_by_method(servers, method):
+    return sum(sum(server.stats()["by_method"].get(method, {}).values()) for server in servers)
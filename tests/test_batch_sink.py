@@ -0,0 +1,44 @@
+import pytest
+
+from Data.BatchSink import BatchSink
+
+
+class FlakyDatabase:
+    """Stand-in for DatabaseConnection - the first `failures` writes fail"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.written = []
+
+    def add_match_rows_bulk(self, tables):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("connection lost")
+        self.written.extend(match[0] for match in tables["matches"])
+
+
+def match_rows(match_id):
+    return {"matches": [(match_id, 1_740_000_000_000, 1900.0, 22, 14, "GOLD")], "players": [], "traits": [],
+            "units": [], "items": []}
+
+
+def test_failed_write_keeps_the_batch():
+    db, flushed = FlakyDatabase(failures=1), []
+    sink = BatchSink(db, max_matches=2, on_flush=flushed.extend)
+    sink.add(match_rows("EUN1_1"))
+    with pytest.raises(Exception, match="connection lost"):
+        sink.add(match_rows("EUN1_2"))
+    assert db.written == [] and flushed == []
+
+    # the failed batch goes with the next flush
+    sink.add(match_rows("EUN1_3"))
+    assert db.written == flushed == ["EUN1_1", "EUN1_2", "EUN1_3"]
+    assert sink.flushed_matches == 3 and sink.buffered_matches == 0
+
+
+def test_error_reaches_the_caller_on_close():
+    db = FlakyDatabase(failures=2)
+    with pytest.raises(Exception, match="connection lost"):
+        with BatchSink(db, max_matches=10) as sink:
+            sink.add(match_rows("EUN1_1"))
+    assert sink.buffered_matches == 1
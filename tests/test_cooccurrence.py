@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from Data.Cooccurrence import Cooccurrence
+
+
+def batch(match_id, boards):
+    """Row tuples of one match of set 14 - boards: list of (placement, traits, units)"""
+    tables = {"matches": [(match_id, 1_740_000_000_000, 1900.0, 22, 14, "GOLD")], "players": [], "traits": [],
+              "units": [], "items": []}
+    for number, (placement, traits, units) in enumerate(boards):
+        puuid = f"player-{number}"
+        tables["players"].append((puuid, match_id, placement))
+        tables["traits"].extend((match_id, puuid, trait, 2, 1, 1, 3) for trait in traits)
+        tables["units"].extend((match_id, puuid, unit, 1, 2) for unit in units)
+    return tables
+
+
+BOARDS = [(1, ["Vanguard", "Rapidfire"], ["Jinx"]), (5, ["Vanguard"], ["Jinx", "Vi"])]
+
+
+def test_pairs_of_one_batch(tmp_path):
+    cooccurrence = Cooccurrence(str(tmp_path))
+    assert cooccurrence.add_rows(batch("EUN1_1", BOARDS)) == 2
+    # the same match is never counted twice
+    assert cooccurrence.add_rows(batch("EUN1_1", BOARDS)) == 0
+
+    pairs = cooccurrence.pairs(14, "unit_unit", min_count=1)
+    assert pairs[["a", "b", "count", "avg_placement"]].values.tolist() == [["Jinx", "Vi", 1, 5.0]]
+    assert Cooccurrence(str(tmp_path)).matrix(14, "trait_trait")[0, 0] == 2
+
+
+def test_interrupted_save_is_not_counted(tmp_path, monkeypatch):
+    cooccurrence = Cooccurrence(str(tmp_path))
+    cooccurrence.add_rows(batch("EUN1_1", BOARDS))
+
+    # crash after matches.txt is appended, before matrices.npz is replaced
+    replace = os.replace
+
+    def failing_replace(source, target):
+        if target.endswith("matrices.npz"):
+            raise OSError("disk full")
+        replace(source, target)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        cooccurrence.add_rows(batch("EUN1_2", BOARDS))
+    monkeypatch.setattr(os, "replace", replace)
+
+    # the match of the failed save is counted once, when it's added again
+    reopened = Cooccurrence(str(tmp_path))
+    assert reopened.add_rows(batch("EUN1_2", BOARDS)) == 2
+    assert reopened.add_rows(batch("EUN1_2", BOARDS)) == 0
+    assert Cooccurrence(str(tmp_path)).vocabulary(14, "traits") == ["Vanguard", "Rapidfire"]
+    assert Cooccurrence(str(tmp_path)).matrix(14, "trait_trait")[0, 0] == 4
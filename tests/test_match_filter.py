@@ -0,0 +1,36 @@
+import threading
+import zlib
+
+import pytest
+
+from Data.CrawlState import CrawlState
+from tests.conftest import collect, requests_by_method
+
+DETAILS = "tft/match/v1/matches"
+
+
+def crawls(pipeline, tmp_path, match_filter):
+    crawl_state = CrawlState(str(tmp_path / "crawl_state.sqlite"))
+    crawl_state.start_run()
+    return {
+        "async": lambda: pipeline.collect_data_from_tier_async(3, 3, "GOLD", match_filter=match_filter),
+        "scheduled": lambda: pipeline.crawl_tier_scheduled(3, 3, "GOLD", match_filter=match_filter),
+        "resumable": lambda: pipeline.crawl_tier_resumable(crawl_state, 3, 3, "GOLD", match_filter=match_filter),
+    }
+
+
+@pytest.mark.parametrize("crawl", ["async", "scheduled", "resumable"])
+def test_known_matches_are_filtered_off_the_event_loop(mock_pipeline, tmp_path, crawl):
+    pipeline, servers = mock_pipeline()
+    filter_threads = set()
+
+    def match_filter(match_ids):
+        filter_threads.add(threading.current_thread())
+        # every other match is already stored
+        return [match_id for match_id in match_ids if zlib.crc32(match_id.encode()) % 2]
+
+    rows = collect(crawls(pipeline, tmp_path, match_filter)[crawl]())
+
+    assert rows
+    assert threading.main_thread() not in filter_threads
+    assert requests_by_method(servers, DETAILS) == len(rows)
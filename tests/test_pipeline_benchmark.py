@@ -0,0 +1,33 @@
+import pytest
+
+from Data import PipelineBenchmark
+
+MODES = {"sync": [], "async": ["--async"], "scheduled": ["--scheduled"]}
+
+
+@pytest.fixture
+def benchmark_run(monkeypatch):
+    """PipelineBenchmark.run with a small crawl - the environment it sets is restored after the test"""
+    for name in ("RIOT_GAMES_KEY", "RIOT_EUNE_BASE_URL", "RIOT_EUROPE_BASE_URL", "LEAGUE_CACHE_PATH",
+                 "RANK_SNAPSHOT_PATH", "MATCH_WATERMARKS_PATH", "MATCH_ARCHIVE_PATH"):
+        monkeypatch.setenv(name, "")
+    monkeypatch.delenv("BENCHMARK_DOTENV", raising=False)
+
+    def run(mode):
+        argv = ["--players", "3", "--matches", "3", "--latency", "0", "--jitter", "0"] + MODES[mode]
+        return PipelineBenchmark.run(PipelineBenchmark.parse_args(argv))
+
+    return run
+
+
+@pytest.mark.parametrize("mode", ["async", "scheduled"])
+def test_mode_collects_the_same_matches_as_sync(benchmark_run, mode):
+    expected = benchmark_run("sync")
+    result = benchmark_run(mode)
+
+    # 4 divisions * 3 players * 3 matches, minus matches shared by the players
+    assert 0 < result["matches"] <= 36
+    assert result["matches"] == expected["matches"]
+    # concurrency must not cost extra api calls - league pages, listings and rank lookups are shared the same way
+    assert result["api_calls_per_match"] <= expected["api_calls_per_match"] <= 2.0
+    assert result["rate_limited_responses"] == 0
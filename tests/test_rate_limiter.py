@@ -0,0 +1,84 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from Data.AsyncFetcher import AsyncFetcher
+from Data.RateLimiter import RateLimiter
+
+METHOD = "tft/league/v1/by-puuid"
+
+
+def statuses(server):
+    return server.stats()["by_method"].get(METHOD, {})
+
+
+def test_limits_are_read_from_the_headers(mock_pipeline):
+    pipeline, (platform, _) = mock_pipeline(app_limits="7:1,30:60", method_limits="3:10")
+    host = urlsplit(platform.base_url).netloc
+
+    pipeline.rate_limited_requests(pipeline.league_by_puuid_url("a"))
+
+    assert pipeline.rate_limiter.limits[("app", host)] == [(7, 1), (30, 60)]
+    assert pipeline.rate_limiter.limits[("method", host, METHOD)] == [(3, 10)]
+    # the next 2 calls fit into the method limit, the 4th one has to wait for the 10s window
+    for puuid in ("b", "c"):
+        pipeline.rate_limited_requests(pipeline.league_by_puuid_url(puuid))
+    assert pipeline.rate_limiter.next_slot(host, METHOD) > 9
+
+
+def test_retry_after_is_respected(mock_pipeline):
+    pipeline, (platform, _) = mock_pipeline(app_limits="2:1")
+    # another process using the same key spends the whole budget, our limiter doesn't know about it
+    for puuid in ("x", "y"):
+        requests.get(pipeline.league_by_puuid_url(puuid))
+
+    started = time.monotonic()
+    entries = pipeline.rate_limited_requests(pipeline.league_by_puuid_url("a"))
+
+    assert entries[0]["puuid"] == "a"
+    assert time.monotonic() - started >= 1
+    assert pipeline.rate_limiter.rate_limited_responses == 1
+    assert statuses(platform) == {200: 3, 429: 1}
+
+
+def test_limit_is_not_exceeded_by_concurrent_requests(mock_pipeline):
+    pipeline, (platform, _) = mock_pipeline(app_limits="10:1")
+    rate_limiter = RateLimiter(app_limits="10:1")
+
+    async def fetch_all():
+        async with AsyncFetcher(rate_limiter) as fetcher:
+            return await asyncio.gather(*(fetcher.get(pipeline.league_by_puuid_url(i)) for i in range(25)))
+
+    assert len(asyncio.run(fetch_all())) == 25
+    assert statuses(platform) == {200: 25}
+    assert rate_limiter.rate_limited_responses == 0
+
+
+def test_server_errors_are_retried(mock_pipeline, monkeypatch):
+    monkeypatch.setenv("RETRY_BACKOFF", "0.01")
+    pipeline, (platform, _) = mock_pipeline(error_rate=0.3)
+    pipeline.max_retries = 10
+
+    for puuid in range(10):
+        pipeline.rate_limited_requests(pipeline.league_by_puuid_url(puuid))
+
+    async def fetch_all():
+        async with AsyncFetcher(pipeline.rate_limiter, max_retries=10, retry_backoff=0.01) as fetcher:
+            return await asyncio.gather(*(fetcher.get(pipeline.league_by_puuid_url(i)) for i in range(10, 20)))
+
+    assert len(asyncio.run(fetch_all())) == 10
+    assert statuses(platform)[200] == 20
+    assert statuses(platform)[503] > 0
+
+
+def test_persistent_server_error_is_raised(mock_pipeline, monkeypatch):
+    monkeypatch.setenv("RETRY_BACKOFF", "0.01")
+    pipeline, (platform, _) = mock_pipeline(error_rate=1.0)
+    pipeline.max_retries = 2
+
+    with pytest.raises(Exception, match="503"):
+        pipeline.rate_limited_requests(pipeline.league_by_puuid_url("a"))
+    assert statuses(platform) == {503: 3}
@@ -0,0 +1,15 @@
+from tests.conftest import collect, requests_by_method
+
+
+def test_scheduled_crawl_takes_ranks_from_the_snapshot(mock_pipeline):
+    pipeline, servers = mock_pipeline()
+    async_rows = collect(pipeline.collect_data_from_tier_async(3, 3, "GOLD"))
+    async_lookups = requests_by_method(servers, "tft/league/v1/by-puuid")
+
+    pipeline, servers = mock_pipeline()
+    scheduled_rows = collect(pipeline.crawl_tier_scheduled(3, 3, "GOLD"))
+    scheduled_lookups = requests_by_method(servers, "tft/league/v1/by-puuid")
+
+    assert len(scheduled_rows) == len(async_rows) > 0
+    # participants are players of the walked divisions - rank lookups wait for the walks, not the api
+    assert scheduled_lookups <= async_lookups